@@ -1,9 +1,215 @@
+import datetime
+
 import models
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import SEARCH_VAR, ChangeList
+from django.contrib.sites.models import Site
+from django.core.paginator import InvalidPage
+from django.db.models import Q, Sum
+from django.template.response import TemplateResponse
+
+from blogengine import bulk
+from blogengine.pagination import EPOCH, CachedCountPaginator
+
+# Number of tags offered by the tag filter, the ones on the most posts
+TAG_FILTER_CHOICES = 20
+
+class PublishedFilter(admin.SimpleListFilter):
+	"""Years, then the months of the chosen year, from the stored ArchiveMonth rows.
+
+	Stands in for date_hierarchy, which finds its years and months with a
+	SELECT DISTINCT over every post.
+	"""
+	title = 'published'
+	parameter_name = 'published'
+
+	def lookups(self, request, model_admin):
+		months = models.ArchiveMonth.objects.filter(post_count__gt=0)
+		years = sorted(set(months.values_list('year', flat=True)), reverse=True)
+		choices = [(str(year), str(year)) for year in years]
+		# Called before self.value() is set
+		value = request.GET.get(self.parameter_name, '')
+		if value[:4].isdigit():
+			year = int(value[:4])
+			for month in sorted(set(months.filter(year=year).values_list('month', flat=True)), reverse=True):
+				choices.append(('%d-%02d' % (year, month), datetime.date(year, month, 1).strftime('%B %Y')))
+		return choices
+
+	def queryset(self, request, queryset):
+		value = self.value()
+		if not value:
+			return queryset
+		try:
+			year, _, month = value.partition('-')
+			year = int(year)
+			if month:
+				month = int(month)
+				start = datetime.datetime(year, month, 1, tzinfo=EPOCH.tzinfo)
+				end = datetime.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=EPOCH.tzinfo)
+			else:
+				start = datetime.datetime(year, 1, 1, tzinfo=EPOCH.tzinfo)
+				end = datetime.datetime(year + 1, 1, 1, tzinfo=EPOCH.tzinfo)
+		except ValueError:
+			raise IncorrectLookupParameters(value)
+		return queryset.filter(pub_date__gte=start, pub_date__lt=end)
+
+class TagFilter(admin.SimpleListFilter):
+	"""The TAG_FILTER_CHOICES most used tags, rather than every tag there is."""
+	title = 'tag'
+	parameter_name = 'tag'
+
+	def lookups(self, request, model_admin):
+		tags = list(models.Tag.objects.filter(post_count__gt=0).order_by('-post_count', 'name')
+					.values_list('pk', 'name')[:TAG_FILTER_CHOICES])
+		value = request.GET.get(self.parameter_name)
+		if value and value.isdigit() and int(value) not in [pk for pk, name in tags]:
+			tags.extend(models.Tag.objects.filter(pk=value).values_list('pk', 'name'))
+		return [(str(pk), name) for pk, name in tags]
+
+	def queryset(self, request, queryset):
+		value = self.value()
+		if not value:
+			return queryset
+		if not value.isdigit():
+			raise IncorrectLookupParameters(value)
+		return queryset.filter(tags=value)
+
+class PostChangeList(ChangeList):
+	def get_results(self, request):
+		# As ChangeList.get_results, with the unfiltered total counted by the paginator too
+		paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+		result_list = None
+		if paginator.estimated and not self.show_all:
+			# Always paged, so an estimate behind the posts can't list them all at once
+			try:
+				result_list = paginator.page(self.page_num + 1).object_list
+			except InvalidPage:
+				pass
+			if result_list is None or self.page_num * self.list_per_page + len(result_list) > paginator.count:
+				# More posts than estimated, count them instead
+				paginator = self.model_admin.paginator(self.queryset, self.list_per_page)
+				result_list = None
+		result_count = paginator.count
+		if self.get_filters_params() or self.params.get(SEARCH_VAR):
+			full_result_count = self.model_admin.get_paginator(request, self.root_queryset,
+																self.list_per_page).count
+		else:
+			full_result_count = result_count
+		can_show_all = result_count <= self.list_max_show_all
+		multi_page = result_count > self.list_per_page
+
+		if result_list is None:
+			if (self.show_all and can_show_all) or not multi_page:
+				result_list = self.queryset._clone()
+			else:
+				try:
+					result_list = paginator.page(self.page_num + 1).object_list
+				except InvalidPage:
+					raise IncorrectLookupParameters
+
+		self.result_count = result_count
+		self.full_result_count = full_result_count
+		self.result_list = result_list
+		self.can_show_all = can_show_all
+		self.multi_page = multi_page
+		self.paginator = paginator
+
+class BulkEditForm(forms.Form):
+	"""What the bulk actions move the posts to, chosen next to the action."""
+	category = forms.ModelChoiceField(models.Category.objects.all(), required=False)
+	tag = forms.CharField(required=False, help_text='Name or slug')
+	site = forms.ModelChoiceField(Site.objects.all(), required=False)
+
+	def clean_tag(self):
+		name = self.cleaned_data['tag'].strip()
+		if not name:
+			return None
+		try:
+			return models.Tag.objects.get(Q(name=name) | Q(slug=name))
+		except (models.Tag.DoesNotExist, models.Tag.MultipleObjectsReturned):
+			raise forms.ValidationError("No single tag called %s" % name)
+
+class PostActionForm(helpers.ActionForm, BulkEditForm):
+	def clean_tag(self):
+		# Checked by the action, as an invalid action form drops the action unexplained
+		return self.cleaned_data['tag']
 
 class PostAdmin(admin.ModelAdmin):
 	prepopulated_fields = {"slug": ("title",)}
 	exclude = ('author',)
+	list_display = ('title', 'pub_date', 'category', 'author', 'site')
+	list_select_related = ('category', 'author', 'site')
+	list_filter = (PublishedFilter, 'category', TagFilter, 'site')
+	paginator = CachedCountPaginator
+	list_per_page = 50
+	action_form = PostActionForm
+	actions = ['set_category', 'add_tag', 'remove_tag', 'move_to_site', 'delete_posts']
+
+	def get_changelist(self, request, **kwargs):
+		return PostChangeList
+
+	def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+		count = None
+		if not queryset.query.where:
+			# Every post, as counted in ArchiveMonth; none counted may just mean none stored
+			count = models.ArchiveMonth.objects.aggregate(total=Sum('post_count'))['total'] or None
+		paginator = self.paginator(queryset, per_page, orphans, allow_empty_first_page, count=count)
+		# Set apart from real or cached counts, see PostChangeList.get_results
+		paginator.estimated = count is not None
+		return paginator
+
+	def get_bulk_value(self, request, field):
+		"""The ``field`` chosen next to the action, or None after saying what is missing."""
+		form = BulkEditForm(request.POST)
+		form.is_valid()
+		value = form.cleaned_data.get(field)
+		if field in form.errors:
+			self.message_user(request, ' '.join(form.errors[field]), messages.ERROR)
+		elif value is None:
+			self.message_user(request, "Choose a %s for this action." % field, messages.ERROR)
+		return value
+
+	def set_category(self, request, queryset):
+		category = self.get_bulk_value(request, 'category')
+		if category is not None:
+			self.message_user(request, "Moved %d posts to %s." % (bulk.set_category(queryset, category), category))
+	set_category.short_description = 'Move selected posts to the chosen category'
+
+	def add_tag(self, request, queryset):
+		tag = self.get_bulk_value(request, 'tag')
+		if tag is not None:
+			self.message_user(request, "Tagged %d posts with %s." % (bulk.add_tag(queryset, tag), tag))
+	add_tag.short_description = 'Add the chosen tag to selected posts'
+
+	def remove_tag(self, request, queryset):
+		tag = self.get_bulk_value(request, 'tag')
+		if tag is not None:
+			self.message_user(request, "Removed %s from %d posts." % (tag, bulk.remove_tag(queryset, tag)))
+	remove_tag.short_description = 'Remove the chosen tag from selected posts'
+
+	def move_to_site(self, request, queryset):
+		site = self.get_bulk_value(request, 'site')
+		if site is not None:
+			self.message_user(request, "Moved %d posts to %s." % (bulk.move_to_site(queryset, site), site))
+	move_to_site.short_description = 'Move selected posts to the chosen site'
+
+	def delete_posts(self, request, queryset):
+		"""Like delete_selected, but confirmed with a count instead of listing every object."""
+		if request.POST.get('post'):
+			self.message_user(request, "Deleted %d posts." % bulk.delete_posts(queryset))
+			return None
+		return TemplateResponse(request, 'admin/blogengine/post/delete_posts.html', {
+			'title': 'Are you sure?',
+			'opts': self.model._meta,
+			'count': queryset.count(),
+			'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+			'select_across': request.POST.get('select_across') == '1',
+			'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+		}, current_app=self.admin_site.name)
+	delete_posts.short_description = 'Delete selected posts quickly'
 
 	def save_model(self, request, obj, form, change):
 		obj.author = request.user
@@ -11,4 +217,4 @@ class PostAdmin(admin.ModelAdmin):
 
 admin.site.register(models.Category)
 admin.site.register(models.Tag)
-admin.site.register(models.Post, PostAdmin)
\ No newline at end of file
+admin.site.register(models.Post, PostAdmin)
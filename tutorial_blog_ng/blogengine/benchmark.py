@@ -0,0 +1,330 @@
+"""Synthetic datasets and load runs, to compare the public pages before and after a change.
+
+``seedbenchmark`` imports posts drawn from synthetic_records(): categories
+and tags follow a Zipf distribution, so a few of them hold most posts, and
+the texts are Markdown with headings, lists, code and links. For a given
+seed, record ``n`` is the same whatever the size, so the 1k dataset is the
+newest 1000 posts of the 100k one and runs on either are repeatable.
+
+``runbenchmark`` requests paths sampled with sample_paths() for each route,
+in process through the WSGI handler or over HTTP, and reports the latency
+percentiles, throughput and (in process only) SQL queries per request.
+"""
+import bisect
+import collections
+import math
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from blogengine.models import Category, Post, Tag
+
+DATASETS = {'1k': 1000, '100k': 100000, '1m': 1000000}
+ROUTES = ('index', 'detail', 'category', 'tag', 'feed', 'flatpage')
+CATEGORIES = 40
+TAGS = 400
+# The newest synthetic post, older ones follow every POST_INTERVAL
+LAST_PUB_DATE = datetime(2014, 6, 1, tzinfo=timezone.utc)
+POST_INTERVAL = timedelta(minutes=2)
+FLATPAGES = (('/about/', 'About'), ('/contact/', 'Contact'), ('/colophon/', 'Colophon'))
+
+WORDS = """
+the of and to in is for that with on as it be are this by from at or an was
+have not can you which all but will one more when data there use has each
+python django code server query cache index page post blog request response
+database table row column model view template test function class method
+value list string number file module package version release change fix
+performance latency memory thread process worker queue lock network socket
+user author editor reader comment feed archive category tag search result
+simple fast slow small large first last new old good better best build run
+deploy config setting option default error warning debug log trace profile
+""".split()
+
+
+class Zipf(object):
+	"""Draws ranks 0 to n - 1, rank r with weight 1 / (r + 1) ** exponent."""
+
+	def __init__(self, n, exponent=1.0):
+		self.cumulative = []
+		total = 0.0
+		for rank in range(n):
+			total += 1.0 / (rank + 1) ** exponent
+			self.cumulative.append(total)
+
+	def draw(self, rng):
+		rank = bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])
+		return min(rank, len(self.cumulative) - 1)
+
+
+def _sentence(rng, words, length):
+	text = ' '.join(WORDS[words.draw(rng)] for i in range(length))
+	return text[0].upper() + text[1:]
+
+
+def _paragraph(rng, words):
+	sentences = []
+	for i in range(rng.randint(2, 6)):
+		sentence = _sentence(rng, words, rng.randint(6, 18)).split(' ')
+		position = rng.randrange(len(sentence))
+		markup = rng.random()
+		if markup < 0.2:
+			sentence[position] = '*%s*' % sentence[position]
+		elif markup < 0.3:
+			sentence[position] = '**%s**' % sentence[position]
+		elif markup < 0.45:
+			sentence[position] = '`%s()`' % sentence[position]
+		elif markup < 0.55:
+			sentence[position] = '[%s](http://example.com/%s/)' % (sentence[position], sentence[position].lower())
+		sentences.append(' '.join(sentence) + '.')
+	return ' '.join(sentences)
+
+
+def markdown_text(rng, words):
+	"""A post body of a few paragraphs, with the occasional heading, list or code block."""
+	blocks = []
+	for i in range(rng.randint(3, 8)):
+		kind = rng.random()
+		if kind < 0.15:
+			blocks.append('## ' + _sentence(rng, words, rng.randint(2, 5)))
+		elif kind < 0.3:
+			blocks.append('\n'.join('* ' + _sentence(rng, words, rng.randint(3, 8))
+									for item in range(rng.randint(2, 5))))
+		elif kind < 0.4:
+			name, argument, result = [WORDS[words.draw(rng)] for word in range(3)]
+			blocks.append('    def %s_%d(%s):\n        return %s(%s)' % (name, i, argument, result, argument))
+		else:
+			blocks.append(_paragraph(rng, words))
+	return '\n\n'.join(blocks)
+
+
+def synthetic_records(count, seed=0, categories=CATEGORIES, tags=TAGS, author=None, site=None):
+	"""``count`` post records (see blogengine.records), newest first."""
+	category_ranks, tag_ranks, words = Zipf(categories), Zipf(tags), Zipf(len(WORDS))
+	for number in range(count):
+		# Seeded per post, so a post doesn't depend on how many come before it
+		rng = random.Random(seed * 2 ** 32 + number)
+		category = category_ranks.draw(rng)
+		yield {
+			'title': _sentence(rng, words, rng.randint(3, 9)),
+			'slug': 'benchmark-%d' % number,
+			'pub_date': (LAST_PUB_DATE - number * POST_INTERVAL).isoformat(),
+			'author': author,
+			'site': site,
+			# A few posts have no category
+			'category': 'category-%d' % category if rng.random() > 0.05 else None,
+			'tags': sorted(set('tag-%d' % tag_ranks.draw(rng) for i in range(rng.randint(0, 5)))),
+			'text': markdown_text(rng, words),
+		}
+
+
+def create_flatpages(site):
+	"""Add the FLATPAGES ``site`` doesn't have yet; returns the number added."""
+	existing = set(FlatPage.objects.filter(sites=site).values_list('url', flat=True))
+	added = 0
+	for url, title in FLATPAGES:
+		if url not in existing:
+			page = FlatPage.objects.create(url=url, title=title, content='<p>%s of this blog.</p>' % title)
+			page.sites.add(site)
+			added += 1
+	return added
+
+
+def sample_paths(site, count, seed=0):
+	"""Up to ``count`` paths to request for each of ROUTES, the same for the same data and seed."""
+	rng = random.Random(seed)
+	posts = Post.objects.published().for_site(site)
+	bounds = posts.aggregate(low=Min('pk'), high=Max('pk'))
+	details = set()
+	if bounds['low'] is not None:
+		for i in range(count * 2):
+			found = list(posts.filter(pk__gte=rng.randint(bounds['low'], bounds['high']))
+						.order_by('pk').values_list('pub_date', 'slug')[:1])
+			details.update(Post(pub_date=pub_date, slug=slug).get_absolute_url() for pub_date, slug in found)
+			if len(details) >= count:
+				break
+
+	def listings(model):
+		slugs = list(model.objects.filter(post_count__gt=0).order_by('pk').values_list('slug', flat=True))
+		return rng.sample(slugs, min(count, len(slugs)))
+	categories, tags = listings(Category), listings(Tag)
+
+	return {
+		'index': ['/'],
+		'detail': sorted(details),
+		'category': ['/category/%s/' % slug for slug in categories],
+		'tag': ['/tag/%s/' % slug for slug in tags],
+		'feed': ['/feeds/posts/'] + ['/category/%s/feed/' % slug for slug in categories[:count - 1]],
+		'flatpage': sorted(FlatPage.objects.filter(sites=site, registration_required=False)
+						.values_list('url', flat=True))[:count],
+	}
+
+
+def wsgi_environ(path, host):
+	path, _, query = path.partition('?')
+	return {
+		'REQUEST_METHOD': 'GET',
+		'SCRIPT_NAME': '',
+		'PATH_INFO': path,
+		'QUERY_STRING': query,
+		'SERVER_NAME': host,
+		'SERVER_PORT': '80',
+		'SERVER_PROTOCOL': 'HTTP/1.1',
+		'HTTP_HOST': host,
+		'wsgi.version': (1, 0),
+		'wsgi.url_scheme': 'http',
+		'wsgi.input': StringIO(),
+		'wsgi.errors': sys.stderr,
+		'wsgi.multithread': True,
+		'wsgi.multiprocess': False,
+		'wsgi.run_once': False,
+	}
+
+
+class WSGITarget(object):
+	"""Requests handled in this process, counting the SQL queries they make."""
+
+	def __init__(self, host):
+		self.host = host
+		self.handler = WSGIHandler()
+
+	def get(self, path):
+		"""(status code, number of queries) of a GET of ``path``."""
+		for connection in connections.all():
+			# The handler resets the queries when the request starts
+			connection.use_debug_cursor = True
+		statuses = []
+		response = self.handler(wsgi_environ(path, self.host),
+								lambda status, headers, exc_info=None: statuses.append(status))
+		try:
+			for chunk in response:
+				pass
+		finally:
+			response.close()
+		return int(statuses[0].split()[0]), sum(len(connection.queries) for connection in connections.all())
+
+
+class HTTPTarget(object):
+	"""Requests to a running server, whose queries can't be counted from here."""
+
+	def __init__(self, base_url, host=None):
+		self.base_url = base_url.rstrip('/')
+		self.headers = {'Host': host} if host else {}
+
+	def get(self, path):
+		try:
+			response = urllib2.urlopen(urllib2.Request(self.base_url + path, headers=self.headers), timeout=60)
+		except urllib2.HTTPError as response:
+			pass
+		response.read()
+		return response.getcode(), None
+
+
+def _free_port():
+	listener = socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	port = listener.getsockname()[1]
+	listener.close()
+	return port
+
+
+@contextmanager
+def gunicorn(workers, timeout=30):
+	"""Run the project under gunicorn with ``workers`` workers, yielding its URL."""
+	port = _free_port()
+	process = subprocess.Popen(['gunicorn', 'tutorial_blog_ng.wsgi:application', '--workers', str(workers),
+								'--bind', '127.0.0.1:%d' % port, '--log-level', 'warning'], cwd=settings.BASE_DIR)
+	try:
+		deadline = time.time() + timeout
+		while True:
+			if process.poll() is not None:
+				raise RuntimeError("gunicorn exited with status %d" % process.returncode)
+			try:
+				socket.create_connection(('127.0.0.1', port), 1).close()
+				break
+			except socket.error:
+				if time.time() > deadline:
+					raise RuntimeError("gunicorn didn't listen on port %d within %ds" % (port, timeout))
+				time.sleep(0.1)
+		yield 'http://127.0.0.1:%d' % port
+	finally:
+		if process.poll() is None:
+			process.terminate()
+			process.wait()
+
+
+def percentile(values, fraction):
+	"""Nearest-rank percentile of the sorted ``values``."""
+	if not values:
+		return None
+	return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+def summarize(samples, elapsed):
+	"""Throughput, latency percentiles and queries per request of [(seconds, status, queries)]."""
+	latencies = sorted(seconds * 1000 for seconds, status, queries in samples)
+	queries = [queries for seconds, status, queries in samples if queries is not None]
+	statuses = collections.Counter(str(status) for seconds, status, queries in samples)
+	return {
+		'requests': len(samples),
+		'seconds': round(elapsed, 3),
+		'requests_per_second': round(len(samples) / max(elapsed, 0.000001), 1),
+		'statuses': dict(statuses),
+		'latency_ms': {
+			'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+			'p50': round(percentile(latencies, 0.5), 3) if latencies else None,
+			'p95': round(percentile(latencies, 0.95), 3) if latencies else None,
+			'p99': round(percentile(latencies, 0.99), 3) if latencies else None,
+			'max': round(latencies[-1], 3) if latencies else None,
+		},
+		'queries_per_request': {
+			'mean': round(float(sum(queries)) / len(queries), 2),
+			'max': max(queries),
+		} if queries else None,
+	}
+
+
+def run_requests(target, paths, concurrency=1, cold=False):
+	"""GET each of ``paths`` from ``concurrency`` threads; returns summarize() of the timings.
+
+	With ``cold`` the cache is cleared before every request.
+	"""
+	pending = collections.deque(paths)
+	samples = []
+
+	def work():
+		while True:
+			try:
+				path = pending.popleft()
+			except IndexError:
+				return
+			if cold:
+				cache.clear()
+			started = time.time()
+			status, queries = target.get(path)
+			samples.append((time.time() - started, status, queries))
+
+	started = time.time()
+	if concurrency == 1:
+		work()
+	else:
+		threads = [threading.Thread(target=work) for i in range(concurrency)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	return summarize(samples, time.time() - started)
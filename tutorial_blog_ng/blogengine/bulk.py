@@ -0,0 +1,195 @@
+"""Changes to many posts at once, as a few statements per chunk of posts.
+
+Used by the PostAdmin actions. The posts are updated with UPDATE, their
+tags with bulk INSERT / DELETE on the through table, so none of the
+per-post signal handlers run; the stored counts, related posts and cache
+dependencies those handlers keep are brought up to date here instead.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.sql.subqueries import DeleteQuery
+from django.utils import timezone
+
+from blogengine.cache import invalidate, site_dependencies
+from blogengine.counts import _change_archive_count
+from blogengine.models import Category, Post, RelatedPost, SearchDocument, SearchPosting, SearchTerm, Tag
+from blogengine.related import recompute_related, refresh_related
+from blogengine.search import chunks
+
+PostTags = Post.tags.through
+
+
+def post_rows(queryset):
+	"""[(id, pub_date, site id, category id, author id)] of the posts in ``queryset``."""
+	return list(queryset.order_by().values_list('pk', 'pub_date', 'site_id', 'category_id', 'author_id'))
+
+
+def post_dependencies(rows, *names):
+	"""Each post's own dependency, and its month plus ``names`` on the post's site."""
+	dependencies = set()
+	for pk, pub_date, site_id, category_id, author_id in rows:
+		dependencies.add('post:%d' % pk)
+		dependencies.update(site_dependencies(site_id, 'posts:%d-%d' % (pub_date.year, pub_date.month), *names))
+	return dependencies
+
+
+def listing_dependencies(rows, tag_ids=(), site_id=None):
+	"""Every listing the posts are in on their site, or on ``site_id``."""
+	dependencies = set()
+	for pk, pub_date, post_site_id, category_id, author_id in rows:
+		names = ['post-list', 'author:%d' % author_id, 'archive:%d-%d' % (pub_date.year, pub_date.month),
+				'posts:%d-%d' % (pub_date.year, pub_date.month)]
+		names.extend('category:%d' % pk for pk in [category_id] if pk)
+		names.extend('tag:%d' % pk for pk in tag_ids)
+		dependencies.update(site_dependencies(site_id or post_site_id, *names))
+	return dependencies
+
+
+def change_counts(model, field, deltas):
+	"""Add ``deltas`` ({pk: delta}) to ``field``, with one UPDATE per distinct delta."""
+	by_delta = defaultdict(list)
+	for pk, delta in deltas.items():
+		if pk and delta:
+			by_delta[delta].append(pk)
+	for delta, pks in by_delta.items():
+		for chunk in chunks(pks):
+			model.objects.filter(pk__in=chunk).update(**{field: F(field) + delta})
+	return bool(by_delta)
+
+
+def _touch(pks, **values):
+	# update() leaves auto_now alone, and the pages show the change
+	values['modified'] = timezone.now()
+	for chunk in chunks(pks):
+		Post.objects.filter(pk__in=chunk).update(**values)
+
+
+def set_category(queryset, category):
+	"""Move the posts to ``category`` (or none); returns the number moved."""
+	category_id = category.pk if category else None
+	rows = [row for row in post_rows(queryset) if row[3] != category_id]
+	if not rows:
+		return 0
+	deltas = defaultdict(int)
+	for row in rows:
+		deltas[row[3]] -= 1
+	deltas[category_id] += len(rows)
+	with transaction.atomic():
+		_touch([row[0] for row in rows], category=category_id)
+		change_counts(Category, 'post_count', deltas)
+	invalidate('post-counts', *post_dependencies(rows, *['category:%d' % pk for pk in deltas if pk]))
+	refresh_related([row[0] for row in rows])
+	return len(rows)
+
+
+def _tagged(rows, tag):
+	tagged = set()
+	for chunk in chunks([row[0] for row in rows]):
+		tagged.update(PostTags.objects.filter(tag=tag, post__in=chunk).values_list('post_id', flat=True))
+	return tagged
+
+
+def add_tag(queryset, tag):
+	"""Tag the posts with ``tag``; returns the number newly tagged."""
+	rows = post_rows(queryset)
+	tagged = _tagged(rows, tag)
+	rows = [row for row in rows if row[0] not in tagged]
+	if not rows:
+		return 0
+	with transaction.atomic():
+		PostTags.objects.bulk_create([PostTags(post_id=row[0], tag_id=tag.pk) for row in rows])
+		_touch([row[0] for row in rows])
+		change_counts(Tag, 'post_count', {tag.pk: len(rows)})
+	invalidate('post-counts', *post_dependencies(rows, 'tag:%d' % tag.pk))
+	refresh_related([row[0] for row in rows])
+	return len(rows)
+
+
+def remove_tag(queryset, tag):
+	"""Take ``tag`` off the posts; returns the number untagged."""
+	rows = post_rows(queryset)
+	tagged = _tagged(rows, tag)
+	rows = [row for row in rows if row[0] in tagged]
+	if not rows:
+		return 0
+	with transaction.atomic():
+		for chunk in chunks([row[0] for row in rows]):
+			PostTags.objects.filter(tag=tag, post__in=chunk).delete()
+		_touch([row[0] for row in rows])
+		change_counts(Tag, 'post_count', {tag.pk: -len(rows)})
+	invalidate('post-counts', *post_dependencies(rows, 'tag:%d' % tag.pk))
+	refresh_related([row[0] for row in rows])
+	return len(rows)
+
+
+def move_to_site(queryset, site):
+	"""Move the posts to ``site``; returns the number moved."""
+	rows = [row for row in post_rows(queryset) if row[2] != site.pk]
+	if not rows:
+		return 0
+	months = defaultdict(int)
+	for pk, pub_date, site_id, category_id, author_id in rows:
+		months[(site_id, pub_date.year, pub_date.month)] -= 1
+		months[(site.pk, pub_date.year, pub_date.month)] += 1
+	tag_ids = set()
+	for chunk in chunks([row[0] for row in rows]):
+		tag_ids.update(PostTags.objects.filter(post__in=chunk).values_list('tag_id', flat=True))
+	with transaction.atomic():
+		_touch([row[0] for row in rows], site=site.pk)
+		for archive_month, delta in months.items():
+			_change_archive_count(archive_month, delta)
+	# The listings of the sites the posts left and of the one they joined
+	invalidate('post-list', *(post_dependencies(rows) | listing_dependencies(rows, tag_ids) |
+		listing_dependencies(rows, tag_ids, site.pk)))
+	refresh_related([row[0] for row in rows])
+	return len(rows)
+
+
+def _grouped_counts(queryset, field):
+	return dict((row[field], -row['posts']) for row in queryset.values(field).annotate(posts=Count('pk')))
+
+
+def delete_posts(queryset):
+	"""Delete the posts and everything hanging off them; returns the number deleted.
+
+	Unlike QuerySet.delete() the posts are never loaded, the related rows
+	are removed with one DELETE per table and chunk.
+	"""
+	rows = post_rows(queryset)
+	if not rows:
+		return 0
+	deleted = set(row[0] for row in rows)
+	category_deltas, tag_deltas, term_deltas = defaultdict(int), defaultdict(int), defaultdict(int)
+	months = defaultdict(int)
+	for pk, pub_date, site_id, category_id, author_id in rows:
+		category_deltas[category_id] -= 1
+		months[(site_id, pub_date.year, pub_date.month)] -= 1
+
+	listers = set()
+	with transaction.atomic():
+		for chunk in chunks(sorted(deleted)):
+			for tag_id, delta in _grouped_counts(PostTags.objects.filter(post__in=chunk), 'tag').items():
+				tag_deltas[tag_id] += delta
+			for term_id, delta in _grouped_counts(SearchPosting.objects.filter(post__in=chunk), 'term').items():
+				term_deltas[term_id] += delta
+			listers.update(RelatedPost.objects.filter(related__in=chunk).values_list('post_id', flat=True))
+
+			PostTags.objects.filter(post__in=chunk).delete()
+			RelatedPost.objects.filter(Q(post__in=chunk) | Q(related__in=chunk)).delete()
+			SearchPosting.objects.filter(post__in=chunk).delete()
+			SearchDocument.objects.filter(post__in=chunk).delete()
+			DeleteQuery(Post).delete_batch(chunk, queryset.db)
+
+		change_counts(Category, 'post_count', category_deltas)
+		change_counts(Tag, 'post_count', tag_deltas)
+		change_counts(SearchTerm, 'doc_count', term_deltas)
+		for archive_month, delta in months.items():
+			_change_archive_count(archive_month, delta)
+
+	invalidate('post-list', 'post-counts', 'search',
+		*(post_dependencies(rows) | listing_dependencies(rows, tag_deltas)))
+	if listers - deleted:
+		recompute_related(listers - deleted)
+	return len(rows)
@@ -0,0 +1,120 @@
+"""Cached documents that are invalidated through the things they depend on.
+
+Every cached entry records the version of each of its dependencies (names
+such as ``'posts'``) at the time it was stored. Invalidating a dependency
+gives it a new version, so every entry built from it stops matching and is
+rebuilt on the next request; entries that don't depend on it are untouched.
+Versions carry the time they were made, so a page can tell when anything
+it depends on last changed (see changed_at).
+"""
+import hashlib
+import math
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import iri_to_uri
+
+from blogengine.timing import count
+
+KEY_PREFIX = 'blogengine'
+CACHE_TIMEOUT = getattr(settings, 'BLOGENGINE_CACHE_TIMEOUT', 60 * 60 * 6)
+INVALIDATED_KEY = '%s:invalidated' % KEY_PREFIX
+
+
+def _version_key(dependency):
+	return '%s:dep:%s' % (KEY_PREFIX, dependency)
+
+
+def _new_version():
+	return '%s-%d' % (uuid.uuid4().hex, math.ceil(time.time()))
+
+
+def get_versions(dependencies):
+	"""Map each dependency to its current version."""
+	keys = dict((_version_key(dependency), dependency) for dependency in dependencies)
+	found = cache.get_many(keys.keys())
+	versions = {}
+	for key, dependency in keys.items():
+		version = found.get(key)
+		if version is None:
+			version = _new_version()
+			# Another process may have got there first
+			if not cache.add(key, version, None):
+				version = cache.get(key, version)
+		versions[dependency] = version
+	return versions
+
+
+def invalidate(*dependencies):
+	"""Expire every cached entry built from any of ``dependencies``."""
+	if dependencies:
+		versions = dict((_version_key(dependency), _new_version()) for dependency in set(dependencies))
+		versions[INVALIDATED_KEY] = time.time()
+		cache.set_many(versions, None)
+
+
+def invalidated_within(seconds):
+	"""Whether anything was invalidated in the last ``seconds``."""
+	invalidated = cache.get(INVALIDATED_KEY)
+	return invalidated is not None and invalidated > time.time() - seconds
+
+
+def changed_at(versions):
+	"""Timestamp of the latest change to the dependencies ``versions`` come from.
+
+	A dependency missing from the cache gets a new version, which then
+	stands for changes made before it was lost.
+	"""
+	stamps = []
+	for version in versions.values():
+		try:
+			stamps.append(int(version.rsplit('-', 1)[1]))
+		except (IndexError, ValueError):
+			# Made before versions were stamped, its time is unknown
+			stamps.append(int(math.ceil(time.time())))
+	return max(stamps) if stamps else None
+
+
+def site_dependencies(site_id, *dependencies):
+	"""``dependencies`` as seen by one site's pages, e.g. ``post-list@2``.
+
+	Changes to a site's posts invalidate these rather than the plain names,
+	so the other sites served from the database keep their cached pages.
+	"""
+	return ['%s@%d' % (dependency, site_id) for dependency in dependencies]
+
+
+def request_key(request, kind='page'):
+	"""Cache key for the response to ``request``, namespaced by its site."""
+	from blogengine.middleware import request_site
+	return '%s:%s:%d:%s' % (KEY_PREFIX, kind, request_site(request).pk,
+							hashlib.md5(iri_to_uri(request.get_full_path())).hexdigest())
+
+
+def get_cached(key):
+	"""The value stored under ``key``, or None if missing or invalidated."""
+	entry = cache.get(key)
+	if entry is None or get_versions(entry['versions'].keys()) != entry['versions']:
+		count('cache-miss')
+		return None
+	count('cache-hit')
+	return entry['value']
+
+
+def set_cached(key, value, versions, timeout=None):
+	"""Store ``value`` until a dependency moves on from ``versions``.
+
+	``versions`` comes from get_versions(), called before rendering so the
+	same versions can go into the ETag.
+	"""
+	cache.set(key, {
+		'value': value,
+		'versions': versions,
+	}, CACHE_TIMEOUT if timeout is None else timeout)
+
+
+def make_etag(key, versions, *extra):
+	"""An ETag that changes whenever any dependency of ``key``, or ``extra``, does."""
+	return hashlib.md5(repr((key, sorted(versions.items())) + extra)).hexdigest()
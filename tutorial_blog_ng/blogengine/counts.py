@@ -0,0 +1,141 @@
+"""Keep Category.post_count, Tag.post_count and ArchiveMonth in step with the posts.
+
+Every change is a relative ``UPDATE ... SET post_count = post_count + n``
+so concurrent writers don't lose counts; ``reconcilecounts`` repairs any
+drift from changes made behind the ORM's back.
+
+The counts include scheduled posts; the sidebar widgets and the sitemap
+take those off with without_scheduled() and published_months(), and expire
+when one goes live.
+"""
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from blogengine.cache import invalidate, site_dependencies
+from blogengine.models import ArchiveMonth, Category, Post, Tag
+from blogengine.publishing import next_publication
+
+
+def _change_counts(model, pks, delta):
+	pks = [pk for pk in pks if pk]
+	if pks and delta:
+		model.objects.filter(pk__in=pks).update(post_count=F('post_count') + delta)
+		invalidate('post-counts')
+
+
+def archive_month_of(post):
+	"""The (site id, year, month) ArchiveMonth row counting ``post``."""
+	if post.pub_date is not None and post.site_id is not None:
+		return (post.site_id, post.pub_date.year, post.pub_date.month)
+
+
+def _change_archive_count(archive_month, delta):
+	if archive_month is None:
+		return
+	site_id, year, month = archive_month
+	rows = ArchiveMonth.objects.filter(site=site_id, year=year, month=month)
+	if not rows.update(post_count=F('post_count') + delta):
+		try:
+			with transaction.atomic():
+				ArchiveMonth.objects.create(site_id=site_id, year=year, month=month,
+											post_count=max(delta, 0))
+		except IntegrityError:
+			# Another writer created the row first
+			rows.update(post_count=F('post_count') + delta)
+	invalidate('archive', *site_dependencies(site_id, 'archive'))
+
+
+def is_scheduled(pub_date):
+	return pub_date is not None and pub_date > timezone.now()
+
+
+def without_scheduled(rows, scheduled):
+	"""``rows`` with the ``scheduled`` posts taken off their post_count, empty ones left out.
+
+	``scheduled`` maps a row's pk to how many posts still to come it counts.
+	"""
+	for row in rows:
+		row.post_count -= scheduled.get(row.pk, 0)
+	return [row for row in rows if row.post_count > 0]
+
+
+def published_months(site):
+	"""The ArchiveMonth rows of ``site``, counting only the posts already out."""
+	months = list(ArchiveMonth.objects.filter(site=site, post_count__gt=0))
+	if next_publication() is not None:
+		pub_dates = Post.objects.for_site(site).filter(pub_date__gt=timezone.now()).values_list(
+			'pub_date', flat=True)
+		scheduled = Counter((pub_date.year, pub_date.month) for pub_date in pub_dates)
+		months = without_scheduled(months, dict((month.pk, scheduled[(month.year, month.month)])
+												for month in months))
+	return months
+
+
+@receiver(post_init, sender=Post)
+def remember_counted_fields(sender, instance, **kwargs):
+	instance._original_category_id = instance.category_id
+	instance._original_archive_month = archive_month_of(instance)
+	instance._original_pub_date = instance.pub_date
+
+
+@receiver(post_save, sender=Post)
+def count_saved_post(sender, instance, created, **kwargs):
+	archive_month = archive_month_of(instance)
+	if created:
+		_change_counts(Category, [instance.category_id], 1)
+		_change_archive_count(archive_month, 1)
+	else:
+		if instance.category_id != instance._original_category_id:
+			_change_counts(Category, [instance.category_id], 1)
+			_change_counts(Category, [instance._original_category_id], -1)
+		if archive_month != instance._original_archive_month:
+			_change_archive_count(archive_month, 1)
+			_change_archive_count(instance._original_archive_month, -1)
+		if is_scheduled(instance.pub_date) != is_scheduled(instance._original_pub_date):
+			# Published early or put off, the counts shown change
+			invalidate('post-counts', *site_dependencies(instance.site_id, 'archive'))
+	instance._original_category_id = instance.category_id
+	instance._original_archive_month = archive_month
+	instance._original_pub_date = instance.pub_date
+
+
+@receiver(pre_delete, sender=Post)
+def count_deleted_post_tags(sender, instance, **kwargs):
+	# Deleting the post removes its tag rows without an m2m_changed
+	if Tag.objects.filter(post=instance).update(post_count=F('post_count') - 1):
+		invalidate('post-counts')
+
+
+@receiver(post_delete, sender=Post)
+def count_deleted_post(sender, instance, **kwargs):
+	_change_counts(Category, [instance.category_id], -1)
+	_change_archive_count(archive_month_of(instance), -1)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def count_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+	related = instance.post_set if reverse else instance.tags
+	if action == 'pre_remove':
+		# pk_set may name rows that aren't there
+		instance._removed_pks = set(related.filter(pk__in=pk_set).values_list('pk', flat=True))
+		return
+	if action == 'pre_clear':
+		instance._removed_pks = set(related.values_list('pk', flat=True))
+		return
+
+	if action == 'post_add':
+		pks, delta = pk_set or (), 1
+	elif action in ('post_remove', 'post_clear'):
+		pks, delta = getattr(instance, '_removed_pks', ()), -1
+	else:
+		return
+	if reverse:
+		# tag.post_set changed
+		_change_counts(Tag, [instance.pk], delta * len(pks))
+	else:
+		_change_counts(Tag, pks, delta)
@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from blogengine.related import PostFeatures, store_related
+
+
+class Command(BaseCommand):
+	help = ("Recompute the related posts of every post. Run it after the "
+			"migration adding them; saves keep them up to date afterwards, but "
+			"a periodic run also picks up the slow drift in tag weights.")
+
+	option_list = BaseCommand.option_list + (
+		make_option('--batch-size', type='int', dest='batch_size', default=500,
+			help='Number of posts whose lists are written per transaction (default: 500).'),
+	)
+
+	def handle(self, *args, **options):
+		started = time.time()
+		data = PostFeatures.for_all_posts()
+		post_ids = sorted(data.categories)
+		changed = 0
+		for start in range(0, len(post_ids), options['batch_size']):
+			batch = post_ids[start:start + options['batch_size']]
+			changed += store_related(dict((pk, data.top(pk)) for pk in batch))
+		self.stdout.write("Computed related posts of %d posts, %d changed, in %.1fs." % (
+			len(post_ids), changed, time.time() - started))
@@ -0,0 +1,68 @@
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test.client import RequestFactory
+
+from blogengine.models import Category, Post, Tag
+from blogengine.pagination import KeysetPaginator, encode_cursor
+from blogengine.views import CategoryListView, PostDetailView, PostListView, PostsFeed, TagListView
+
+EXPLAIN_PREFIXES = {
+	'sqlite': 'EXPLAIN QUERY PLAN ',
+	'postgresql': 'EXPLAIN ',
+	'mysql': 'EXPLAIN ',
+}
+
+
+class Command(BaseCommand):
+	args = '[database]'
+	help = ("Print the EXPLAIN plan of the queries behind each public view, "
+			"using the first category, tag and post in the database as samples.")
+
+	def handle(self, *args, **options):
+		connection = connections[args[0] if args else DEFAULT_DB_ALIAS]
+		prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+		if prefix is None:
+			raise CommandError("Don't know how to EXPLAIN on %s" % connection.vendor)
+
+		for label, queryset in self.get_querysets():
+			sql, params = queryset.query.sql_with_params()
+			cursor = connection.cursor()
+			cursor.execute(prefix + sql, params)
+			self.stdout.write("== %s" % label)
+			self.stdout.write(sql % tuple(repr(param) for param in params))
+			for row in cursor.fetchall():
+				self.stdout.write("    " + " | ".join(unicode(column) for column in row))
+			self.stdout.write("")
+
+	def get_querysets(self):
+		# As a request to the current site, which ALLOWED_HOSTS lets through
+		site = Site.objects.get_current()
+		request = RequestFactory().get('/', HTTP_HOST=site.domain)
+		request.site = site
+		post = Post.objects.published().for_site(site).order_by('-pub_date', '-pk')[:1]
+		post = post[0] if post else None
+		cursor = encode_cursor(post.pub_date, post.pk) if post else None
+
+		views = [('index', PostListView(request=request, kwargs={}))]
+		category = Category.objects.exclude(slug=None)[:1]
+		if category:
+			views.append(('category %s' % category[0].slug,
+						CategoryListView(request=request, kwargs={'slug': category[0].slug})))
+		tag = Tag.objects.exclude(slug=None)[:1]
+		if tag:
+			views.append(('tag %s' % tag[0].slug,
+						TagListView(request=request, kwargs={'slug': tag[0].slug})))
+
+		for name, view in views:
+			paginator = KeysetPaginator(view.get_queryset(), view.paginate_by)
+			yield ('%s: first page' % name, paginator.page_queryset())
+			if cursor:
+				yield ('%s: older page' % name, paginator.page_queryset(after=cursor))
+
+		yield ('tags for a page', Tag.objects.filter(post__in=Post.objects.values('pk')[:5]))
+		feed = PostsFeed()
+		yield ('feed', feed.items(feed.get_object(request)))
+		if post:
+			detail = PostDetailView(request=request, kwargs={'slug': post.slug})
+			yield ('detail', detail.get_queryset().filter(slug=post.slug))
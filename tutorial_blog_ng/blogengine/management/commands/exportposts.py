@@ -0,0 +1,56 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from blogengine.models import Post
+from blogengine.records import jsonl_lines, markdown_tar, post_records
+
+FORMATS = ('jsonl', 'markdown')
+
+
+class Command(BaseCommand):
+	args = '<output file or ->'
+	help = ("Export every post, with its author, site, category and tags, as "
+			"JSON lines or a tar of Markdown files (.tar or .tar.gz) that "
+			"importposts can read back. Posts are read in chunks, so memory use "
+			"doesn't grow with the number of posts.")
+
+	option_list = BaseCommand.option_list + (
+		make_option('--format', dest='format', default=None, choices=FORMATS,
+			help='jsonl or markdown (default: from the file name).'),
+		make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+			help='Number of posts read per query (default: 500).'),
+	)
+
+	def handle(self, *args, **options):
+		if len(args) != 1:
+			raise CommandError("Give the output file, or - for standard output")
+		path = args[0]
+		export_format = options['format']
+		if export_format is None:
+			export_format = 'markdown' if path.endswith(('.tar', '.tar.gz', '.tgz')) else 'jsonl'
+
+		started = time.time()
+		self.exported = 0
+		records = self.count(post_records(Post.objects.all(), options['chunk_size']))
+		if export_format == 'jsonl':
+			chunks = (line.encode('utf-8') for line in jsonl_lines(records))
+		else:
+			chunks = markdown_tar(records, compress=path.endswith(('.gz', '.tgz')))
+
+		output = sys.stdout if path == '-' else open(path, 'wb')
+		try:
+			for chunk in chunks:
+				output.write(chunk)
+		finally:
+			if output is not sys.stdout:
+				output.close()
+		if path != '-':
+			self.stdout.write("Exported %d posts in %.1fs." % (self.exported, time.time() - started))
+
+	def count(self, records):
+		for record in records:
+			self.exported += 1
+			yield record
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from optparse import make_option
+
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.client import Client
+
+from blogengine.models import Category, Post, RelatedPost, Tag
+from blogengine.pagination import encode_cursor
+from blogengine.views import FEED_ITEMS, KeysetListMixin
+
+MANIFEST_NAME = '.manifest.json'
+
+_client = None
+
+
+def _digest(*parts):
+	return hashlib.md5(repr(parts)).hexdigest()
+
+
+def _write_file(path, content):
+	directory = os.path.dirname(path)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	# Write then rename so nginx never serves a half written file
+	tmp_path = '%s.tmp%d' % (path, os.getpid())
+	with open(tmp_path, 'wb') as tmp_file:
+		tmp_file.write(content)
+	os.rename(tmp_path, path)
+
+
+def _init_worker(host):
+	global _client
+	_client = Client(HTTP_HOST=host)
+
+
+def _render_page(job):
+	url, paths = job
+	response = _client.get(url)
+	if response.status_code != 200:
+		return url, response.status_code
+	for path in paths:
+		_write_file(path, response.content)
+	return url, response.status_code
+
+
+class Command(BaseCommand):
+	args = '<output directory>'
+	help = """Render the public site to static files nginx can serve directly.
+
+Only pages whose posts, categories or tags changed since the last export are
+rendered again; a manifest of page fingerprints is kept in the output
+directory. Listing pages past the first are written to after/<cursor>.html
+and before/<cursor>.html next to the listing, and feeds to index.xml, so
+nginx needs something like:
+
+    index index.html index.xml;
+    location / {
+        if ($arg_after) { rewrite ^(.*?)/?$ $1/after/$arg_after.html? last; }
+        if ($arg_before) { rewrite ^(.*?)/?$ $1/before/$arg_before.html? last; }
+        try_files $uri $uri/ =404;
+    }
+"""
+
+	option_list = BaseCommand.option_list + (
+		make_option('--processes', type='int', dest='processes',
+			default=multiprocessing.cpu_count(),
+			help='Number of rendering processes (default: one per CPU).'),
+		make_option('--full', action='store_true', dest='full', default=False,
+			help='Render every page, ignoring the manifest.'),
+	)
+
+	def handle(self, *args, **options):
+		if len(args) != 1:
+			raise CommandError("Give the output directory")
+		self.output = os.path.abspath(args[0])
+		manifest_path = os.path.join(self.output, MANIFEST_NAME)
+
+		manifest = {}
+		if os.path.exists(manifest_path) and not options['full']:
+			with open(manifest_path) as manifest_file:
+				manifest = json.load(manifest_file)
+
+		started = time.time()
+		pages = self.get_pages()
+		jobs = [(url, [os.path.join(self.output, path) for path in paths])
+				for url, (fingerprint, paths) in sorted(pages.items())
+				if manifest.get(url, {}).get('fingerprint') != fingerprint]
+
+		# Remove files no page is written to any more
+		old_files = set(path for page in manifest.values() for path in page['files'])
+		new_files = set(path for fingerprint, paths in pages.values() for path in paths)
+		for path in old_files - new_files:
+			path = os.path.join(self.output, path)
+			if os.path.exists(path):
+				os.remove(path)
+
+		failed = set()
+		for url, status in self.render(jobs, options['processes']):
+			if status != 200:
+				failed.add(url)
+				self.stderr.write("%s returned %d" % (url, status))
+
+		manifest = dict((url, {'fingerprint': fingerprint, 'files': paths})
+						for url, (fingerprint, paths) in pages.items()
+						if url not in failed)
+		_write_file(manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+
+		self.stdout.write("Rendered %d of %d pages in %.1fs, %d failed." % (
+			len(jobs), len(pages), time.time() - started, len(failed)))
+
+	def render(self, jobs, processes):
+		host = Site.objects.get_current().domain
+		if processes <= 1:
+			_init_worker(host)
+			return [_render_page(job) for job in jobs]
+
+		# Children must open their own database connections
+		for connection in connections.all():
+			connection.close()
+		pool = multiprocessing.Pool(processes, _init_worker, (host,))
+		try:
+			return list(pool.imap_unordered(_render_page, jobs, chunksize=16))
+		finally:
+			pool.close()
+			pool.join()
+
+	def get_pages(self):
+		"""Map each URL to (fingerprint, output paths), from a few bulk queries."""
+		categories = dict((pk, (slug, _digest(name, slug))) for pk, name, slug in
+						Category.objects.values_list('pk', 'name', 'slug'))
+		tags = dict((pk, (slug, _digest(name, slug))) for pk, name, slug in
+					Tag.objects.values_list('pk', 'name', 'slug'))
+		site_id = Site.objects.get_current().pk
+		site_posts = Post.objects.published().for_site(site_id)
+		post_tags = defaultdict(list)
+		for post_id, tag_id in Post.tags.through.objects.filter(post__in=site_posts).values_list(
+				'post_id', 'tag_id'):
+			post_tags[post_id].append(tag_id)
+
+		# Newest first, the order of every listing
+		posts = []
+		for pk, slug, pub_date, modified, category_id in site_posts.order_by('-pub_date', '-pk').values_list(
+				'pk', 'slug', 'pub_date', 'modified', 'category_id').iterator():
+			tag_ids = sorted(post_tags[pk])
+			digest = _digest(pk, modified.isoformat(),
+							categories[category_id][1] if category_id else None,
+							[tags[tag_id][1] for tag_id in tag_ids])
+			posts.append({
+				'pk': pk,
+				'url': Post(slug=slug, pub_date=pub_date).get_absolute_url(),
+				'cursor': encode_cursor(pub_date, pk),
+				'category_id': category_id,
+				'tag_ids': tag_ids,
+				'month': (pub_date.year, pub_date.month),
+				'digest': digest,
+			})
+
+		# Post pages also show the titles of their related posts
+		related = defaultdict(list)
+		for post_id, related_id in RelatedPost.objects.filter(post__in=site_posts).values_list(
+				'post_id', 'related_id'):
+			related[post_id].append(related_id)
+		digests = dict((post['pk'], post['digest']) for post in posts)
+
+		pages = {}
+		for post in posts:
+			fingerprint = _digest(post['digest'], [digests.get(pk) for pk in related[post['pk']]])
+			pages[post['url']] = (fingerprint, [post['url'].strip('/') + '/index.html'])
+
+		by_category = defaultdict(list)
+		by_tag = defaultdict(list)
+		by_year = defaultdict(list)
+		by_month = defaultdict(list)
+		for post in posts:
+			by_category[post['category_id']].append(post)
+			for tag_id in post['tag_ids']:
+				by_tag[tag_id].append(post)
+			by_year[post['month'][0]].append(post)
+			by_month[post['month']].append(post)
+		# Every listing page shows the site's post counts and archive widgets
+		self.sidebar = _digest(
+			sorted((pk, categories.get(pk), len(listed)) for pk, listed in by_category.items()),
+			sorted((pk, tags[pk], len(listed)) for pk, listed in by_tag.items()),
+			sorted((month, len(listed)) for month, listed in by_month.items()))
+
+		self.add_listing(pages, '/', '/feeds/posts/', posts)
+		for pk, (slug, digest) in categories.items():
+			if slug:
+				self.add_listing(pages, '/category/%s/' % slug, '/category/%s/feed/' % slug,
+								by_category[pk], digest)
+		for pk, (slug, digest) in tags.items():
+			if slug:
+				self.add_listing(pages, '/tag/%s/' % slug, '/tag/%s/feed/' % slug,
+								by_tag[pk], digest)
+
+		for year, year_posts in by_year.items():
+			self.add_listing(pages, '/%d/' % year, None, year_posts)
+		for (year, month), month_posts in by_month.items():
+			self.add_listing(pages, '/%d/%d/' % (year, month), None, month_posts)
+
+		for url, title, content, template_name in FlatPage.objects.filter(sites=site_id).values_list(
+				'url', 'title', 'content', 'template_name'):
+			pages[url] = (_digest(title, content, template_name), [url.strip('/') + '/index.html'])
+		return pages
+
+	def add_listing(self, pages, url, feed_url, posts, digest=None):
+		"""Add the paginated listing of ``posts`` at ``url`` and its feed, if any."""
+		per_page = KeysetListMixin.paginate_by
+		chunks = [posts[i:i + per_page] for i in range(0, len(posts), per_page)] or [[]]
+		directory = url.strip('/')
+
+		for number, chunk in enumerate(chunks):
+			if number == 0:
+				page_url, paths = url, [os.path.join(directory, 'index.html')]
+			else:
+				cursor = chunks[number - 1][-1]['cursor']
+				page_url = '%s?after=%s' % (url, cursor)
+				paths = [os.path.join(directory, 'after', cursor + '.html')]
+			if number + 1 < len(chunks):
+				# The same page is what the next page's newer link shows
+				cursor = chunks[number + 1][0]['cursor']
+				paths.append(os.path.join(directory, 'before', cursor + '.html'))
+			pages[page_url] = (_digest(digest, self.sidebar, paths, [post['digest'] for post in chunk]), paths)
+
+		if feed_url:
+			feed_fingerprint = _digest(digest, [post['digest'] for post in posts[:FEED_ITEMS]])
+			pages[feed_url] = (feed_fingerprint, [os.path.join(feed_url.strip('/'), 'index.xml')])
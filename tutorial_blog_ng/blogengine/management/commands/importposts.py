@@ -0,0 +1,203 @@
+import itertools
+import json
+import os
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.text import slugify
+
+from blogengine.cache import invalidate, site_dependencies
+from blogengine.markup import render_markdown
+from blogengine.models import Category, Post, Tag
+from blogengine.records import parse_pub_date, read_records
+from blogengine.search import chunks
+
+SLUG_LENGTH = Post._meta.get_field('slug').max_length
+
+
+def _slug(name):
+	return slugify(unicode(name))[:SLUG_LENGTH]
+
+
+class Command(BaseCommand):
+	args = '<file.jsonl or directory> [...]'
+	help = """Import posts from JSON lines files and directories of Markdown files.
+
+See blogengine.records for the format. Categories and tags are matched by
+slug and created as needed, posts go to the current site unless their site
+exists, posts whose slug already exists are skipped,
+so an interrupted import can simply be run again; with --checkpoint the
+records already done are not even read again. Posts are inserted in bulk
+without their save() signals, so the counts, search index and related
+posts are rebuilt once at the end; the checkpoint is kept until then, so
+a run resumed after the last record still rebuilds.
+"""
+
+	option_list = BaseCommand.option_list + (
+		make_option('--batch-size', type='int', dest='batch_size', default=1000,
+			help='Number of records imported per transaction (default: 1000).'),
+		make_option('--author', dest='author', default=None,
+			help='Username to use for records without an author.'),
+		make_option('--checkpoint', dest='checkpoint', default=None,
+			help='File recording progress, to resume an interrupted import from.'),
+		make_option('--no-rebuild', action='store_false', dest='rebuild', default=True,
+			help="Don't rebuild counts, search index and related posts afterwards."),
+	)
+
+	def handle(self, *paths, **options):
+		if not paths:
+			raise CommandError("Give at least one .jsonl file or directory of Markdown files")
+		self.default_author = options['author']
+		self.site = Site.objects.get_current()
+		self.site_ids = dict(Site.objects.values_list('domain', 'pk'))
+		self.category_ids = {}
+		self.tag_ids = {}
+		self.author_ids = {}
+		self.dependencies = set(['post-list', 'post-counts', 'archive'])
+
+		checkpoint = options['checkpoint']
+		done, rebuild_pending = self.read_checkpoint(checkpoint, paths)
+		records = itertools.islice(self.get_records(paths), done, None)
+		started = time.time()
+		imported = skipped = failed = rows = 0
+
+		while True:
+			batch = list(itertools.islice(records, options['batch_size']))
+			if not batch:
+				break
+			with transaction.atomic():
+				result = self.import_batch(batch, done)
+			imported += result[0]
+			skipped += result[1]
+			failed += result[2]
+			rows += result[3]
+			done += len(batch)
+			rebuild_pending = rebuild_pending or bool(imported)
+			if checkpoint:
+				self.write_checkpoint(checkpoint, paths, done, rebuild_pending)
+			self.stdout.write("%d records read, %d posts imported, %.0f rows/s" % (
+				done, imported, rows / max(time.time() - started, 0.001)))
+
+		invalidate(*self.dependencies)
+		if rebuild_pending and options['rebuild']:
+			self.rebuild()
+		if checkpoint and os.path.exists(checkpoint):
+			os.remove(checkpoint)
+
+		elapsed = time.time() - started
+		self.stdout.write("Imported %d posts, skipped %d existing and %d invalid records; "
+			"%d rows in %.1fs (%.0f rows/s)." % (imported, skipped, failed, rows, elapsed,
+			rows / max(elapsed, 0.001)))
+
+	def get_records(self, paths):
+		return read_records(paths)
+
+	def rebuild(self):
+		for command in ('reconcilecounts', 'rebuildsearch', 'computerelated'):
+			call_command(command, stdout=self.stdout)
+
+	def read_checkpoint(self, checkpoint, paths):
+		"""(records done, whether posts were imported without the rebuild after them)."""
+		if checkpoint and os.path.exists(checkpoint):
+			with open(checkpoint) as checkpoint_file:
+				state = json.load(checkpoint_file)
+			if state['paths'] != list(paths):
+				raise CommandError("%s is for an import of %s" % (checkpoint, ', '.join(state['paths'])))
+			# Checkpoints from before the flag only say how far the import got
+			return state['records'], state.get('rebuild', state['records'] > 0)
+		return 0, False
+
+	def write_checkpoint(self, checkpoint, paths, done, rebuild_pending):
+		tmp_path = checkpoint + '.tmp'
+		with open(tmp_path, 'w') as checkpoint_file:
+			json.dump({'paths': list(paths), 'records': done, 'rebuild': rebuild_pending}, checkpoint_file)
+		os.rename(tmp_path, checkpoint)
+
+	def import_batch(self, batch, offset):
+		"""Insert the new posts of ``batch``; returns (imported, skipped, failed, rows)."""
+		parsed = []
+		slugs = set()
+		failed = 0
+		for number, record in enumerate(batch, offset + 1):
+			try:
+				slug = (record.get('slug') or _slug(record['title']))[:SLUG_LENGTH]
+				author = record.get('author') or self.default_author
+				if not slug or not author:
+					raise ValueError("no slug or author")
+				parsed.append((record, slug, parse_pub_date(record['pub_date']), author))
+				slugs.add(slug)
+			except (KeyError, ValueError) as e:
+				self.stderr.write("Skipping record %d: %s" % (number, e))
+				failed += 1
+
+		existing = set()
+		for chunk in chunks(slugs):
+			existing.update(Post.objects.filter(slug__in=chunk).values_list('slug', flat=True))
+		rows = self.create_missing(User, 'username', self.author_ids,
+			[author for record, slug, pub_date, author in parsed], create=False)
+		rows += self.create_missing(Category, 'slug', self.category_ids,
+			[record.get('category') for record, slug, pub_date, author in parsed])
+		rows += self.create_missing(Tag, 'slug', self.tag_ids,
+			[name for record, slug, pub_date, author in parsed for name in record.get('tags') or ()])
+
+		posts = []
+		post_tags = {}
+		skipped = 0
+		for record, slug, pub_date, author in parsed:
+			if slug in existing:
+				skipped += 1
+				continue
+			if author not in self.author_ids:
+				self.stderr.write("Skipping %s: no user %s" % (slug, author))
+				failed += 1
+				continue
+			existing.add(slug)
+			category_id = self.category_ids.get(_slug(record['category'])) if record.get('category') else None
+			site_id = self.site_ids.get(record.get('site'), self.site.pk)
+			post = Post(title=record['title'], slug=slug, pub_date=pub_date, text=record.get('text', ''),
+						author_id=self.author_ids[author], site_id=site_id, category_id=category_id)
+			post.text_html = render_markdown(post.text, use_cache=False)
+			posts.append(post)
+			post_tags[slug] = set(self.tag_ids[_slug(name)] for name in record.get('tags') or ()
+								if _slug(name) in self.tag_ids)
+
+			names = ['post-list', 'archive', 'author:%d' % post.author_id,
+					'archive:%d-%d' % (pub_date.year, pub_date.month), 'posts:%d-%d' % (pub_date.year, pub_date.month)]
+			if category_id:
+				names.append('category:%d' % category_id)
+			names.extend('tag:%d' % pk for pk in post_tags[slug])
+			self.dependencies.update(site_dependencies(site_id, *names))
+
+		Post.objects.bulk_create(posts)
+		# bulk_create doesn't give the ids back on every database
+		post_ids = {}
+		for chunk in chunks(post_tags):
+			post_ids.update(Post.objects.filter(slug__in=chunk).values_list('slug', 'pk'))
+		links = [Post.tags.through(post_id=post_ids[slug], tag_id=tag_id)
+				for slug, tag_ids in post_tags.items() for tag_id in tag_ids]
+		Post.tags.through.objects.bulk_create(links)
+
+		return len(posts), skipped, failed, rows + len(posts) + len(links)
+
+	def create_missing(self, model, field, ids, names, create=True):
+		"""Fill ``ids`` (key -> pk) for ``names``, bulk creating missing rows; returns rows created."""
+		wanted = {}
+		for name in names:
+			if name:
+				key = _slug(name) if field == 'slug' else name
+				if key and key not in ids:
+					wanted.setdefault(key, name)
+		for chunk in chunks(wanted):
+			ids.update(model.objects.filter(**{field + '__in': chunk}).values_list(field, 'pk'))
+		missing = [key for key in wanted if key not in ids]
+		if not missing or not create:
+			return 0
+		model.objects.bulk_create([model(name=wanted[key], slug=key, description='') for key in missing])
+		for chunk in chunks(missing):
+			ids.update(model.objects.filter(slug__in=chunk).values_list('slug', 'pk'))
+		return len(missing)
@@ -0,0 +1,76 @@
+import time
+from collections import defaultdict
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blogengine.cache import invalidate
+from blogengine.models import Post, SearchDocument, SearchPosting, SearchTerm
+from blogengine.search import chunks, document_terms, get_term_ids
+
+
+class Command(BaseCommand):
+	help = ("Rebuild the search index from scratch. Run it after the migration "
+			"adding the index and whenever the tokenizer changes; searches "
+			"made while it runs only see the posts indexed so far.")
+
+	option_list = BaseCommand.option_list + (
+		make_option('--batch-size', type='int', dest='batch_size', default=500,
+			help='Number of posts indexed per transaction (default: 500).'),
+	)
+
+	def handle(self, *args, **options):
+		batch_size = options['batch_size']
+		started = time.time()
+
+		with transaction.atomic():
+			SearchPosting.objects.all().delete()
+			SearchDocument.objects.all().delete()
+			SearchTerm.objects.update(doc_count=0)
+		term_ids = dict(SearchTerm.objects.values_list('term', 'pk'))
+		doc_counts = defaultdict(int)
+
+		last_pk = 0
+		indexed = 0
+		while True:
+			batch = list(Post.objects.filter(pk__gt=last_pk)
+						.order_by('pk')
+						.values_list('pk', 'title', 'text')[:batch_size])
+			if not batch:
+				break
+
+			with transaction.atomic():
+				documents = [(pk, document_terms(title, text)) for pk, title, text in batch]
+				missing = set(term for pk, terms in documents for term in terms
+							if term not in term_ids)
+				if missing:
+					term_ids.update(get_term_ids(missing))
+
+				postings = []
+				for pk, terms in documents:
+					for term, positions in terms.items():
+						postings.append(SearchPosting(
+							term_id=term_ids[term], post_id=pk, frequency=len(positions),
+							positions=' '.join(map(str, positions))))
+						doc_counts[term_ids[term]] += 1
+				SearchPosting.objects.bulk_create(postings)
+				SearchDocument.objects.bulk_create([
+					SearchDocument(post_id=pk, length=sum(len(positions) for positions in terms.values()))
+					for pk, terms in documents])
+			indexed += len(batch)
+			last_pk = batch[-1][0]
+
+		# One UPDATE per distinct count rather than one per term
+		by_count = defaultdict(list)
+		for term_id, count in doc_counts.items():
+			by_count[count].append(term_id)
+		with transaction.atomic():
+			for count, ids in by_count.items():
+				for chunk in chunks(ids):
+					SearchTerm.objects.filter(pk__in=chunk).update(doc_count=count)
+			SearchTerm.objects.filter(doc_count=0).delete()
+		invalidate('search')
+
+		self.stdout.write("Indexed %d posts, %d terms in %.1fs." % (
+			indexed, len(doc_counts), time.time() - started))
@@ -0,0 +1,62 @@
+from collections import defaultdict
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from blogengine.cache import invalidate, site_dependencies
+from blogengine.models import ArchiveMonth, Category, Post, Tag
+from blogengine.search import chunks
+
+
+class Command(BaseCommand):
+	help = ("Recount the posts of every category, tag and archive month and fix "
+			"the stored counts that drifted. Run it after the migrations adding "
+			"the counts.")
+
+	def handle(self, *args, **options):
+		fixed = {}
+		with transaction.atomic():
+			for model in (Category, Tag):
+				fixed[model] = self.reconcile(model)
+			fixed[ArchiveMonth] = self.reconcile_archive()
+		if fixed[Category] or fixed[Tag]:
+			invalidate('post-counts')
+		if fixed[ArchiveMonth]:
+			invalidate('archive', *[dependency for site_id in Site.objects.values_list('pk', flat=True)
+									for dependency in site_dependencies(site_id, 'archive')])
+		self.stdout.write("Fixed %d categories, %d tags and %d archive months." % (
+			fixed[Category], fixed[Tag], fixed[ArchiveMonth]))
+
+	def reconcile(self, model):
+		"""Fix the post_count of ``model`` rows, with one UPDATE per distinct count."""
+		by_count = defaultdict(list)
+		for pk, stored, actual in (model.objects.annotate(actual=Count('post'))
+									.values_list('pk', 'post_count', 'actual')):
+			if stored != actual:
+				by_count[actual].append(pk)
+		for count, pks in by_count.items():
+			for chunk in chunks(pks):
+				model.objects.filter(pk__in=chunk).update(post_count=count)
+		return sum(len(pks) for pks in by_count.values())
+
+	def reconcile_archive(self):
+		"""Recount ArchiveMonth from one pass over the post dates."""
+		actual = defaultdict(int)
+		for site_id, pub_date in Post.objects.values_list('site_id', 'pub_date').iterator():
+			actual[(site_id, pub_date.year, pub_date.month)] += 1
+
+		fixed = 0
+		stored = set()
+		for pk, site_id, year, month, count in ArchiveMonth.objects.values_list(
+				'pk', 'site_id', 'year', 'month', 'post_count'):
+			stored.add((site_id, year, month))
+			if actual.get((site_id, year, month), 0) != count:
+				ArchiveMonth.objects.filter(pk=pk).update(post_count=actual.get((site_id, year, month), 0))
+				fixed += 1
+		missing = [ArchiveMonth(site_id=site_id, year=year, month=month, post_count=count)
+					for (site_id, year, month), count in actual.items()
+					if (site_id, year, month) not in stored]
+		ArchiveMonth.objects.bulk_create(missing)
+		return fixed + len(missing)
@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from blogengine.cache import invalidate
+from blogengine.markup import render_markdown
+from blogengine.models import Post
+
+
+class Command(BaseCommand):
+	help = ("Re-render the stored HTML of every post. Run it whenever the "
+			"Markdown extension set changes.")
+
+	option_list = BaseCommand.option_list + (
+		make_option('--batch-size', type='int', dest='batch_size', default=500,
+			help='Number of posts rendered per transaction (default: 500).'),
+	)
+
+	def handle(self, *args, **options):
+		batch_size = options['batch_size']
+		last_pk = 0
+		rendered = updated = 0
+
+		while True:
+			batch = list(Post.objects.filter(pk__gt=last_pk)
+						.order_by('pk')
+						.values_list('pk', 'text', 'text_html')[:batch_size])
+			if not batch:
+				break
+
+			changed = []
+			with transaction.atomic():
+				for pk, text, text_html in batch:
+					html = render_markdown(text, use_cache=False)
+					if html != text_html:
+						# update() skips save() and its signals on purpose, and with
+						# them modified and the invalidation of the post's pages
+						Post.objects.filter(pk=pk).update(text_html=html, modified=timezone.now())
+						changed.append(pk)
+			invalidate(*['post:%d' % pk for pk in changed])
+			updated += len(changed)
+			rendered += len(batch)
+			last_pk = batch[-1][0]
+
+		self.stdout.write("Rendered %d posts, %d changed." % (rendered, updated))
@@ -0,0 +1,122 @@
+import json
+import subprocess
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+from blogengine.benchmark import ROUTES, HTTPTarget, WSGITarget, gunicorn, run_requests, sample_paths
+from blogengine.models import Category, Post, Tag
+
+
+class Command(BaseCommand):
+	help = """Request the public pages of the current site and report their performance as JSON.
+
+Seed the data with seedbenchmark first. For each route (%s) up to
+--paths pages are sampled and requested --requests times in all, after
+one untimed request of each unless --no-warmup. Requests go through the
+WSGI handler in this process, which also counts their SQL queries, or to
+--url, or to gunicorn started with --gunicorn workers. Save the output of
+two runs to compare a change.
+""" % ', '.join(ROUTES)
+
+	option_list = BaseCommand.option_list + (
+		make_option('--routes', dest='routes', default=','.join(ROUTES),
+			help='Comma separated routes to request (default: all).'),
+		make_option('--requests', type='int', dest='requests', default=200,
+			help='Number of requests per route (default: 200).'),
+		make_option('--concurrency', type='int', dest='concurrency', default=1,
+			help='Number of requests made at once (default: 1).'),
+		make_option('--paths', type='int', dest='paths', default=20,
+			help='Number of different pages requested per route (default: 20).'),
+		make_option('--seed', type='int', dest='seed', default=0,
+			help='Seed of the sampled pages (default: 0).'),
+		make_option('--cold', action='store_true', dest='cold', default=False,
+			help='Clear the cache before every request (in process only).'),
+		make_option('--no-warmup', action='store_false', dest='warmup', default=True,
+			help="Don't request each page once before timing."),
+		make_option('--url', dest='url', default=None,
+			help='Request a server running at this URL instead.'),
+		make_option('--gunicorn', type='int', dest='gunicorn', default=None,
+			help='Start gunicorn with this many workers and request it.'),
+		make_option('--output', dest='output', default=None,
+			help='File to write the results to (default: standard output).'),
+	)
+
+	def handle(self, *args, **options):
+		routes = [route.strip() for route in options['routes'].split(',') if route.strip()]
+		unknown = set(routes) - set(ROUTES)
+		if unknown:
+			raise CommandError("Unknown routes %s, choose from %s" % (', '.join(sorted(unknown)), ', '.join(ROUTES)))
+		if options['concurrency'] < 1 or options['requests'] < 1:
+			raise CommandError("--concurrency and --requests must be at least 1")
+		if options['cold'] and (options['url'] or options['gunicorn']):
+			raise CommandError("--cold only works in process")
+
+		site = Site.objects.get_current()
+		paths = sample_paths(site, options['paths'], options['seed'])
+		if options['gunicorn']:
+			try:
+				with gunicorn(options['gunicorn']) as url:
+					results = self.run(HTTPTarget(url, site.domain), routes, paths, options)
+			except RuntimeError as e:
+				raise CommandError(str(e))
+			target = 'gunicorn, %d workers' % options['gunicorn']
+		elif options['url']:
+			results = self.run(HTTPTarget(options['url'], site.domain), routes, paths, options)
+			target = options['url']
+		else:
+			results = self.run(WSGITarget(site.domain), routes, paths, options)
+			target = 'in process'
+
+		report = {
+			'started': timezone.now().isoformat(),
+			'revision': self.revision(),
+			'target': target,
+			'database': connections[DEFAULT_DB_ALIAS].vendor,
+			'cache': settings.CACHES['default']['BACKEND'],
+			'dataset': {
+				'posts': Post.objects.for_site(site).count(),
+				'categories': Category.objects.count(),
+				'tags': Tag.objects.count(),
+				'flatpages': FlatPage.objects.filter(sites=site).count(),
+			},
+			'options': dict((name, options[name]) for name in
+							('requests', 'concurrency', 'paths', 'seed', 'cold', 'warmup')),
+			'paths': dict((route, paths[route]) for route in routes),
+			'routes': results,
+		}
+		output = json.dumps(report, indent=2, sort_keys=True)
+		if options['output']:
+			with open(options['output'], 'w') as output_file:
+				output_file.write(output + '\n')
+		else:
+			self.stdout.write(output)
+
+	def run(self, target, routes, paths, options):
+		results = {}
+		for route in routes:
+			if not paths[route]:
+				self.stderr.write("Skipping %s: nothing to request, run seedbenchmark first" % route)
+				continue
+			if options['warmup']:
+				for path in paths[route]:
+					target.get(path)
+			requests = [paths[route][i % len(paths[route])] for i in range(options['requests'])]
+			results[route] = run_requests(target, requests, options['concurrency'], options['cold'])
+			self.stderr.write("%s: %.1f requests/s, p50 %.1fms, p99 %.1fms" % (route,
+				results[route]['requests_per_second'], results[route]['latency_ms']['p50'],
+				results[route]['latency_ms']['p99']))
+		return results
+
+	def revision(self):
+		"""The checked out git commit, if any, to tell runs apart."""
+		try:
+			return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+											stderr=subprocess.STDOUT).strip()
+		except (OSError, subprocess.CalledProcessError):
+			return None
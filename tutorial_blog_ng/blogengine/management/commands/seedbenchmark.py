@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from blogengine.benchmark import CATEGORIES, DATASETS, TAGS, create_flatpages, synthetic_records
+from blogengine.management.commands import importposts
+
+AUTHOR = 'benchmark'
+
+
+class Command(importposts.Command):
+	args = '[%s|<number of posts>]' % '|'.join(sorted(DATASETS, key=DATASETS.get))
+	help = """Fill the database with a synthetic dataset for runbenchmark (default: 1k).
+
+Posts are made by blogengine.benchmark.synthetic_records() and imported
+like importposts does, on the current site by a '%s' user; the pages in
+blogengine.benchmark.FLATPAGES are added too. The same size and seed
+always give the same posts, and posts already there are skipped, so a
+bigger dataset can be seeded over a smaller one.
+""" % AUTHOR
+
+	option_list = BaseCommand.option_list + (
+		make_option('--seed', type='int', dest='seed', default=0,
+			help='Seed of the generated posts (default: 0).'),
+		make_option('--categories', type='int', dest='categories', default=CATEGORIES,
+			help='Number of categories (default: %d).' % CATEGORIES),
+		make_option('--tags', type='int', dest='tags', default=TAGS,
+			help='Number of tags (default: %d).' % TAGS),
+		make_option('--batch-size', type='int', dest='batch_size', default=1000,
+			help='Number of posts imported per transaction (default: 1000).'),
+		make_option('--checkpoint', dest='checkpoint', default=None,
+			help='File recording progress, to resume an interrupted seeding from.'),
+		make_option('--no-rebuild', action='store_false', dest='rebuild', default=True,
+			help="Don't rebuild counts, search index and related posts afterwards."),
+	)
+
+	def handle(self, size='1k', **options):
+		count = DATASETS.get(size.lower())
+		if count is None:
+			try:
+				count = int(size)
+			except ValueError:
+				raise CommandError("Give one of %s or a number of posts" % ', '.join(sorted(DATASETS)))
+		if not User.objects.filter(username=AUTHOR).exists():
+			User.objects.create_user(AUTHOR)
+		self.options = dict(options, count=count)
+		options['author'] = AUTHOR
+		# Names the dataset in the checkpoint
+		super(Command, self).handle('benchmark:%d:%d' % (count, options['seed']), **options)
+		self.stdout.write("Added %d flatpages." % create_flatpages(self.site))
+
+	def get_records(self, paths):
+		return synthetic_records(self.options['count'], self.options['seed'], self.options['categories'],
+								self.options['tags'], AUTHOR, self.site.domain)
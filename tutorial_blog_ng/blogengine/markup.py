@@ -0,0 +1,147 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import markdown
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.encoding import force_unicode
+
+MARKDOWN_EXTENSIONS = getattr(settings, 'BLOGENGINE_MARKDOWN_EXTENSIONS', ["nl2br", ])
+MARKDOWN_OPTIONS = {
+	'safe_mode': True,
+	'enable_attributes': False,
+}
+
+# In-process cache ceiling, per worker, in (approximate) bytes of HTML
+MARKDOWN_CACHE_MAX_BYTES = getattr(settings, 'BLOGENGINE_MARKDOWN_CACHE_MAX_BYTES', 4 * 1024 * 1024)
+# Optional CACHES alias used as a second, shared tier
+MARKDOWN_CACHE_BACKEND = getattr(settings, 'BLOGENGINE_MARKDOWN_CACHE_BACKEND', None)
+MARKDOWN_CACHE_TIMEOUT = getattr(settings, 'BLOGENGINE_MARKDOWN_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Anything that changes the output must change the cache keys
+CONFIG_FINGERPRINT = hashlib.sha1(repr((
+	markdown.version,
+	list(MARKDOWN_EXTENSIONS),
+	sorted(MARKDOWN_OPTIONS.items()),
+))).hexdigest()
+
+
+class RenderCache(object):
+	"""Size-bounded LRU of rendered HTML, keyed by content hash."""
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.entries = OrderedDict()
+			self.size = 0
+			self.hits = self.misses = self.evictions = 0
+			self.shared_hits = 0
+
+	def get(self, key):
+		with self.lock:
+			try:
+				value = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self.entries[key] = value
+			self.hits += 1
+			return value
+
+	def set(self, key, value):
+		cost = self._cost(key, value)
+		if cost > self.max_bytes:
+			return
+		with self.lock:
+			if key in self.entries:
+				self.size -= self._cost(key, self.entries.pop(key))
+			self.entries[key] = value
+			self.size += cost
+			while self.size > self.max_bytes:
+				old_key, old_value = self.entries.popitem(last=False)
+				self.size -= self._cost(old_key, old_value)
+				self.evictions += 1
+
+	def stats(self):
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'bytes': self.size,
+				'max_bytes': self.max_bytes,
+				'hits': self.hits,
+				'shared_hits': self.shared_hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+			}
+
+	def _cost(self, key, value):
+		# unicode is stored as UCS-2/UCS-4, this only has to be proportional
+		return len(key) + len(value) * 2
+
+
+render_cache = RenderCache(MARKDOWN_CACHE_MAX_BYTES)
+
+_local = threading.local()
+
+
+def _get_parser():
+	# Markdown instances are not thread safe, so keep one per thread
+	parser = getattr(_local, 'parser', None)
+	if parser is None:
+		parser = _local.parser = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS,
+													**MARKDOWN_OPTIONS)
+	return parser
+
+
+def _get_shared_cache():
+	if not MARKDOWN_CACHE_BACKEND:
+		return None
+	return get_cache(MARKDOWN_CACHE_BACKEND)
+
+
+def cache_key(text):
+	digest = hashlib.sha1(CONFIG_FINGERPRINT)
+	digest.update(text.encode('utf-8'))
+	return 'blogengine:md:%s' % digest.hexdigest()
+
+
+def _render(text):
+	return _get_parser().reset().convert(text)
+
+
+def render_markdown(value, use_cache=True):
+	"""Render Markdown source to the HTML shown on the site.
+
+	Results are kept in a per-process LRU (and the shared cache tier when
+	BLOGENGINE_MARKDOWN_CACHE_BACKEND is set). Pass use_cache=False for
+	one-off renders such as saving a post.
+	"""
+	text = force_unicode(value)
+	if not use_cache:
+		return _render(text)
+
+	key = cache_key(text)
+	html = render_cache.get(key)
+	if html is not None:
+		return html
+
+	shared = _get_shared_cache()
+	if shared is not None:
+		html = shared.get(key)
+		if html is not None:
+			with render_cache.lock:
+				render_cache.shared_hits += 1
+			render_cache.set(key, html)
+			return html
+
+	html = _render(text)
+	render_cache.set(key, html)
+	if shared is not None:
+		shared.set(key, html, MARKDOWN_CACHE_TIMEOUT)
+	return html
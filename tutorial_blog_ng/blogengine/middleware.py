@@ -0,0 +1,99 @@
+"""Per-request work: the Site picked by the Host header, the database to read from, and timings."""
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import DatabaseError
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from blogengine import routers, timing
+
+SERVER_TIMING = getattr(settings, 'BLOGENGINE_SERVER_TIMING', True)
+# Set for REPLICA_LAG seconds after a client writes, to keep its reads on the primary
+PIN_COOKIE = 'blogengine_primary'
+
+# domain -> Site, loaded once per process and dropped when a Site changes
+_sites_by_host = {}
+
+
+def _sites():
+	if not _sites_by_host:
+		_sites_by_host.update((site.domain.lower(), site) for site in Site.objects.all())
+	return _sites_by_host
+
+
+def single_site():
+	"""Whether there is just one Site, so counts over every post are its counts."""
+	return len(_sites()) <= 1
+
+
+def site_for_host(host):
+	"""The Site whose domain is ``host`` (with or without its port), else the SITE_ID one."""
+	_sites()
+	host = host.lower()
+	site = _sites_by_host.get(host) or _sites_by_host.get(host.rsplit(':', 1)[0])
+	return site or Site.objects.get_current()
+
+
+def request_site(request):
+	"""The site ``request`` is for, as set by CurrentSiteMiddleware."""
+	site = getattr(request, 'site', None)
+	if site is None:
+		site = request.site = site_for_host(request.get_host())
+	return site
+
+
+@receiver([post_save, post_delete], sender=Site)
+def forget_sites(sender, **kwargs):
+	_sites_by_host.clear()
+
+
+class CurrentSiteMiddleware(object):
+	def process_request(self, request):
+		request.site = site_for_host(request.get_host())
+
+
+class ReplicaMiddleware(object):
+	"""Let replica_reads() views read from a replica, see blogengine.routers."""
+
+	def process_request(self, request):
+		routers.start_request()
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		if (getattr(view_func, 'replica_reads', False) and request.method in ('GET', 'HEAD') and
+				PIN_COOKIE not in request.COOKIES):
+			routers.use_replicas()
+
+	def process_exception(self, request, exception):
+		alias = routers.request_alias()
+		if isinstance(exception, DatabaseError) and alias in routers.REPLICAS:
+			routers.mark_down(alias)
+
+	def process_response(self, request, response):
+		if routers.request_wrote():
+			response.set_cookie(PIN_COOKIE, '1', max_age=routers.REPLICA_LAG, httponly=True)
+		routers.start_request()
+		return response
+
+
+class TimingMiddleware(object):
+	"""Time each request, see blogengine.timing.
+
+	The timings go in a Server-Timing header unless BLOGENGINE_SERVER_TIMING
+	is False, and into the statistics of the request's URL pattern name.
+	"""
+
+	def __init__(self):
+		timing.instrument_templates()
+
+	def process_request(self, request):
+		timing.start()
+
+	def process_response(self, request, response):
+		timings = timing.stop()
+		if timings is None:
+			return response
+		match = getattr(request, 'resolver_match', None)
+		timing.record(match.view_name if match else 'unmatched', response.status_code, timings)
+		if SERVER_TIMING:
+			response['Server-Timing'] = timing.server_timing(timings)
+		return response
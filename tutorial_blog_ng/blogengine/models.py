@@ -1,18 +1,25 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.utils import timezone
 from django.utils.text import slugify
 
+from blogengine.markup import render_markdown
+
 
 class Category(models.Model):
 	name = models.CharField(max_length=200)
 	description = models.TextField()
 	slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+	# Kept up to date by blogengine.counts
+	post_count = models.PositiveIntegerField(default=0, editable=False)
 
 	def save(self):
 		if not self.slug:
 			self.slug = slugify(unicode(self.name))
-		super(Category, self).save()
+		# Never write back a post_count read before posts changed
+		update_fields = None if self.pk is None else ['name', 'description', 'slug']
+		super(Category, self).save(update_fields=update_fields)
 
 	def __unicode__(self):
 		return self.name
@@ -27,11 +34,15 @@ class Tag(models.Model):
 	name = models.CharField(max_length=200)
 	description = models.TextField()
 	slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+	# Kept up to date by blogengine.counts
+	post_count = models.PositiveIntegerField(default=0, editable=False)
 
 	def save(self):
 		if not self.slug:
 			self.slug = slugify(unicode(self.name))
-		super(Tag, self).save()
+		# Never write back a post_count read before posts changed
+		update_fields = None if self.pk is None else ['name', 'description', 'slug']
+		super(Tag, self).save(update_fields=update_fields)
 
 	def get_absolute_url(self):
 		return "/tag/%s/" % (self.slug)
@@ -39,17 +50,51 @@ class Tag(models.Model):
 	def __unicode__(self):
 		return self.name
 
+class PostQuerySet(models.query.QuerySet):
+	def for_listing(self):
+		# Everything the templates touch per post, in two queries
+		return self.select_related('category', 'author', 'site').prefetch_related('tags')
+
+	def published(self):
+		# Scheduled posts stay hidden until their pub_date, see blogengine.publishing
+		return self.filter(pub_date__lte=timezone.now())
+
+	def for_site(self, site):
+		return self.filter(site=site)
+
+class PostManager(models.Manager):
+	def get_queryset(self):
+		return PostQuerySet(self.model, using=self._db)
+
+	def for_listing(self):
+		return self.get_queryset().for_listing()
+
+	def published(self):
+		return self.get_queryset().published()
+
+	def for_site(self, site):
+		return self.get_queryset().for_site(site)
+
 # Create your models here.
 class Post(models.Model):
 	title = models.CharField(max_length=200)
 	pub_date = models.DateTimeField()
+	modified = models.DateTimeField(auto_now=True)
 	text = models.TextField()
+	text_html = models.TextField(blank=True, editable=False)
 	slug = models.SlugField(max_length=40, unique=True)
 	author = models.ForeignKey(User)
 	site = models.ForeignKey(Site)
 	category = models.ForeignKey(Category, blank=True,null=True)
 	tags = models.ManyToManyField(Tag)
 
+	objects = PostManager()
+
+	def save(self, *args, **kwargs):
+		# Render once on write so the templates never run Markdown
+		self.text_html = render_markdown(self.text, use_cache=False)
+		super(Post, self).save(*args, **kwargs)
+
 	def get_absolute_url(self):
 		return "/%s/%s/%s/"	 % (self.pub_date.year, self.pub_date.month, self.slug)
 
@@ -57,4 +102,67 @@ class Post(models.Model):
 		return self.title
 
 	class Meta:
-		ordering = ["-pub_date"]
\ No newline at end of file
+		ordering = ["-pub_date"]
+		# Listings filter on one of these and seek on (pub_date, id)
+		index_together = [
+			('pub_date', 'id'),
+			('site', 'pub_date', 'id'),
+			('category', 'pub_date', 'id'),
+			('author', 'pub_date', 'id'),
+			('site', 'category', 'pub_date', 'id'),
+			('site', 'author', 'pub_date', 'id'),
+		]
+
+class ArchiveMonth(models.Model):
+	"""Number of posts a site published in a month, kept by blogengine.counts."""
+	site = models.ForeignKey(Site)
+	year = models.PositiveSmallIntegerField()
+	month = models.PositiveSmallIntegerField()
+	post_count = models.PositiveIntegerField(default=0)
+
+	def get_absolute_url(self):
+		return "/%d/%d/" % (self.year, self.month)
+
+	class Meta:
+		unique_together = ('site', 'year', 'month')
+		ordering = ['-year', '-month']
+
+class RelatedPost(models.Model):
+	"""One of the most similar posts to ``post``, kept by blogengine.related."""
+	post = models.ForeignKey(Post, related_name='related_links')
+	related = models.ForeignKey(Post, related_name='+')
+	score = models.FloatField()
+
+	class Meta:
+		unique_together = ('post', 'related')
+		ordering = ['-score', '-related']
+
+class SearchTerm(models.Model):
+	"""A token of the search index and the number of posts containing it."""
+	term = models.CharField(max_length=100, unique=True)
+	doc_count = models.PositiveIntegerField(default=0)
+
+	def __unicode__(self):
+		return self.term
+
+class SearchPosting(models.Model):
+	"""Where one term occurs in one post."""
+	term = models.ForeignKey(SearchTerm)
+	post = models.ForeignKey(Post)
+	frequency = models.PositiveIntegerField()
+	# Space separated token positions, for phrase queries
+	positions = models.TextField()
+
+	class Meta:
+		unique_together = ('term', 'post')
+
+class SearchDocument(models.Model):
+	"""Number of tokens indexed for a post, for BM25 length normalisation."""
+	post = models.OneToOneField(Post, primary_key=True)
+	length = models.PositiveIntegerField()
+
+# Connect the cache invalidation, search indexing, post count and related post handlers
+from blogengine import signals
+from blogengine import search
+from blogengine import counts
+from blogengine import related
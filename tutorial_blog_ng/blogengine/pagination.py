@@ -0,0 +1,179 @@
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Q
+from django.utils import timezone
+
+from blogengine.cache import KEY_PREFIX, get_cached, get_versions, set_cached
+
+if settings.USE_TZ:
+	EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+else:
+	EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_cursor(pub_date, pk):
+	"""Encode a (pub_date, id) position for use in a URL."""
+	delta = pub_date - EPOCH
+	micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+	return '%d-%d' % (micros, pk)
+
+
+def decode_cursor(value):
+	try:
+		micros, pk = value.rsplit('-', 1)
+		return EPOCH + datetime.timedelta(microseconds=int(micros)), int(pk)
+	except (ValueError, OverflowError):
+		raise InvalidPage("Invalid cursor %r" % value)
+
+
+class KeysetPage(object):
+	"""A page of posts bounded by cursors rather than an offset."""
+
+	def __init__(self, object_list, has_older, has_newer):
+		self.object_list = object_list
+		self._has_older = has_older
+		self._has_newer = has_newer
+
+	def __repr__(self):
+		return '<KeysetPage of %d posts>' % len(self.object_list)
+
+	def __len__(self):
+		return len(self.object_list)
+
+	def __getitem__(self, index):
+		return self.object_list[index]
+
+	def __iter__(self):
+		return iter(self.object_list)
+
+	# Page API used by templates, "next" is older and "previous" is newer
+	def has_next(self):
+		return self._has_older
+
+	def has_previous(self):
+		return self._has_newer
+
+	def has_other_pages(self):
+		return self._has_older or self._has_newer
+
+	@property
+	def next_cursor(self):
+		if self._has_older:
+			post = self.object_list[-1]
+			return encode_cursor(post.pub_date, post.pk)
+
+	@property
+	def previous_cursor(self):
+		if self._has_newer:
+			post = self.object_list[0]
+			return encode_cursor(post.pub_date, post.pk)
+
+
+class KeysetPaginator(object):
+	"""Seek pagination over posts ordered by (-pub_date, -id).
+
+	Each page is a single indexed range query for per_page + 1 rows; there
+	is no COUNT(*) and no OFFSET however deep the page.
+	"""
+
+	def __init__(self, queryset, per_page, count=None):
+		self.queryset = queryset
+		self.per_page = per_page
+		# Total number of posts when known without a query, else None
+		self.count = count
+
+	def page_queryset(self, after=None, before=None):
+		"""The query for one page, including the extra row used to detect more."""
+		# The redundant pub_date bound turns the OR into an index range scan
+		if after:
+			pub_date, pk = decode_cursor(after)
+			queryset = self.queryset.filter(pub_date__lte=pub_date).filter(
+				Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk)
+			).order_by('-pub_date', '-pk')
+		elif before:
+			pub_date, pk = decode_cursor(before)
+			queryset = self.queryset.filter(pub_date__gte=pub_date).filter(
+				Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, pk__gt=pk)
+			).order_by('pub_date', 'pk')
+		else:
+			queryset = self.queryset.order_by('-pub_date', '-pk')
+		return queryset[:self.per_page + 1]
+
+	def page(self, after=None, before=None):
+		object_list = list(self.page_queryset(after, before))
+		has_more = len(object_list) > self.per_page
+		object_list = object_list[:self.per_page]
+
+		if before:
+			if not has_more:
+				# Reached the newest posts, show the full first page instead
+				return self.page()
+			object_list.reverse()
+			return KeysetPage(object_list, has_older=True, has_newer=has_more)
+		return KeysetPage(object_list, has_older=has_more, has_newer=bool(after))
+
+	def cursor_for_page(self, number):
+		"""Cursor that starts numbered page ``number`` (OFFSET, so keep it shallow)."""
+		if number <= 1:
+			return None
+		queryset = self.queryset.prefetch_related(None).order_by('-pub_date', '-pk')
+		try:
+			pub_date, pk = queryset.values_list('pub_date', 'pk')[(number - 1) * self.per_page - 1]
+		except IndexError:
+			raise InvalidPage("That page contains no results")
+		return encode_cursor(pub_date, pk)
+
+
+class CachedCountPaginator(Paginator):
+	"""Numbered pages over posts without a COUNT(*) or deep OFFSET per request.
+
+	The count is either given (e.g. from the stored counts) or cached until
+	a post is added, removed, reordered or changes category, tag or site.
+	When the posts are in (-pub_date, -id) order the cursor ending each page
+	is cached too, so paging forward seeks from there instead of skipping
+	rows; other orderings and jumps fall back to OFFSET.
+	"""
+	COUNT_DEPENDENCIES = ['post-list', 'post-counts', 'archive']
+	KEYSET_ORDERINGS = (('-pub_date', '-pk'), ('-pub_date', '-id'))
+
+	def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, count=None):
+		super(CachedCountPaginator, self).__init__(object_list, per_page, orphans, allow_empty_first_page)
+		if count is not None:
+			self._count = count
+		self._query_key = hashlib.md5(str(object_list.query)).hexdigest()
+
+	def _key(self, kind):
+		return '%s:%s:%s' % (KEY_PREFIX, kind, self._query_key)
+
+	def _get_count(self):
+		if self._count is None:
+			key = self._key('count')
+			self._count = get_cached(key)
+			if self._count is None:
+				versions = get_versions(self.COUNT_DEPENDENCIES)
+				self._count = self.object_list.count()
+				set_cached(key, self._count, versions)
+		return self._count
+	count = property(_get_count)
+
+	def page(self, number):
+		number = self.validate_number(number)
+		if self.orphans or tuple(self.object_list.query.order_by) not in self.KEYSET_ORDERINGS:
+			return super(CachedCountPaginator, self).page(number)
+
+		cursors = get_cached(self._key('cursors')) or {}
+		if number == 1:
+			object_list = list(self.object_list[:self.per_page])
+		elif number - 1 in cursors:
+			object_list = list(KeysetPaginator(self.object_list, self.per_page)
+								.page_queryset(after=cursors[number - 1])[:self.per_page])
+		else:
+			bottom = (number - 1) * self.per_page
+			object_list = list(self.object_list[bottom:bottom + self.per_page])
+		if object_list and number not in cursors:
+			cursors[number] = encode_cursor(object_list[-1].pub_date, object_list[-1].pk)
+			set_cached(self._key('cursors'), cursors, get_versions(self.COUNT_DEPENDENCIES))
+		return self._get_page(object_list, number, self)
@@ -0,0 +1,81 @@
+"""Scheduled publishing.
+
+A post whose pub_date is still to come stays out of the listings, feeds,
+search results and sitemaps, and its page is a 404, until that time.
+Rather than a job flushing the caches when it goes live, everything cached
+from the posts expires at the next publication time and carries that time
+in its ETag, so cached copies are used right up to the moment they change.
+
+What is stored rather than cached, such as the related posts, catches up
+through the ``posts_published`` signal. It is sent with the posts whose
+pub_date passed since the next publication was last worked out, by the
+first request to work it out again; should the cache lose track of that
+time, ``computerelated`` brings the related posts up to date.
+"""
+import math
+
+from django.core.cache import cache
+from django.dispatch import Signal
+from django.utils import timezone
+
+from blogengine.cache import CACHE_TIMEOUT, KEY_PREFIX, get_cached, get_versions, set_cached
+from blogengine.models import Post
+
+NEXT_PUBLICATION_KEY = '%s:next-publication' % KEY_PREFIX
+PUBLISHED_UNTIL_KEY = '%s:published-until' % KEY_PREFIX
+
+posts_published = Signal(providing_args=['post_ids'])
+
+
+def _publications():
+	"""{'pub_date': the earliest pub_date still to come, 'published': the latest gone by}."""
+	now = timezone.now()
+	cached = get_cached(NEXT_PUBLICATION_KEY)
+	if cached is not None and 'published' in cached and (cached['pub_date'] is None or
+															cached['pub_date'] > now):
+		return cached
+
+	# Any post added, removed or moved in time changes it
+	versions = get_versions(['post-list'])
+	since = cache.get(PUBLISHED_UNTIL_KEY)
+	if since is None or since > now:
+		since = now
+	cache.set(PUBLISHED_UNTIL_KEY, now, None)
+	upcoming = Post.objects.filter(pub_date__gt=since).order_by('pub_date').values_list('pub_date', flat=True)
+	pub_dates = list(upcoming[:1])
+	# Posts went live since it was last worked out
+	if pub_dates and pub_dates[0] <= now:
+		posts_published.send(sender=Post, post_ids=list(Post.objects.filter(
+			pub_date__gt=since, pub_date__lte=now).values_list('pk', flat=True)))
+		pub_dates = list(upcoming.filter(pub_date__gt=now)[:1])
+	published = list(Post.objects.filter(pub_date__lte=now).order_by('-pub_date')
+					.values_list('pub_date', flat=True)[:1])
+	publications = {
+		'pub_date': pub_dates[0] if pub_dates else None,
+		'published': published[0] if published else None,
+	}
+	set_cached(NEXT_PUBLICATION_KEY, publications, versions)
+	return publications
+
+
+def next_publication():
+	"""The earliest pub_date still to come, or None if nothing is scheduled."""
+	return _publications()['pub_date']
+
+
+def last_publication():
+	"""The latest pub_date gone by, or None if no post is out yet.
+
+	Pages showing post counts change then, without anything being invalidated.
+	"""
+	return _publications()['published']
+
+
+def publication_timeout():
+	"""Seconds to cache anything built from the published posts: until the next one goes live."""
+	pub_date = next_publication()
+	if pub_date is None:
+		return CACHE_TIMEOUT
+	delta = pub_date - timezone.now()
+	seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+	return int(max(1, min(CACHE_TIMEOUT, math.ceil(seconds))))
@@ -0,0 +1,161 @@
+"""The post record format shared by ``importposts`` and ``exportposts``.
+
+A record is a dict with ``title``, ``slug``, ``pub_date`` (ISO 8601),
+``author`` (username), ``site`` (domain), ``category`` (name or None),
+``tags`` (names) and ``text`` (Markdown). It is stored either as one JSON
+object per line of a ``.jsonl`` file, or as a Markdown file with a header
+of ``Key: value`` lines and a blank line before the text::
+
+	Title: Hello world
+	Slug: hello-world
+	Pub-Date: 2014-06-01T12:00:00+00:00
+	Author: admin
+	Site: example.com
+	Category: python
+	Tags: django, web
+
+	The *text* of the post.
+"""
+import calendar
+import codecs
+import io
+import json
+import os
+import tarfile
+from collections import defaultdict
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from blogengine.models import Post
+
+MARKDOWN_SUFFIXES = ('.md', '.markdown')
+HEADER_FIELDS = ('title', 'slug', 'pub_date', 'author', 'site', 'category', 'tags')
+
+
+def post_record(post, tag_names):
+	"""The record of ``post``, which should have its author, site and category loaded."""
+	return {
+		'title': post.title,
+		'slug': post.slug,
+		'pub_date': post.pub_date.isoformat(),
+		'author': post.author.username,
+		'site': post.site.domain,
+		'category': post.category.name if post.category_id else None,
+		'tags': sorted(tag_names),
+		'text': post.text,
+	}
+
+
+def parse_pub_date(value):
+	"""Parse a record's date or datetime, assuming UTC when no offset is given."""
+	value = value.strip()
+	pub_date = parse_datetime(value)
+	if pub_date is None:
+		date = parse_date(value)
+		if date is None:
+			raise ValueError("Invalid date %r" % value)
+		pub_date = timezone.datetime(date.year, date.month, date.day)
+	if timezone.is_naive(pub_date):
+		pub_date = timezone.make_aware(pub_date, timezone.utc)
+	return pub_date
+
+
+def format_markdown(record):
+	lines = []
+	for field in HEADER_FIELDS:
+		value = record.get(field)
+		if field == 'tags':
+			value = ', '.join(value or ())
+		if value:
+			lines.append(u'%s: %s' % (field.replace('_', '-').title(), value))
+	return u'\n'.join(lines) + u'\n\n' + record['text']
+
+
+def parse_markdown(content, name=None):
+	"""The record in a Markdown file, its title defaulting to ``name``."""
+	content = content.replace(u'\r\n', u'\n')
+	header, _, text = content.partition(u'\n\n')
+	record = {'title': name, 'tags': [], 'text': text}
+	for line in header.splitlines():
+		key, sep, value = line.partition(u':')
+		field = key.strip().lower().replace('-', '_')
+		if not sep or field not in HEADER_FIELDS:
+			# No header, the whole file is the text
+			return {'title': name, 'tags': [], 'text': content}
+		if field == 'tags':
+			record['tags'] = [tag.strip() for tag in value.split(u',') if tag.strip()]
+		else:
+			record[field] = value.strip()
+	return record
+
+
+def read_records(paths):
+	"""Stream the records of ``.jsonl`` files and directories of Markdown files, in a stable order."""
+	for path in paths:
+		if os.path.isdir(path):
+			for directory, subdirectories, files in os.walk(path):
+				subdirectories.sort()
+				for filename in sorted(files):
+					if filename.endswith(MARKDOWN_SUFFIXES):
+						with codecs.open(os.path.join(directory, filename), encoding='utf-8') as post_file:
+							yield parse_markdown(post_file.read(), os.path.splitext(filename)[0])
+		elif path.endswith(MARKDOWN_SUFFIXES):
+			with codecs.open(path, encoding='utf-8') as post_file:
+				yield parse_markdown(post_file.read(), os.path.splitext(os.path.basename(path))[0])
+		else:
+			with open(path) as lines:
+				for line in lines:
+					if line.strip():
+						yield json.loads(line)
+
+
+def post_records(queryset, chunk_size=500):
+	"""Stream the records of ``queryset`` in pk order, one chunk of posts in memory at a time."""
+	queryset = queryset.select_related('author', 'site', 'category').order_by('pk')
+	last_pk = 0
+	while True:
+		posts = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+		if not posts:
+			break
+		tag_names = defaultdict(list)
+		for post_id, name in Post.tags.through.objects.filter(
+				post__in=[post.pk for post in posts]).values_list('post_id', 'tag__name'):
+			tag_names[post_id].append(name)
+		for post in posts:
+			yield post_record(post, tag_names[post.pk])
+		last_pk = posts[-1].pk
+
+
+def jsonl_lines(records):
+	for record in records:
+		yield json.dumps(record) + '\n'
+
+
+class _TarBuffer(object):
+	"""Collects what tarfile writes so it can be handed on piece by piece."""
+
+	def __init__(self):
+		self.data = []
+
+	def write(self, data):
+		self.data.append(data)
+
+	def pop(self):
+		data, self.data = ''.join(self.data), []
+		return data
+
+
+def markdown_tar(records, compress=False):
+	"""Stream a tar of one Markdown file per record, ``posts/<slug>.md``."""
+	buf = _TarBuffer()
+	tar = tarfile.open(mode='w|gz' if compress else 'w|', fileobj=buf)
+	for record in records:
+		content = format_markdown(record).encode('utf-8')
+		info = tarfile.TarInfo('posts/%s.md' % record['slug'])
+		info.size = len(content)
+		info.mtime = calendar.timegm(parse_pub_date(record['pub_date']).utctimetuple())
+		tar.addfile(info, io.BytesIO(content))
+		yield buf.pop()
+	tar.close()
+	yield buf.pop()
@@ -0,0 +1,264 @@
+"""Related posts from shared tags and categories.
+
+Each post is a sparse vector over its tags and its category, weighted by
+inverse document frequency, and two posts are as related as the cosine of
+their vectors. Scores are accumulated by walking the tag -> posts index,
+so only pairs sharing a tag are ever looked at; a shared category adds to
+the score of those pairs. Only published posts on the same site are
+listed. The best RELATED_POSTS of every post are stored in RelatedPost.
+``computerelated`` fills the table, after which changing a post's tags,
+category or site, or its going live, only recomputes the lists it can
+enter or leave.
+"""
+import heapq
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from blogengine.cache import invalidate
+from blogengine.models import Category, Post, RelatedPost, Tag
+from blogengine.publishing import posts_published
+from blogengine.search import chunks
+
+RELATED_POSTS = getattr(settings, 'BLOGENGINE_RELATED_POSTS', 5)
+# How much a shared category counts next to a shared tag
+CATEGORY_WEIGHT = getattr(settings, 'BLOGENGINE_RELATED_CATEGORY_WEIGHT', 0.5)
+# Tags on more posts than this say too little to be worth walking
+MAX_TAG_POSTS = getattr(settings, 'BLOGENGINE_RELATED_MAX_TAG_POSTS', 2000)
+
+PostTags = Post.tags.through
+
+
+class PostFeatures(object):
+	"""Tags and categories of a set of posts, indexed by tag.
+
+	Document frequencies come from Tag.post_count and Category.post_count.
+	"""
+
+	def __init__(self):
+		self.num_posts = Post.objects.count()
+		self.now = timezone.now()
+		self.tags = defaultdict(set)
+		self.categories = {}
+		self.sites = {}
+		self.scheduled = set()
+		self.posts_by_tag = defaultdict(set)
+		self.tag_counts = {}
+		self.category_counts = {}
+		self._norms = {}
+
+	@classmethod
+	def for_all_posts(cls):
+		data = cls()
+		data.add_posts(Post.objects.values_list('pk', 'category_id', 'site_id', 'pub_date').iterator())
+		data.add_tags(PostTags.objects.values_list('post_id', 'tag_id').iterator())
+		data.tag_counts.update(Tag.objects.values_list('pk', 'post_count'))
+		data.category_counts.update(Category.objects.values_list('pk', 'post_count'))
+		return data
+
+	@classmethod
+	def around(cls, post_ids):
+		"""``post_ids`` and every published post on their sites sharing a tag with them."""
+		data = cls()
+		data.load(post_ids)
+		data.load_counts()
+		tag_ids = set(tag_id for pk in post_ids for tag_id in data.tags[pk]
+					if data.tag_counts.get(tag_id, 0) <= MAX_TAG_POSTS)
+		site_ids = set(data.sites[pk] for pk in post_ids if pk in data.sites)
+		neighbours = set()
+		for chunk in chunks(tag_ids):
+			neighbours.update(PostTags.objects.filter(tag__in=chunk, post__site__in=site_ids,
+				post__pub_date__lte=data.now).values_list('post_id', flat=True))
+		data.load(neighbours - set(data.categories))
+		data.load_counts()
+		return data
+
+	def load(self, post_ids):
+		for chunk in chunks(post_ids):
+			self.add_posts(Post.objects.filter(pk__in=chunk).values_list(
+				'pk', 'category_id', 'site_id', 'pub_date'))
+			self.add_tags(PostTags.objects.filter(post__in=chunk).values_list('post_id', 'tag_id'))
+
+	def load_counts(self):
+		tag_ids = set(tag_id for tags in self.tags.values() for tag_id in tags) - set(self.tag_counts)
+		for chunk in chunks(tag_ids):
+			self.tag_counts.update(Tag.objects.filter(pk__in=chunk).values_list('pk', 'post_count'))
+		category_ids = set(self.categories.values()) - set(self.category_counts) - set([None])
+		for chunk in chunks(category_ids):
+			self.category_counts.update(Category.objects.filter(pk__in=chunk).values_list('pk', 'post_count'))
+
+	def add_posts(self, rows):
+		for pk, category_id, site_id, pub_date in rows:
+			self.categories[pk] = category_id
+			self.sites[pk] = site_id
+			if pub_date > self.now:
+				self.scheduled.add(pk)
+
+	def listable(self, pk, other):
+		"""Whether ``other`` can be listed as related to ``pk``."""
+		return other != pk and other not in self.scheduled and self.sites.get(other) == self.sites.get(pk)
+
+	def add_tags(self, rows):
+		for post_id, tag_id in rows:
+			self.tags[post_id].add(tag_id)
+			self.posts_by_tag[tag_id].add(post_id)
+
+	def _idf(self, count):
+		return math.log(1 + float(self.num_posts) / max(count, 1))
+
+	def norm(self, pk):
+		if pk not in self._norms:
+			squares = sum(self._idf(self.tag_counts.get(tag_id, 1)) ** 2 for tag_id in self.tags[pk])
+			category_id = self.categories.get(pk)
+			if category_id:
+				squares += (CATEGORY_WEIGHT * self._idf(self.category_counts.get(category_id, 1))) ** 2
+			self._norms[pk] = math.sqrt(squares)
+		return self._norms[pk]
+
+	def scores(self, pk):
+		"""Cosine similarity of ``pk`` with every listable post sharing a tag with it."""
+		scores = defaultdict(float)
+		for tag_id in self.tags[pk]:
+			count = self.tag_counts.get(tag_id, 1)
+			if count > MAX_TAG_POSTS:
+				continue
+			weight = self._idf(count) ** 2
+			for other in self.posts_by_tag[tag_id]:
+				if self.listable(pk, other):
+					scores[other] += weight
+		category_id = self.categories.get(pk)
+		if category_id:
+			weight = (CATEGORY_WEIGHT * self._idf(self.category_counts.get(category_id, 1))) ** 2
+			for other in scores:
+				if self.categories.get(other) == category_id:
+					scores[other] += weight
+		norm = self.norm(pk)
+		return dict((other, score / (norm * self.norm(other))) for other, score in scores.items())
+
+	def top(self, pk, scores=None):
+		"""The best [(score, post id)] for ``pk``, ties going to newer posts."""
+		if scores is None:
+			scores = self.scores(pk)
+		return heapq.nlargest(RELATED_POSTS, ((score, other) for other, score in scores.items()))
+
+
+def store_related(tops):
+	"""Save ``{post id: top(post id)}``, rewriting only the lists that changed."""
+	changed = []
+	for chunk in chunks(sorted(tops)):
+		stored = defaultdict(list)
+		for post_id, related_id in RelatedPost.objects.filter(post__in=chunk).values_list(
+				'post_id', 'related_id'):
+			stored[post_id].append(related_id)
+		changed.extend(pk for pk in chunk if [other for score, other in tops[pk]] != stored[pk])
+
+	with transaction.atomic():
+		for chunk in chunks(changed):
+			RelatedPost.objects.filter(post__in=chunk).delete()
+			RelatedPost.objects.bulk_create([
+				RelatedPost(post_id=pk, related_id=other, score=score)
+				for pk in chunk for score, other in tops[pk]])
+	invalidate(*['related:%d' % pk for pk in changed])
+	return len(changed)
+
+
+def recompute_related(post_ids):
+	"""Recompute the lists of ``post_ids`` alone."""
+	data = PostFeatures.around(post_ids)
+	store_related(dict((pk, data.top(pk)) for pk in post_ids if pk in data.categories))
+
+
+def refresh_related(post_ids):
+	"""Recompute the lists of ``post_ids`` and the lists they enter or leave."""
+	post_ids = set(post_ids)
+	if not post_ids:
+		return
+	data = PostFeatures.around(post_ids)
+	tops = {}
+	candidates = {}
+	for pk in post_ids:
+		if pk in data.categories:
+			scores = data.scores(pk)
+			tops[pk] = data.top(pk, scores)
+			if pk in data.scheduled:
+				# Listed nowhere until it goes live
+				continue
+			for other, score in scores.items():
+				candidates[other] = max(score, candidates.get(other, 0))
+
+	# Lists showing one of the posts may lose it or reorder
+	affected = set()
+	for chunk in chunks(post_ids):
+		affected.update(RelatedPost.objects.filter(related__in=chunk).values_list('post_id', flat=True))
+	# Lists one of them now beats the last entry of, or that aren't full
+	floors = {}
+	for chunk in chunks(candidates):
+		for row in (RelatedPost.objects.filter(post__in=chunk).values('post')
+					.annotate(floor=Min('score'), entries=Count('pk'))):
+			floors[row['post']] = (row['floor'], row['entries'])
+	for other, score in candidates.items():
+		floor, entries = floors.get(other, (0, 0))
+		if entries < RELATED_POSTS or score > floor:
+			affected.add(other)
+
+	store_related(tops)
+	affected -= post_ids
+	if affected:
+		recompute_related(affected)
+
+
+def related_fields(post):
+	"""What decides the lists ``post`` is in: its category, site and whether it is published."""
+	return (post.category_id, post.site_id, post.pub_date is not None and post.pub_date <= timezone.now())
+
+
+@receiver(post_init, sender=Post)
+def remember_related_fields(sender, instance, **kwargs):
+	instance._original_related = related_fields(instance)
+
+
+@receiver(post_save, sender=Post)
+def refresh_saved_post(sender, instance, created, **kwargs):
+	# New posts have no tags yet, so no related posts either
+	fields = related_fields(instance)
+	if not created and fields != instance._original_related:
+		refresh_related([instance.pk])
+	instance._original_related = fields
+
+
+@receiver(posts_published)
+def refresh_published_posts(sender, post_ids, **kwargs):
+	refresh_related(post_ids)
+
+
+@receiver(pre_delete, sender=Post)
+def remember_related_listers(sender, instance, **kwargs):
+	# The rows pointing at the post are gone by post_delete
+	instance._related_listers = list(RelatedPost.objects.filter(related=instance)
+									.values_list('post_id', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def refresh_deleted_post(sender, instance, **kwargs):
+	if instance._related_listers:
+		recompute_related(instance._related_listers)
+
+
+@receiver(m2m_changed, sender=PostTags)
+def refresh_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+	if action == 'pre_clear' and reverse:
+		instance._related_cleared_pks = set(instance.post_set.values_list('pk', flat=True))
+	if action not in ('post_add', 'post_remove', 'post_clear'):
+		return
+	if not reverse:
+		refresh_related([instance.pk])
+	elif action == 'post_clear':
+		refresh_related(getattr(instance, '_related_cleared_pks', ()))
+	else:
+		refresh_related(pk_set or ())
@@ -0,0 +1,127 @@
+"""Serve the public pages from read replicas, everything else from ``default``.
+
+Views wrapped in replica_reads() (the listings, posts, feeds, sitemaps and
+flatpages, see blogengine/urls.py) read from a replica picked round-robin
+per request, skipping any that failed for REPLICA_RETRY seconds. Writes,
+the admin and everything outside a request use the primary, and so does:
+
+* a client that wrote in the last REPLICA_LAG seconds, pinned by a cookie
+  (see blogengine.middleware.ReplicaMiddleware), so editors see their edits;
+* a request after anything was invalidated in the last REPLICA_LAG seconds,
+  so pages cached under the new versions aren't built from a lagging copy;
+* the rest of a request once it has written.
+
+Replicas are the DATABASES aliases in BLOGENGINE_REPLICAS, by default every
+alias but ``default``. To try it locally, copy the SQLite file (or point an
+alias at a second local Postgres database) and mark it as a test mirror::
+
+	DATABASES['replica'] = {
+		'ENGINE': 'django.db.backends.sqlite3',
+		'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+		'TEST_MIRROR': 'default',
+	}
+"""
+import itertools
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.decorators import available_attrs
+
+from blogengine.cache import invalidated_within
+
+REPLICAS = getattr(settings, 'BLOGENGINE_REPLICAS',
+				[alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS])
+# Seconds a replica may be behind the primary
+REPLICA_LAG = getattr(settings, 'BLOGENGINE_REPLICA_LAG', 10)
+# Seconds a failing replica is left alone before it is tried again
+REPLICA_RETRY = getattr(settings, 'BLOGENGINE_REPLICA_RETRY', 30)
+
+# What the current request reads from and whether it wrote, reset by ReplicaMiddleware
+_state = threading.local()
+# alias -> time it may be tried again, per process
+_down = {}
+
+
+def replica_reads(view):
+	"""Mark ``view`` as only reading, so its GET and HEAD requests may use a replica."""
+	@wraps(view, assigned=available_attrs(view))
+	def wrapped(*args, **kwargs):
+		return view(*args, **kwargs)
+	wrapped.replica_reads = True
+	return wrapped
+
+
+def start_request():
+	"""Forget what the previous request on this thread read from and wrote."""
+	_state.replica = False
+	_state.alias = None
+	_state.wrote = False
+
+
+def use_replicas():
+	"""Let the rest of the current request read from a replica."""
+	_state.replica = True
+
+
+def request_alias():
+	"""The database the current request has read from, if it chose one."""
+	return getattr(_state, 'alias', None)
+
+
+def request_wrote():
+	"""Whether the current request has written to the primary."""
+	return getattr(_state, 'wrote', False)
+
+
+def mark_down(alias):
+	"""Stop reading from ``alias`` for REPLICA_RETRY seconds."""
+	_down[alias] = time.time() + REPLICA_RETRY
+
+
+class ReplicaRouter(object):
+	def __init__(self, replicas=None):
+		self.replicas = list(REPLICAS if replicas is None else replicas)
+		self._next = itertools.cycle(self.replicas)
+
+	def is_healthy(self, alias):
+		"""Whether ``alias`` can be connected to; a no-op once it is."""
+		try:
+			connections[alias].ensure_connection()
+		except DatabaseError:
+			return False
+		return True
+
+	def choose(self):
+		"""The next healthy replica, or the primary if there is none or it may be ahead."""
+		if not self.replicas or invalidated_within(REPLICA_LAG):
+			return DEFAULT_DB_ALIAS
+		now = time.time()
+		for alias in itertools.islice(self._next, len(self.replicas)):
+			if _down.get(alias, 0) > now:
+				continue
+			if self.is_healthy(alias):
+				return alias
+			mark_down(alias)
+		return DEFAULT_DB_ALIAS
+
+	def db_for_read(self, model, **hints):
+		if not getattr(_state, 'replica', False) or _state.wrote:
+			return DEFAULT_DB_ALIAS
+		if _state.alias is None:
+			# One replica for the whole request, so it reads one consistent copy
+			_state.alias = self.choose()
+		return _state.alias
+
+	def db_for_write(self, model, **hints):
+		_state.wrote = True
+		return DEFAULT_DB_ALIAS
+
+	def allow_relation(self, obj1, obj2, **hints):
+		# Every database holds the same rows
+		return True
+
+	def allow_syncdb(self, db, model):
+		return db not in self.replicas
@@ -0,0 +1,245 @@
+"""Full-text search over post titles and text.
+
+The inverted index lives in three tables (see models): SearchTerm holds
+each token and the number of posts containing it, SearchPosting where a
+term occurs in a post and SearchDocument how many tokens each post has.
+Saving or deleting a post only touches that post's rows; the
+``rebuildsearch`` command rebuilds the whole index in batches.
+
+Queries match posts containing every term, ``"quoted phrases"`` must
+appear in order, and results are ranked with BM25. The index covers every
+site and scheduled posts too, those are left out when ranking.
+"""
+import hashlib
+import itertools
+import math
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, F
+from django.db.models.signals import post_init, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from blogengine.cache import KEY_PREFIX, get_cached, get_versions, invalidate, set_cached
+from blogengine.models import Post, SearchDocument, SearchPosting, SearchTerm
+from blogengine.publishing import publication_timeout
+
+# BM25 term frequency saturation and length normalisation
+BM25_K1 = getattr(settings, 'BLOGENGINE_SEARCH_K1', 1.2)
+BM25_B = getattr(settings, 'BLOGENGINE_SEARCH_B', 0.75)
+# Most posts returned for one query
+MAX_RESULTS = getattr(settings, 'BLOGENGINE_SEARCH_MAX_RESULTS', 1000)
+MAX_QUERY_TERMS = 16
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+MAX_TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+# Position gap between title and text so phrases can't span both
+FIELD_GAP = 100
+# Keeps IN lists under SQLite's 999 parameter limit
+CHUNK_SIZE = 500
+
+
+def chunks(items):
+	items = list(items)
+	for i in range(0, len(items), CHUNK_SIZE):
+		yield items[i:i + CHUNK_SIZE]
+
+
+def tokenize(text):
+	return TOKEN_RE.findall(text.lower())
+
+
+def document_terms(title, text):
+	"""Map each term of a post to the list of its positions."""
+	terms = defaultdict(list)
+	position = 0
+	for field in (title, text):
+		for token in tokenize(field):
+			if len(token) <= MAX_TERM_LENGTH:
+				terms[token].append(position)
+			position += 1
+		position += FIELD_GAP
+	return terms
+
+
+def get_term_ids(terms):
+	"""Map each of ``terms`` to its SearchTerm id, creating missing ones."""
+	ids = {}
+	for chunk in chunks(terms):
+		ids.update(SearchTerm.objects.filter(term__in=chunk).values_list('term', 'pk'))
+	missing = [term for term in terms if term not in ids]
+	if missing:
+		try:
+			with transaction.atomic():
+				SearchTerm.objects.bulk_create([SearchTerm(term=term) for term in missing])
+		except IntegrityError:
+			# Another writer added some of them first
+			for term in missing:
+				SearchTerm.objects.get_or_create(term=term)
+		for chunk in chunks(missing):
+			ids.update(SearchTerm.objects.filter(term__in=chunk).values_list('term', 'pk'))
+	return ids
+
+
+def _change_doc_counts(term_ids, delta):
+	for chunk in chunks(term_ids):
+		SearchTerm.objects.filter(pk__in=chunk).update(doc_count=F('doc_count') + delta)
+
+
+def index_post(post):
+	"""Bring the index rows of ``post`` in line with its title and text."""
+	terms = document_terms(post.title, post.text)
+	with transaction.atomic():
+		existing = dict((posting.term.term, posting) for posting in
+						SearchPosting.objects.filter(post=post).select_related('term'))
+
+		removed = [posting for term, posting in existing.items() if term not in terms]
+		for chunk in chunks(removed):
+			SearchPosting.objects.filter(pk__in=[posting.pk for posting in chunk]).delete()
+		_change_doc_counts([posting.term_id for posting in removed], -1)
+
+		for term, posting in existing.items():
+			positions = ' '.join(map(str, terms.get(term, ())))
+			if positions and positions != posting.positions:
+				SearchPosting.objects.filter(pk=posting.pk).update(
+					frequency=len(terms[term]), positions=positions)
+
+		added = [term for term in terms if term not in existing]
+		if added:
+			term_ids = get_term_ids(added)
+			SearchPosting.objects.bulk_create([
+				SearchPosting(term_id=term_ids[term], post=post, frequency=len(terms[term]),
+							positions=' '.join(map(str, terms[term])))
+				for term in added])
+			_change_doc_counts(term_ids.values(), 1)
+
+		length = sum(len(positions) for positions in terms.values())
+		if not SearchDocument.objects.filter(post=post).update(length=length):
+			SearchDocument.objects.create(post=post, length=length)
+	invalidate('search')
+
+
+def unindex_post(post):
+	with transaction.atomic():
+		term_ids = list(SearchPosting.objects.filter(post=post).values_list('term_id', flat=True))
+		SearchPosting.objects.filter(post=post).delete()
+		SearchDocument.objects.filter(post=post).delete()
+		_change_doc_counts(term_ids, -1)
+	invalidate('search')
+
+
+@receiver(post_init, sender=Post)
+def remember_search_fields(sender, instance, **kwargs):
+	instance._original_search = (instance.title, instance.text)
+
+
+@receiver(post_save, sender=Post)
+def update_search_index(sender, instance, created, **kwargs):
+	if created or (instance.title, instance.text) != instance._original_search:
+		index_post(instance)
+		remember_search_fields(sender, instance)
+
+
+@receiver(pre_delete, sender=Post)
+def remove_from_search_index(sender, instance, **kwargs):
+	unindex_post(instance)
+
+
+def parse_query(query):
+	"""Split ``query`` into its distinct terms and its quoted phrases."""
+	terms, phrases = [], []
+	for phrase, word in QUERY_RE.findall(query):
+		tokens = tokenize(phrase or word)
+		if phrase and len(tokens) > 1:
+			phrases.append(tokens)
+		terms.extend(token for token in tokens if token not in terms)
+	terms = terms[:MAX_QUERY_TERMS]
+	# Phrases stop at the first term left out
+	kept = set(terms)
+	phrases = [list(itertools.takewhile(kept.__contains__, phrase)) for phrase in phrases]
+	return terms, [phrase for phrase in phrases if len(phrase) > 1]
+
+
+def index_stats():
+	"""Number of indexed posts and their average length."""
+	key = '%s:search:stats' % KEY_PREFIX
+	stats = get_cached(key)
+	if stats is None:
+		versions = get_versions(['search'])
+		stats = SearchDocument.objects.aggregate(count=Count('pk'), length=Avg('length'))
+		set_cached(key, stats, versions)
+	return stats['count'], stats['length'] or 0
+
+
+def _has_phrase(positions, phrase):
+	starts = positions[phrase[0]]
+	for offset, term in enumerate(phrase[1:], 1):
+		starts = starts & set(position - offset for position in positions[term])
+	return bool(starts)
+
+
+def rank(terms, phrases, site=None):
+	"""Ids of the published posts containing all ``terms`` and ``phrases``, best first.
+
+	Only posts on ``site`` are ranked if it is given.
+	"""
+	found = list(SearchTerm.objects.filter(term__in=terms, doc_count__gt=0))
+	if len(found) < len(terms):
+		return []
+	num_docs, avg_length = index_stats()
+	found.sort(key=lambda term: term.doc_count)
+	names = dict((term.pk, term.term) for term in found)
+
+	# Only posts containing the rarest term can match, so start from those
+	candidates = SearchPosting.objects.filter(term=found[0], post__pub_date__lte=timezone.now())
+	if site is not None:
+		candidates = candidates.filter(post__site=site)
+	candidates = candidates.values('post_id')
+	fields = ['post_id', 'term_id', 'frequency', 'post__searchdocument__length']
+	if phrases:
+		fields.append('positions')
+	matches = defaultdict(list)
+	for row in (SearchPosting.objects.filter(term__in=found, post__in=candidates)
+				.values_list(*fields).iterator()):
+		matches[row[0]].append(row)
+
+	idf = dict((term.pk, math.log(1 + (num_docs - term.doc_count + 0.5) / (term.doc_count + 0.5)))
+				for term in found)
+	scores = []
+	for post_id, rows in matches.items():
+		if len(rows) < len(found):
+			continue
+		if phrases:
+			positions = dict((names[row[1]], set(map(int, row[4].split()))) for row in rows)
+			if not all(_has_phrase(positions, phrase) for phrase in phrases):
+				continue
+		score = 0.0
+		for row in rows:
+			frequency, length = row[2], row[3] or 0
+			norm = 1 - BM25_B + BM25_B * length / avg_length if avg_length else 1
+			score += idf[row[1]] * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+		scores.append((-score, -post_id))
+	scores.sort()
+	return [-post_id for score, post_id in scores[:MAX_RESULTS]]
+
+
+def search(query, site=None):
+	"""Ids of the published posts matching ``query``, on ``site`` if given, best first.
+
+	Cached until the index or the posts listed change, or a post is published.
+	"""
+	terms, phrases = parse_query(query)
+	if not terms:
+		return []
+	key = '%s:search:%s:%s' % (KEY_PREFIX, site.pk if site is not None else 'all',
+								hashlib.md5(repr((terms, phrases)).encode('utf-8')).hexdigest())
+	results = get_cached(key)
+	if results is None:
+		versions = get_versions(['search', 'post-list'])
+		results = rank(terms, phrases, site)
+		set_cached(key, results, versions, publication_timeout())
+	return results
@@ -0,0 +1,139 @@
+"""Invalidate cached pages and feeds when the content they show changes.
+
+Dependency names used by the views:
+
+``post:<id>``
+	anything about the post changed
+``post-list``
+	a post was added, removed or moved in date order
+``category:<id>``, ``tag:<id>``
+	the category/tag itself changed
+``post-counts``
+	a category or tag was added, changed or removed, or its post count
+	changed (see blogengine.counts)
+``archive``
+	a month's post count changed (see blogengine.counts)
+``related:<id>``
+	the post's related posts changed (see blogengine.related)
+``flatpages``
+	a flatpage was added, changed or removed
+
+and, scoped to the site of the posts with ``site_dependencies()``:
+
+``post-list@<site>``, ``archive@<site>``
+	as above, for one site's posts
+``category:<id>@<site>``, ``tag:<id>@<site>``, ``author:<id>@<site>``
+	posts were added, removed or reordered in the listing
+``archive:<year>-<month>@<site>``
+	posts were added, removed or reordered in that month's listing
+``posts:<year>-<month>@<site>``
+	a post published in that month was saved or deleted
+"""
+from django.contrib.flatpages.models import FlatPage
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from blogengine.cache import invalidate, site_dependencies
+from blogengine.models import Category, Post, Tag
+
+
+@receiver(post_init, sender=Post)
+def remember_post_listing_fields(sender, instance, **kwargs):
+	# Lets a save invalidate the listings the post is leaving
+	instance._original_listing = (instance.pub_date, instance.category_id, instance.author_id,
+									instance.site_id)
+
+
+def archive_dependency(pub_date, kind='archive'):
+	return '%s:%d-%d' % (kind, pub_date.year, pub_date.month)
+
+
+@receiver(post_save, sender=Post)
+def invalidate_saved_post(sender, instance, created, **kwargs):
+	pub_date, category_id, author_id, site_id = getattr(instance, '_original_listing',
+														(None, None, None, None))
+	# Listings of the site the post is on, and of the one it was on
+	joined = [archive_dependency(instance.pub_date, 'posts')]
+	left = []
+
+	moved = created or instance.site_id != site_id
+	reordered = moved or instance.pub_date != pub_date
+	if reordered:
+		joined.extend(['post-list', archive_dependency(instance.pub_date)])
+		if not created:
+			left.extend(['post-list', archive_dependency(pub_date), archive_dependency(pub_date, 'posts')])
+			tags = ['tag:%d' % pk for pk in instance.tags.values_list('pk', flat=True)]
+			joined.extend(tags)
+			left.extend(tags)
+	if reordered or instance.category_id != category_id:
+		joined.extend('category:%d' % pk for pk in [instance.category_id] if pk)
+		left.extend('category:%d' % pk for pk in [category_id] if pk)
+	if reordered or instance.author_id != author_id:
+		joined.append('author:%d' % instance.author_id)
+		left.extend('author:%d' % pk for pk in [author_id] if pk)
+
+	dependencies = ['post:%d' % instance.pk] + site_dependencies(instance.site_id, *joined)
+	if left:
+		dependencies.extend(site_dependencies(site_id, *left))
+	if reordered:
+		dependencies.append('post-list')
+	invalidate(*dependencies)
+	remember_post_listing_fields(sender, instance)
+
+
+@receiver(pre_delete, sender=Post)
+def remember_deleted_post_tags(sender, instance, **kwargs):
+	# The tag rows are gone by post_delete
+	instance._deleted_tag_ids = list(instance.tags.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def invalidate_deleted_post(sender, instance, **kwargs):
+	left = ['post-list', 'author:%d' % instance.author_id, archive_dependency(instance.pub_date),
+			archive_dependency(instance.pub_date, 'posts')]
+	if instance.category_id:
+		left.append('category:%d' % instance.category_id)
+	left.extend('tag:%d' % pk for pk in getattr(instance, '_deleted_tag_ids', []))
+	invalidate('post:%d' % instance.pk, 'post-list', *site_dependencies(instance.site_id, *left))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def invalidate_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+	if action == 'pre_clear':
+		# Work out what is about to be removed
+		if reverse:
+			instance._cleared_pks = set(instance.post_set.values_list('pk', flat=True))
+		else:
+			instance._cleared_pks = set(instance.tags.values_list('pk', flat=True))
+		return
+	if action == 'post_clear':
+		pk_set = getattr(instance, '_cleared_pks', set())
+	elif action not in ('post_add', 'post_remove'):
+		return
+
+	if reverse:
+		# tag.post_set changed, maybe on several sites
+		dependencies = ['post:%d' % pk for pk in pk_set or ()]
+		if pk_set:
+			for site_id in set(Post.objects.filter(pk__in=pk_set).values_list('site_id', flat=True)):
+				dependencies.extend(site_dependencies(site_id, 'tag:%d' % instance.pk))
+		invalidate(*dependencies)
+	else:
+		invalidate('post:%d' % instance.pk,
+			*site_dependencies(instance.site_id, *['tag:%d' % pk for pk in pk_set or ()]))
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+	invalidate('category:%d' % instance.pk, 'post-counts')
+
+
+@receiver([post_save, post_delete], sender=Tag)
+def invalidate_tag(sender, instance, **kwargs):
+	invalidate('tag:%d' % instance.pk, 'post-counts')
+
+
+@receiver([post_save, post_delete], sender=FlatPage)
+@receiver(m2m_changed, sender=FlatPage.sites.through)
+def invalidate_flatpages(sender, instance, **kwargs):
+	invalidate('flatpages')
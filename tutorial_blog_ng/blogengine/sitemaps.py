@@ -0,0 +1,201 @@
+"""``sitemap.xml`` as an index of shards of at most SHARD_SIZE URLs each.
+
+Posts are sharded by the month they were published in, the categories and
+tags with posts out on the site by pk, and the flatpages of the site go in
+one shard. Every shard is read with keyset iteration, so no shard costs
+more than a walk along an index, and is cached until something listed in
+it changes: a post shard depends on ``posts:<year>-<month>@<site>``, the
+category and tag shards on ``post-counts`` and ``post-list@<site>`` and the
+flatpages on ``flatpages`` (see blogengine.signals), and all of them expire
+when a scheduled post goes live.
+"""
+import datetime
+import itertools
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.db.models import Q
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+
+from blogengine.cache import get_cached, get_versions, make_etag, request_key, set_cached, site_dependencies
+from blogengine.counts import published_months
+from blogengine.middleware import request_site, single_site
+from blogengine.models import Category, Post, Tag
+from blogengine.pagination import EPOCH
+from blogengine.publishing import next_publication, publication_timeout
+from blogengine.search import CHUNK_SIZE
+from blogengine.views import cached_page_response, is_not_modified, last_modified_of, set_validators
+
+SHARD_SIZE = getattr(settings, 'BLOGENGINE_SITEMAP_SHARD_SIZE', 50000)
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+CONTENT_TYPE = 'application/xml; charset=utf-8'
+
+
+def shard_count(count):
+	return max((count + SHARD_SIZE - 1) // SHARD_SIZE, 1)
+
+
+def shard_name(kind, part=1):
+	if part > 1:
+		return 'sitemap-%s-%d.xml' % (kind, part)
+	return 'sitemap-%s.xml' % kind
+
+
+def month_range(year, month):
+	start = datetime.datetime(year, month, 1, tzinfo=EPOCH.tzinfo)
+	end = datetime.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=EPOCH.tzinfo)
+	return start, end
+
+
+def listed(model, site):
+	"""The categories or tags (``model``) with posts out on ``site``."""
+	if next_publication() is None and single_site():
+		# The stored counts are of those posts
+		return model.objects.filter(post_count__gt=0)
+	posts = Post.objects.published().for_site(site).order_by()
+	if model is Tag:
+		return Tag.objects.filter(pk__in=Post.tags.through.objects.filter(post__in=posts).values('tag'))
+	return Category.objects.filter(pk__in=posts.values('category'))
+
+
+def sitemap_shards(site):
+	"""The file names of every shard of ``site``'s sitemap."""
+	shards = []
+	for month in sorted(published_months(site), key=lambda month: (month.year, month.month)):
+		kind = 'posts-%04d-%02d' % (month.year, month.month)
+		shards.extend(shard_name(kind, part) for part in range(1, shard_count(month.post_count) + 1))
+	for kind, model in (('categories', Category), ('tags', Tag)):
+		count = listed(model, site).count()
+		if count:
+			shards.extend(shard_name(kind, part) for part in range(1, shard_count(count) + 1))
+	if FlatPage.objects.filter(sites=site, registration_required=False).exists():
+		shards.append(shard_name('pages'))
+	return shards
+
+
+def _keyset(queryset, fields, key):
+	"""Stream ``fields`` of ``queryset`` in ``key`` order, CHUNK_SIZE rows per query.
+
+	``key`` is one or two fields, the last of them unique.
+	"""
+	queryset = queryset.order_by(*key).values_list(*fields)
+	positions = [fields.index(field) for field in key]
+	rows = list(queryset[:CHUNK_SIZE])
+	while rows:
+		for row in rows:
+			yield row
+		if len(rows) < CHUNK_SIZE:
+			break
+		last = [rows[-1][position] for position in positions]
+		if len(key) == 1:
+			after = queryset.filter(**{key[0] + '__gt': last[0]})
+		else:
+			after = queryset.filter(Q(**{key[0] + '__gt': last[0]}) |
+									Q(**{key[0]: last[0], key[1] + '__gt': last[1]}))
+		rows = list(after[:CHUNK_SIZE])
+
+
+def _part(rows, part):
+	return itertools.islice(rows, (part - 1) * SHARD_SIZE, part * SHARD_SIZE)
+
+
+def post_entries(site, year, month, part=1):
+	"""[(path, last modified)] of a month's posts, oldest first."""
+	start, end = month_range(year, month)
+	posts = Post.objects.published().filter(site=site, pub_date__gte=start, pub_date__lt=end)
+	rows = _keyset(posts, ('pub_date', 'pk', 'slug', 'modified'), ('pub_date', 'pk'))
+	return [('/%d/%d/%s/' % (pub_date.year, pub_date.month, slug), modified)
+			for pub_date, pk, slug, modified in _part(rows, part)]
+
+
+def listing_entries(model, prefix, site, part=1):
+	rows = _keyset(listed(model, site), ('pk', 'slug'), ('pk',))
+	return [('/%s/%s/' % (prefix, slug), None) for pk, slug in _part(rows, part)]
+
+
+def page_entries(site):
+	rows = _keyset(FlatPage.objects.filter(sites=site, registration_required=False), ('pk', 'url'), ('pk',))
+	return [(url, None) for pk, url in rows]
+
+
+def _lastmod(modified):
+	return '<lastmod>%s</lastmod>' % modified.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def render_urlset(base, entries):
+	lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<urlset xmlns="%s">' % SITEMAP_NS]
+	for path, modified in entries:
+		lines.append('<url><loc>%s</loc>%s</url>' % (
+			escape(base + path), _lastmod(modified) if modified else ''))
+	lines.append('</urlset>')
+	return u'\n'.join(lines).encode('utf-8')
+
+
+def render_index(base, shards):
+	lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<sitemapindex xmlns="%s">' % SITEMAP_NS]
+	lines.extend('<sitemap><loc>%s/%s</loc></sitemap>' % (escape(base), name) for name in shards)
+	lines.append('</sitemapindex>')
+	return u'\n'.join(lines).encode('utf-8')
+
+
+def _cached_sitemap(request, dependencies, build):
+	"""Serve the document ``build()`` returns as (content, last modified), cached on ``dependencies``."""
+	key = request_key(request, 'sitemap')
+	page = get_cached(key)
+	if page is not None:
+		return cached_page_response(request, page)
+
+	versions = get_versions(dependencies)
+	content, last_modified = build()
+	page = {
+		'etag': make_etag(key, versions, next_publication()),
+		'last_modified': last_modified_of(versions, [last_modified]),
+		'content_type': CONTENT_TYPE,
+		'content': content,
+	}
+	set_cached(key, page, versions, publication_timeout())
+	if is_not_modified(request, page['etag'], page['last_modified']):
+		return set_validators(HttpResponseNotModified(), page)
+	return set_validators(HttpResponse(content, content_type=CONTENT_TYPE), page)
+
+
+def _base_url(site):
+	return 'http://%s' % site.domain
+
+
+def sitemap_index(request):
+	site = request_site(request)
+	dependencies = site_dependencies(site.pk, 'archive', 'post-list') + ['post-counts', 'flatpages']
+	return _cached_sitemap(request, dependencies,
+		lambda: (render_index(_base_url(site), sitemap_shards(site)), None))
+
+
+def sitemap_shard(request, kind, year=None, month=None, part=None):
+	site = request_site(request)
+	part = int(part or 1)
+	if kind == 'posts':
+		year, month = int(year), int(month)
+		if not 1 <= month <= 12:
+			raise Http404
+		dependencies = site_dependencies(site.pk, 'posts:%d-%d' % (year, month))
+		entries = lambda: post_entries(site, year, month, part)
+	elif kind == 'categories':
+		dependencies = ['post-counts'] + site_dependencies(site.pk, 'post-list')
+		entries = lambda: listing_entries(Category, 'category', site, part)
+	elif kind == 'tags':
+		dependencies = ['post-counts'] + site_dependencies(site.pk, 'post-list')
+		entries = lambda: listing_entries(Tag, 'tag', site, part)
+	else:
+		if part != 1:
+			raise Http404
+		dependencies = ['flatpages']
+		entries = lambda: page_entries(site)
+
+	def build():
+		found = entries()
+		if not found and part > 1:
+			raise Http404
+		dates = [modified for path, modified in found if modified]
+		return render_urlset(_base_url(site), found), max(dates) if dates else None
+	return _cached_sitemap(request, dependencies, build)
@@ -0,0 +1,72 @@
+import datetime
+import math
+from collections import Counter
+
+from django import template
+from django.contrib.sites.models import Site
+from django.db.models import Count
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from blogengine.cache import KEY_PREFIX, get_cached, get_versions, set_cached, site_dependencies
+from blogengine.counts import published_months, without_scheduled
+from blogengine.middleware import request_site, single_site
+from blogengine.models import Category, Post, Tag
+from blogengine.publishing import next_publication, publication_timeout
+
+register = template.Library()
+
+def site_counts(rows):
+	"""``rows`` ordered by name, with post_count the number of posts they were filtered on."""
+	rows = list(rows.annotate(posts=Count('post')).order_by('name'))
+	for row in rows:
+		row.post_count = row.posts
+	return rows
+
+@register.simple_tag(takes_context=True)
+def post_counts_sidebar(context):
+	"""Categories and a tag cloud counting the site's published posts, cached until a count changes."""
+	site = request_site(context['request']) if 'request' in context else Site.objects.get_current()
+	key = '%s:sidebar:%d' % (KEY_PREFIX, site.pk)
+	html = get_cached(key)
+	if html is None:
+		versions = get_versions(['post-counts'] + site_dependencies(site.pk, 'post-list'))
+		if single_site():
+			categories = list(Category.objects.filter(post_count__gt=0).order_by('name'))
+			tags = list(Tag.objects.filter(post_count__gt=0).order_by('name'))
+			if next_publication() is not None:
+				scheduled = Post.objects.filter(pub_date__gt=timezone.now())
+				categories = without_scheduled(categories, Counter(scheduled.values_list('category_id', flat=True)))
+				tags = without_scheduled(tags, Counter(Post.tags.through.objects.filter(
+					post__in=scheduled).values_list('tag_id', flat=True)))
+		else:
+			# The stored counts are of every site's posts
+			posts = Post.objects.published().for_site(site)
+			categories = site_counts(Category.objects.filter(post__in=posts))
+			tags = site_counts(Tag.objects.filter(post__in=posts))
+		most = max([tag.post_count for tag in tags] or [1])
+		for tag in tags:
+			# Font size from 1em to 2em, on a log scale
+			tag.size = '%.1f' % (1 + (math.log(tag.post_count) / math.log(most) if most > 1 else 0))
+		html = render_to_string('blogengine/includes/sidebar.html', {
+			'categories': categories,
+			'tags': tags,
+		})
+		set_cached(key, html, versions, publication_timeout())
+	return mark_safe(html)
+
+@register.simple_tag(takes_context=True)
+def archive_widget(context):
+	"""Months of the request's site with their published post counts, cached until one changes."""
+	site = request_site(context['request']) if 'request' in context else Site.objects.get_current()
+	key = '%s:archive:%d' % (KEY_PREFIX, site.pk)
+	html = get_cached(key)
+	if html is None:
+		versions = get_versions(site_dependencies(site.pk, 'archive'))
+		months = published_months(site)
+		for month in months:
+			month.date = datetime.date(month.year, month.month, 1)
+		html = render_to_string('blogengine/includes/archive.html', {'months': months})
+		set_cached(key, html, versions, publication_timeout())
+	return mark_safe(html)
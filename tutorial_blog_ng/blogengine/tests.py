@@ -1,15 +1,55 @@
 from django.test import TestCase, LiveServerTestCase, Client
+from django.core.management import call_command
 from django.utils import timezone
-from blogengine.models import Post, Category, Tag
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from StringIO import StringIO
+import calendar
+import json
+import os
+import random
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+from blogengine.models import Post, Category, Tag, ArchiveMonth, RelatedPost, SearchPosting, SearchTerm
 import markdown
 from django.contrib.flatpages.models import FlatPage
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 import feedparser
+from django.core.urlresolvers import resolve
+from blogengine import benchmark, routers, sitemaps, timing
+from blogengine import search as search_module
+from blogengine.cache import CACHE_TIMEOUT, invalidate
+from blogengine.management.commands import importposts
+from blogengine.middleware import PIN_COOKIE, site_for_host
+from blogengine.markup import RenderCache, render_cache, render_markdown
+from blogengine.publishing import next_publication, publication_timeout
+from blogengine.records import post_records
+from blogengine.search import search
+from south.migration import Migrations
+
+@contextmanager
+def frozen_now(moment):
+    # timezone.now() and time.time(), which the cache expires entries by, are
+    # looked up on their modules by every caller
+    now, clock = timezone.now, time.time
+    timezone.now = lambda: moment
+    time.time = lambda: calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+    try:
+        yield
+    finally:
+        timezone.now, time.time = now, clock
 
 class BaseAcceptanceTest(LiveServerTestCase):
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
 class PostTest(TestCase):
     def test_create_category(self):
@@ -132,6 +172,75 @@ class PostTest(TestCase):
         self.assertEquals(only_post_tag.name, 'python')
         self.assertEquals(only_post_tag.description, 'The Python programming language')
 
+    def test_post_stores_rendered_html(self):
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+
+        post = Post()
+        post.title = 'My first post'
+        post.text = 'This is [my first blog post](http://127.0.0.1:8000/)'
+        post.slug = 'my-first-post'
+        post.pub_date = timezone.now()
+        post.author = author
+        post.site = site
+        post.save()
+
+        # Check the HTML was rendered on save
+        only_post = Post.objects.all()[0]
+        self.assertEquals(only_post.text_html, markdown.markdown(post.text))
+
+        # Check it is re-rendered when the text changes
+        only_post.text = 'This is my *edited* post'
+        only_post.save()
+        self.assertTrue('<em>edited</em>' in Post.objects.all()[0].text_html)
+
+    def test_migration_renders_older_posts(self):
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        for i in range(3):
+            Post.objects.create(title='Post %d' % i, text='Post *number* %d' % i, slug='post-%d' % i,
+                                pub_date=timezone.now(), author=author, site=Site.objects.get_current())
+        # As left by 0009, without the save signals
+        Post.objects.update(text_html='')
+        modified = dict(Post.objects.values_list('pk', 'modified'))
+
+        migration = Migrations('blogengine').migration('0019_render_post_html')
+        migration.migration_instance().forwards(migration.orm())
+        for post in Post.objects.all():
+            self.assertEquals(post.text_html, render_markdown(post.text, use_cache=False))
+            self.assertTrue('<em>number</em>' in post.text_html)
+            # Rendering the text it had all along is no change to the post
+            self.assertEquals(post.modified, modified[post.pk])
+
+
+class MarkdownCacheTest(TestCase):
+    def setUp(self):
+        render_cache.clear()
+
+    def test_repeated_render_is_cached(self):
+        # Render the same text twice
+        html = render_markdown('This is *my* post')
+        self.assertEquals(render_markdown('This is *my* post'), html)
+        self.assertEquals(html, markdown.markdown('This is *my* post'))
+
+        # Check the second render came from the cache
+        stats = render_cache.stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['entries'], 1)
+
+    def test_cache_is_bounded(self):
+        cache = RenderCache(100)
+        cache.set('a', u'x' * 20)
+        cache.set('b', u'y' * 20)
+        cache.set('c', u'z' * 20)
+
+        # Check the least recently used entry was evicted
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('c'), u'z' * 20)
+        stats = cache.stats()
+        self.assertTrue(stats['bytes'] <= 100)
+        self.assertEquals(stats['evictions'], 1)
+
 
 class AdminTest(BaseAcceptanceTest):
     fixtures = ['users.json']
@@ -487,6 +596,240 @@ class AdminTest(BaseAcceptanceTest):
         self.assertEquals(len(all_tags), 0)
 
 
+class AdminChangeListTest(BaseAcceptanceTest):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        super(AdminChangeListTest, self).setUp()
+        author = User.objects.get(username='bobsmith')
+        site = Site.objects.get_current()
+        self.category = Category(name='python', description='Python')
+        self.category.save()
+        self.tag = Tag(name='django', description='Django')
+        self.tag.save()
+
+        # 55 posts in June 2014, one a day back from the 30th, the last five in May
+        for i in range(55):
+            post = Post.objects.create(title='Post number %d' % i, text='This is post %d' % i,
+                                       slug='post-number-%d' % i, author=author, site=site,
+                                       pub_date=datetime(2014, 6, 30, 12, tzinfo=timezone.utc) - timedelta(days=i),
+                                       category=self.category if i % 5 == 0 else None)
+            if i % 11 == 0:
+                post.tags.add(self.tag)
+        self.client.login(username='bobsmith', password='password')
+
+    def titles(self, query=''):
+        response = self.client.get('/admin/blogengine/post/' + query)
+        self.assertEquals(response.status_code, 200)
+        return [post.title for post in response.context['cl'].result_list]
+
+    def test_changelist(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/blogengine/post/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('55 posts' in response.content)
+        # Counted from ArchiveMonth, and the rows come with their relations
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+        self.assertEquals(len(response.context['cl'].result_list), 50)
+
+        # The second page seeks from the end of the first
+        self.assertEquals(self.titles('?p=1'), ['Post number %d' % i for i in range(50, 55)])
+        # Other orderings are paged by offset
+        self.assertEquals(self.titles('?p=1&o=2'), ['Post number %d' % i for i in range(4, -1, -1)])
+
+    def test_archive_months_behind(self):
+        author = User.objects.get(username='bobsmith')
+        for i in range(55, 120):
+            Post.objects.create(title='Post number %d' % i, text='This is post %d' % i,
+                                slug='post-number-%d' % i, author=author, site=Site.objects.get_current(),
+                                pub_date=datetime(2014, 6, 30, 12, tzinfo=timezone.utc) - timedelta(days=i))
+
+        # Nothing stored yet, so the posts are counted
+        ArchiveMonth.objects.all().delete()
+        response = self.client.get('/admin/blogengine/post/')
+        self.assertTrue('120 posts' in response.content)
+        self.assertEquals(len(response.context['cl'].result_list), 50)
+
+        # Only June stored, an undercount still pages and is corrected by the rows seen
+        ArchiveMonth.objects.create(site=Site.objects.get_current(), year=2014, month=6, post_count=30)
+        response = self.client.get('/admin/blogengine/post/')
+        self.assertTrue('120 posts' in response.content)
+        self.assertEquals(len(response.context['cl'].result_list), 50)
+        self.assertEquals(self.titles('?p=2'), ['Post number %d' % i for i in range(100, 120)])
+
+    def test_filters(self):
+        self.assertEquals(len(self.titles('?category__id__exact=%d' % self.category.pk)), 11)
+        self.assertEquals(self.titles('?tag=%d' % self.tag.pk),
+                          ['Post number %d' % i for i in (0, 11, 22, 33, 44)])
+        self.assertEquals(len(self.titles('?published=2014-05')), 25)
+        response = self.client.get('/admin/blogengine/post/?published=2014')
+        self.assertEquals(response.context['cl'].result_count, 55)
+        response = self.client.get('/admin/blogengine/post/?published=2014-06')
+        self.assertTrue('30 posts' in response.content)
+        self.assertTrue('June 2014' in response.content)
+
+        # The cached count follows changes to the posts
+        Post.objects.get(slug='post-number-1').delete()
+        response = self.client.get('/admin/blogengine/post/?published=2014-06')
+        self.assertTrue('29 posts' in response.content)
+
+class BulkActionTest(BaseAcceptanceTest):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        super(BulkActionTest, self).setUp()
+        author = User.objects.get(username='bobsmith')
+        self.site = Site.objects.get_current()
+        self.python = Category(name='python', description='Python')
+        self.python.save()
+        self.django = Category(name='django', description='Django')
+        self.django.save()
+        self.tag = Tag(name='web', description='The web')
+        self.tag.save()
+        self.posts = []
+        for i in range(6):
+            post = Post.objects.create(title='Post number %d' % i, text='Something about snakes %d' % i,
+                                       slug='post-number-%d' % i, author=author, site=self.site,
+                                       pub_date=datetime(2014, 6, 10 + i, tzinfo=timezone.utc),
+                                       category=self.python)
+            self.posts.append(post)
+        self.client.login(username='bobsmith', password='password')
+
+    def run_action(self, action, posts, **data):
+        data.update({'action': action, 'index': 0,
+                     '_selected_action': [post.pk for post in posts]})
+        return self.client.post('/admin/blogengine/post/', data, follow=True)
+
+    def assertCountsReconciled(self):
+        out = StringIO()
+        call_command('reconcilecounts', stdout=out)
+        self.assertEquals(out.getvalue().strip(), 'Fixed 0 categories, 0 tags and 0 archive months.')
+
+    def test_set_category(self):
+        self.client.get(self.django.get_absolute_url())
+        response = self.run_action('set_category', self.posts[:4], category=self.django.pk)
+        self.assertTrue('Moved 4 posts to django.' in response.content)
+        self.assertEquals(Post.objects.filter(category=self.django).count(), 4)
+        self.assertEquals(Category.objects.get(pk=self.django.pk).post_count, 4)
+        self.assertEquals(Category.objects.get(pk=self.python.pk).post_count, 2)
+        self.assertTrue('Post number 3' in self.client.get(self.django.get_absolute_url()).content)
+        self.assertCountsReconciled()
+
+        response = self.run_action('set_category', self.posts[:4])
+        self.assertTrue('Choose a category for this action.' in response.content)
+
+    def test_tags(self):
+        response = self.run_action('add_tag', self.posts[:3], tag='web')
+        self.assertTrue('Tagged 3 posts with web.' in response.content)
+        response = self.run_action('add_tag', self.posts[:4], tag='web')
+        self.assertTrue('Tagged 1 posts with web.' in response.content)
+        self.assertEquals(Tag.objects.get(pk=self.tag.pk).post_count, 4)
+        # The newly tagged posts are related to each other
+        self.assertEquals(RelatedPost.objects.filter(post=self.posts[0]).count(), 3)
+
+        response = self.run_action('remove_tag', self.posts[2:], tag='web')
+        self.assertTrue('Removed web from 2 posts.' in response.content)
+        self.assertEquals(sorted(self.tag.post_set.values_list('pk', flat=True)),
+                          [self.posts[0].pk, self.posts[1].pk])
+        self.assertEquals(list(RelatedPost.objects.filter(post=self.posts[0]).values_list('related', flat=True)),
+                          [self.posts[1].pk])
+        self.assertCountsReconciled()
+
+        response = self.run_action('add_tag', self.posts, tag='nonexistent')
+        self.assertTrue('No single tag called nonexistent' in response.content)
+
+    def test_move_to_site(self):
+        other = Site.objects.create(name='other.com', domain='other.com')
+        response = self.run_action('move_to_site', self.posts[:2], site=other.pk)
+        self.assertTrue('Moved 2 posts to other.com.' in response.content)
+        self.assertEquals(ArchiveMonth.objects.get(site=other, year=2014, month=6).post_count, 2)
+        self.assertEquals(ArchiveMonth.objects.get(site=self.site, year=2014, month=6).post_count, 4)
+        self.assertCountsReconciled()
+
+    def test_delete_posts(self):
+        self.tag.post_set.add(*self.posts)
+        self.assertEquals(len(search('snakes')), 6)
+        response = self.run_action('delete_posts', self.posts[:4])
+        self.assertTrue('Delete 4 posts?' in response.content)
+        self.assertEquals(Post.objects.count(), 6)
+
+        response = self.run_action('delete_posts', self.posts[:4], post='yes')
+        self.assertTrue('Deleted 4 posts.' in response.content)
+        self.assertEquals(list(Post.objects.order_by('pk').values_list('title', flat=True)),
+                          ['Post number 4', 'Post number 5'])
+        self.assertEquals(sorted(search('snakes')), [self.posts[4].pk, self.posts[5].pk])
+        self.assertEquals(SearchTerm.objects.get(term='snakes').doc_count, 2)
+        self.assertEquals(list(RelatedPost.objects.filter(post=self.posts[4]).values_list('related', flat=True)),
+                          [self.posts[5].pk])
+        self.assertFalse('Post number 0' in self.client.get('/').content)
+        self.assertCountsReconciled()
+
+class ScheduledPostTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ScheduledPostTest, self).setUp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        self.category = Category(name='python', description='Python')
+        self.category.save()
+        self.published = Post.objects.create(title='Published post', text='Out already', slug='published',
+                                             author=author, site=Site.objects.get_current(), category=self.category,
+                                             pub_date=timezone.now() - timedelta(days=1))
+        self.scheduled = Post.objects.create(title='Scheduled post', text='Not out yet', slug='scheduled',
+                                             author=author, site=Site.objects.get_current(), category=self.category,
+                                             pub_date=timezone.now() + timedelta(hours=1))
+
+    def test_scheduled_posts_hidden(self):
+        for url in ('/', self.category.get_absolute_url(), '/feeds/posts/', '/search/?q=out'):
+            content = self.client.get(url).content
+            self.assertTrue('Published post' in content)
+            self.assertFalse('Scheduled post' in content)
+        self.assertEquals(self.client.get(self.scheduled.get_absolute_url()).status_code, 404)
+        self.assertEquals(list(Post.objects.published()), [self.published])
+
+    def test_cache_timeout(self):
+        self.assertTrue(3590 < publication_timeout() <= 3600)
+        self.scheduled.pub_date = timezone.now() - timedelta(hours=1)
+        self.scheduled.save()
+        self.assertEquals(publication_timeout(), CACHE_TIMEOUT)
+
+    def test_goes_live_without_invalidation(self):
+        # The cached index must flip without anything being invalidated
+        response = self.client.get('/')
+        self.assertFalse('Scheduled post' in response.content)
+        etag = response['ETag']
+        self.assertEquals(self.client.get('/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with frozen_now(self.scheduled.pub_date + timedelta(seconds=1)):
+            response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Scheduled post' in response.content)
+
+    def test_counts_leave_out_scheduled_posts(self):
+        tag = Tag(name='django', description='Django')
+        tag.save()
+        self.scheduled.tags.add(tag)
+        # In a month of its own
+        self.scheduled.pub_date = timezone.now() + timedelta(days=40)
+        self.scheduled.save()
+        month = '%s</a> (1)' % self.scheduled.pub_date.strftime('%B %Y')
+        content = self.client.get('/').content
+        self.assertTrue('python</a> (1)' in content)
+        self.assertFalse('django</a>' in content)
+        self.assertFalse(month in content)
+
+        # Check the cached widgets count it once it is out
+        with frozen_now(self.scheduled.pub_date + timedelta(minutes=1)):
+            content = self.client.get('/').content
+            self.assertTrue('python</a> (2)' in content)
+            self.assertTrue('django</a>' in content)
+            self.assertTrue(month in content)
+
+            # And that they leave it out again when it is put off
+            self.scheduled.pub_date = timezone.now() + timedelta(days=1)
+            self.scheduled.save()
+            content = self.client.get('/').content
+            self.assertTrue('python</a> (1)' in content)
+            self.assertFalse('django</a>' in content)
+
 class PostViewTest(BaseAcceptanceTest):
     def test_index(self):
         #create the category
@@ -506,11 +849,8 @@ class PostViewTest(BaseAcceptanceTest):
         author = User.objects.create_user('testuser', 'user@example.com', 'password')
         author.save()
 
-        #create the site
-        site = Site()
-        site.name = 'example.com'
-        site.domain = 'example.com'
-        site.save()
+        # Use the site the test client requests, views only show its posts
+        site = Site.objects.get_current()
 
         #create the post
         post = Post()
@@ -569,11 +909,8 @@ class PostViewTest(BaseAcceptanceTest):
         author = User.objects.create_user('testuser', 'user@example.com', 'password')
         author.save()
         
-        #create the site
-        site = Site()
-        site.name = 'example.com'
-        site.domain = 'example.com'
-        site.save()
+        # Use the site the test client requests, views only show its posts
+        site = Site.objects.get_current()
 
         #create the post
         post = Post()
@@ -610,6 +947,10 @@ class PostViewTest(BaseAcceptanceTest):
         # Check the post tag is in the response
         post_tag = all_posts[0].tags.all()[0]
         self.assertTrue(post_tag.name in response.content)
+        self.assertTrue('href="%s"' % post_tag.get_absolute_url() in response.content)
+
+        # Check the share links point at the post on its site
+        self.assertTrue('data-href="http://%s%s"' % (post.site, post_url) in response.content)
 
 
         #check the post text is in the response
@@ -622,6 +963,29 @@ class PostViewTest(BaseAcceptanceTest):
 
         self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in response.content)       
 
+    def test_post_page_wrong_date_redirects(self):
+        # Create the author
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+
+        # Create the post
+        post = Post()
+        post.title = 'My first post'
+        post.text = 'This is my first blog post'
+        post.slug = 'my-first-post'
+        post.pub_date = timezone.now()
+        post.author = author
+        post.site = Site.objects.all()[0]
+        post.save()
+
+        # Fetch the post under the wrong year and month
+        response = self.client.get('/%d/%d/my-first-post/' % (post.pub_date.year - 1, post.pub_date.month))
+        self.assertEquals(response.status_code, 301)
+        self.assertTrue(response['Location'].endswith(post.get_absolute_url()))
+
+        # Check an unknown slug is not found
+        response = self.client.get('/%d/%d/no-such-post/' % (post.pub_date.year, post.pub_date.month))
+        self.assertEquals(response.status_code, 404)
+
     def test_category_page(self):
         # Create the category
         category = Category()
@@ -633,11 +997,8 @@ class PostViewTest(BaseAcceptanceTest):
         author = User.objects.create_user('testuser', 'user@example.com', 'password')
         author.save()
 
-        # Create the site
-        site = Site()
-        site.name = 'example.com'
-        site.domain = 'example.com'
-        site.save()
+        # Use the site the test client requests, views only show its posts
+        site = Site.objects.get_current()
 
         # Create the post
         post = Post()
@@ -688,11 +1049,8 @@ class PostViewTest(BaseAcceptanceTest):
         author = User.objects.create_user('testuser', 'user@example.com', 'password')
         author.save()
 
-        # Create the site
-        site = Site()
-        site.name = 'example.com'
-        site.domain = 'example.com'
-        site.save()
+        # Use the site the test client requests, views only show its posts
+        site = Site.objects.get_current()
 
         # Create the post
         post = Post()
@@ -744,6 +1102,1122 @@ class PostViewTest(BaseAcceptanceTest):
         self.assertEquals(response.status_code, 200)
         self.assertTrue('No posts found' in response.content)
 
+class QueryBudgetTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(QueryBudgetTest, self).setUp()
+
+        # Create the author and site, the current site is looked up once per process
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.get_current()
+
+        # Create posts spread over two categories and three tags
+        self.category = Category(name='python', description='The Python programming language')
+        self.category.save()
+        other_category = Category(name='perl', description='The Perl programming language')
+        other_category.save()
+        tags = []
+        for name in ('django', 'flask', 'web'):
+            tag = Tag(name=name, description=name)
+            tag.save()
+            tags.append(tag)
+        self.tag = tags[-1]
+
+        for i in range(5):
+            post = Post()
+            post.title = 'Post number %d' % i
+            post.text = 'This is post *%d*' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = timezone.now()
+            post.author = author
+            post.site = site
+            post.category = (self.category, other_category)[i % 2]
+            post.save()
+            post.tags.add(self.tag, tags[i % 2])
+
+        # Like the current site and the host -> site map, the next scheduled post
+        # is looked up once and cached
+        site_for_host('testserver')
+        next_publication()
+
+    def test_index_query_budget(self):
+        # page of posts, tags for the page, sidebar categories, tags and months
+        with self.assertNumQueries(5):
+            response = self.client.get('/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post number 4' in response.content)
+
+    def test_category_query_budget(self):
+        # category, page of posts, tags for the page, sidebar categories, tags and months
+        with self.assertNumQueries(6):
+            response = self.client.get(self.category.get_absolute_url())
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post number 4' in response.content)
+
+    def test_tag_query_budget(self):
+        # tag, page of posts, tags for the page, sidebar categories, tags and months
+        with self.assertNumQueries(6):
+            response = self.client.get(self.tag.get_absolute_url())
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post number 4' in response.content)
+
+class PostCountTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(PostCountTest, self).setUp()
+        self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        self.site = Site.objects.all()[0]
+        self.python = Category(name='python', description='The Python programming language')
+        self.python.save()
+        self.perl = Category(name='perl', description='The Perl programming language')
+        self.perl.save()
+        self.django = Tag(name='django', description='The Django framework')
+        self.django.save()
+        self.flask = Tag(name='flask', description='The Flask framework')
+        self.flask.save()
+
+    def create_post(self, number, category):
+        post = Post()
+        post.title = 'Post number %d' % number
+        post.text = 'This is post %d' % number
+        post.slug = 'post-number-%d' % number
+        post.pub_date = timezone.now()
+        post.author = self.author
+        post.site = self.site
+        post.category = category
+        post.save()
+        return post
+
+    def assertCounts(self, python, perl, django, flask):
+        self.assertEquals(Category.objects.get(pk=self.python.pk).post_count, python)
+        self.assertEquals(Category.objects.get(pk=self.perl.pk).post_count, perl)
+        self.assertEquals(Tag.objects.get(pk=self.django.pk).post_count, django)
+        self.assertEquals(Tag.objects.get(pk=self.flask.pk).post_count, flask)
+
+    def test_counts_follow_posts(self):
+        first = self.create_post(1, self.python)
+        second = self.create_post(2, self.python)
+        first.tags.add(self.django, self.flask)
+        second.tags.add(self.django)
+        self.assertCounts(2, 0, 2, 1)
+
+        # Move a post, untag it and tag it from the other side
+        second.category = self.perl
+        second.save()
+        second.tags.remove(self.django, self.flask)
+        self.flask.post_set.add(second)
+        self.assertCounts(1, 1, 1, 2)
+
+        # Saving a category doesn't overwrite its count
+        self.perl.description = 'Still around'
+        self.perl.save()
+        self.assertCounts(1, 1, 1, 2)
+
+        # Clear and delete
+        self.flask.post_set.clear()
+        first.delete()
+        self.assertCounts(0, 1, 0, 0)
+
+    def test_reconcile_and_display(self):
+        post = self.create_post(1, self.python)
+        post.tags.add(self.django)
+
+        # Break the counts behind the ORM's back, then repair them
+        Category.objects.update(post_count=7)
+        out = StringIO()
+        call_command('reconcilecounts', stdout=out)
+        self.assertEquals(out.getvalue().strip(), 'Fixed 2 categories, 0 tags and 0 archive months.')
+        self.assertCounts(1, 0, 1, 0)
+
+        # Check the sidebar and the listing show the counts
+        response = self.client.get(self.python.get_absolute_url())
+        self.assertEquals(response.context['paginator'].count, 1)
+        self.assertTrue('1 post</p>' in response.content)
+        self.assertTrue('python</a> (1)' in response.content)
+        self.assertFalse('perl</a>' in response.content)
+
+        # Check a new post updates the cached sidebar
+        self.create_post(2, self.perl)
+        self.assertTrue('perl</a> (1)' in self.client.get('/').content)
+
+    def test_sidebar_counts_per_site(self):
+        other = Site.objects.create(domain='other.com', name='other.com')
+        first = self.create_post(1, self.python)
+        first.tags.add(self.django)
+        second = self.create_post(2, self.perl)
+        second.site = other
+        second.save()
+        second.tags.add(self.flask)
+
+        content = self.client.get('/').content
+        self.assertTrue('python</a> (1)' in content)
+        self.assertTrue('django</a>' in content)
+        self.assertFalse('perl</a>' in content)
+        self.assertFalse('flask</a>' in content)
+        content = self.client.get('/', HTTP_HOST='other.com').content
+        self.assertTrue('perl</a> (1)' in content)
+        self.assertTrue('flask</a>' in content)
+        self.assertFalse('python</a>' in content)
+
+        # Move a post across, check both sidebars follow
+        first.site = other
+        first.save()
+        self.assertFalse('python</a>' in self.client.get('/').content)
+        self.assertTrue('python</a> (1)' in self.client.get('/', HTTP_HOST='other.com').content)
+
+class ArchiveTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+
+        # Create posts in May and June 2014 and one in 2013
+        self.posts = []
+        for i, (year, month) in enumerate([(2014, 6), (2014, 6), (2014, 5), (2013, 12)]):
+            post = Post()
+            post.title = 'Post number %d' % i
+            post.text = 'This is post %d' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = datetime(year, month, 10, 12, tzinfo=timezone.utc)
+            post.author = author
+            post.site = site
+            post.save()
+            self.posts.append(post)
+
+    def titles(self, url):
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return sorted(post.title for post in response.context['object_list'])
+
+    def test_archive_pages(self):
+        self.assertEquals(self.titles('/2014/'), ['Post number 0', 'Post number 1', 'Post number 2'])
+        self.assertEquals(self.titles('/2014/6/'), ['Post number 0', 'Post number 1'])
+        self.assertEquals(self.titles('/2013/12'), ['Post number 3'])
+        self.assertEquals(self.titles('/2014/7/'), [])
+        self.assertEquals(self.client.get('/2014/13/').status_code, 404)
+
+        # Move a post to another month, check both months are rebuilt
+        self.posts[0].pub_date = datetime(2014, 5, 1, tzinfo=timezone.utc)
+        self.posts[0].save()
+        self.assertEquals(self.titles('/2014/6/'), ['Post number 1'])
+        self.assertEquals(self.titles('/2014/5/'), ['Post number 0', 'Post number 2'])
+
+    def test_archive_widget(self):
+        content = self.client.get('/').content
+        self.assertTrue('<a href="/2014/6/">June 2014</a> (2)' in content)
+        self.assertTrue('<a href="/2013/12/">December 2013</a> (1)' in content)
+
+        # Delete a post and check its month is counted down
+        self.posts[3].delete()
+        content = self.client.get('/').content
+        self.assertFalse('December 2013' in content)
+        self.assertEquals(ArchiveMonth.objects.get(year=2013, month=12).post_count, 0)
+
+        # Break the counts and check they are repaired
+        ArchiveMonth.objects.all().delete()
+        out = StringIO()
+        call_command('reconcilecounts', stdout=out)
+        self.assertEquals(out.getvalue().strip(), 'Fixed 0 categories, 0 tags and 2 archive months.')
+        self.assertEquals(sorted(ArchiveMonth.objects.values_list('year', 'month', 'post_count')),
+                          [(2014, 5, 1), (2014, 6, 2)])
+
+class RelatedPostTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(RelatedPostTest, self).setUp()
+        self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        self.site = Site.objects.all()[0]
+        self.tags = {}
+        for name in ('django', 'python', 'web', 'cooking'):
+            self.tags[name] = Tag(name=name, description=name)
+            self.tags[name].save()
+
+        # Create posts with overlapping tags
+        self.posts = []
+        for i, names in enumerate([('django', 'python'), ('django', 'python', 'web'), ('django',), ('cooking',)]):
+            self.posts.append(self.create_post(i, names))
+
+    def create_post(self, number, tags, site=None, pub_date=None):
+        post = Post()
+        post.title = 'Post number %d' % number
+        post.text = 'This is post %d' % number
+        post.slug = 'post-number-%d' % number
+        post.pub_date = pub_date or timezone.now()
+        post.author = self.author
+        post.site = site or self.site
+        post.save()
+        post.tags.add(*[self.tags[name] for name in tags])
+        return post
+
+    def related(self):
+        related = {}
+        for post in self.posts:
+            related[post.pk] = list(RelatedPost.objects.filter(post=post).values_list('related', flat=True))
+        return related
+
+    def test_related_posts(self):
+        first, second, third, fourth = [post.pk for post in self.posts]
+        self.assertEquals(self.related(), {
+            first: [second, third],
+            second: [first, third],
+            third: [first, second],
+            fourth: [],
+        })
+
+        # Retag and delete, check the incremental updates match a full recompute
+        self.posts[3].tags.add(self.tags['web'])
+        self.tags['python'].post_set.remove(self.posts[0])
+        self.posts[2].delete()
+        self.posts = self.posts[:2] + self.posts[3:]
+        incremental = self.related()
+        self.assertEquals(incremental[fourth], [second])
+        call_command('computerelated', stdout=StringIO())
+        self.assertEquals(self.related(), incremental)
+
+    def test_only_published_posts_on_the_site(self):
+        first, second, third, fourth = [post.pk for post in self.posts]
+        other_site = Site.objects.create(domain='other.example.com', name='other')
+        elsewhere = self.create_post(4, ('django', 'python', 'web'), site=other_site)
+        scheduled = self.create_post(5, ('django', 'python', 'web'), pub_date=timezone.now() + timedelta(hours=1))
+        related = self.related()
+        self.assertEquals(related[second], [first, third])
+        self.assertEquals(list(RelatedPost.objects.filter(post=elsewhere)), [])
+        self.assertEquals(list(RelatedPost.objects.filter(post=scheduled).values_list('related', flat=True)),
+                          [second, first, third])
+
+        # Check the scheduled post enters the lists when it goes live
+        next_publication()
+        with frozen_now(scheduled.pub_date + timedelta(minutes=1)):
+            self.assertEquals(next_publication(), None)
+            incremental = self.related()
+            self.assertEquals(incremental[second], [scheduled.pk, first, third])
+            call_command('computerelated', stdout=StringIO())
+            self.assertEquals(self.related(), incremental)
+
+        # Check moving a post away takes it out of the lists
+        self.posts[1].site = other_site
+        self.posts[1].save()
+        self.assertEquals(self.related()[first], [third])
+
+    def test_post_page_shows_related_posts(self):
+        url = self.posts[0].get_absolute_url()
+        response = self.client.get(url)
+        self.assertEquals([post.title for post in response.context['related_posts']],
+                          ['Post number 1', 'Post number 2'])
+        self.assertTrue('Related posts' in response.content)
+
+        # Rename a related post, check the cached page is rebuilt
+        self.posts[1].title = 'A renamed post'
+        self.posts[1].save()
+        self.assertTrue('A renamed post' in self.client.get(url).content)
+
+class PaginationTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+        now = timezone.now()
+
+        # Create twelve posts, an hour apart, two sharing a timestamp
+        for i in range(12):
+            post = Post()
+            post.title = 'Post number %d' % i
+            post.text = 'This is post %d' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = now - timedelta(hours=min(i, 10))
+            post.author = author
+            post.site = site
+            post.save()
+
+    def titles(self, response):
+        return [post.title for post in response.context['object_list']]
+
+    def test_older_and_newer_links(self):
+        # Fetch the first page
+        response = self.client.get('/')
+        self.assertEquals(self.titles(response), ['Post number %d' % i for i in range(5)])
+        self.assertFalse(response.context['page_obj'].has_previous())
+        self.assertTrue('Older Posts' in response.content)
+
+        # Follow the older links to the end
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get('/?after=%s' % cursor)
+        self.assertEquals(self.titles(response), ['Post number %d' % i for i in range(5, 10)])
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get('/?after=%s' % cursor)
+        self.assertEquals(self.titles(response), ['Post number 11', 'Post number 10'])
+        self.assertFalse(response.context['page_obj'].has_next())
+
+        # Walk back with the newer link
+        cursor = response.context['page_obj'].previous_cursor
+        response = self.client.get('/?before=%s' % cursor)
+        self.assertEquals(self.titles(response), ['Post number %d' % i for i in range(5, 10)])
+        self.assertTrue('Newer Posts' in response.content)
+
+    def test_numbered_page_redirects(self):
+        # Check a numbered page redirects to its cursor
+        response = self.client.get('/2/')
+        self.assertEquals(response.status_code, 302)
+        response = self.client.get('/2/', follow=True)
+        self.assertEquals(self.titles(response), ['Post number %d' % i for i in range(5, 10)])
+
+        # Check pages past the end and bad cursors are not found
+        self.assertEquals(self.client.get('/4/').status_code, 404)
+        self.assertEquals(self.client.get('/?after=blah').status_code, 404)
+
+class PageCacheTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+
+        # Create a post in each of two categories
+        self.python = Category(name='python', description='The Python programming language')
+        self.python.save()
+        self.perl = Category(name='perl', description='The Perl programming language')
+        self.perl.save()
+        self.tag = Tag(name='django', description='The Django framework')
+        self.tag.save()
+        self.posts = []
+        for category in (self.python, self.perl):
+            post = Post()
+            post.title = 'A %s post' % category.name
+            post.text = 'All about %s' % category.name
+            post.slug = '%s-post' % category.name
+            post.pub_date = timezone.now()
+            post.author = author
+            post.site = site
+            post.category = category
+            post.save()
+            self.posts.append(post)
+        self.posts[0].tags.add(self.tag)
+
+    def test_pages_are_cached(self):
+        urls = ['/', self.posts[0].get_absolute_url(),
+                self.python.get_absolute_url(), self.tag.get_absolute_url()]
+        for url in urls:
+            self.client.get(url)
+
+        # Check every page is now served from the cache
+        with self.assertNumQueries(0):
+            for url in urls:
+                response = self.client.get(url)
+                self.assertEquals(response.status_code, 200)
+                self.assertTrue('A python post' in response.content)
+
+    def test_only_dependent_pages_are_invalidated(self):
+        python_post_url = self.posts[0].get_absolute_url()
+        self.client.get(python_post_url)
+        self.client.get(self.python.get_absolute_url())
+
+        # Edit the perl post and check the python pages are still cached
+        self.posts[1].title = 'An edited perl post'
+        self.posts[1].save()
+        with self.assertNumQueries(0):
+            self.client.get(python_post_url)
+            self.client.get(self.python.get_absolute_url())
+
+        # Rename the category and check both pages showing it are rebuilt
+        self.python.name = 'python3'
+        self.python.save()
+        self.assertTrue('python3' in self.client.get(python_post_url).content)
+        self.assertTrue('python3' in self.client.get(self.python.get_absolute_url()).content)
+
+        # Untag the post and check its page is rebuilt
+        self.posts[0].tags.remove(self.tag)
+        self.assertFalse('/tag/django/' in self.client.get(python_post_url).content)
+
+    def test_new_post_invalidates_index(self):
+        self.client.get('/')
+
+        # Add a post and check it appears
+        post = Post()
+        post.title = 'A brand new post'
+        post.text = 'Just published'
+        post.slug = 'a-brand-new-post'
+        post.pub_date = timezone.now()
+        post.author = self.posts[0].author
+        post.site = self.posts[0].site
+        post.save()
+        self.assertTrue('A brand new post' in self.client.get('/').content)
+
+        # Delete it and check it is gone
+        post.delete()
+        self.assertFalse('A brand new post' in self.client.get('/').content)
+
+    def test_conditional_get(self):
+        etags = {}
+        for url in ('/', self.posts[0].get_absolute_url(), '/feeds/posts/'):
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            etag = etags[url] = response['ETag']
+
+            # Check a matching ETag or date gets a 304 with no body
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 304)
+            self.assertEquals(response.content, '')
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEquals(response.status_code, 304)
+
+        # Edit the post and check the old ETag no longer matches
+        self.posts[0].title = 'An edited python post'
+        self.posts[0].save()
+        for url in ('/', self.posts[0].get_absolute_url(), '/feeds/posts/'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue('An edited python post' in response.content)
+
+    def test_if_modified_since_covers_what_else_is_shown(self):
+        url = self.python.get_absolute_url()
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEquals(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        # A post in another category changes the sidebar counts
+        with frozen_now(timezone.now() + timedelta(seconds=10)):
+            Post.objects.create(title='Another perl post', text='More perl', slug='another-perl-post',
+                                author=self.posts[1].author, site=self.posts[1].site, category=self.perl,
+                                pub_date=timezone.now() - timedelta(seconds=5))
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue('perl</a> (2)' in response.content)
+            last_modified = response['Last-Modified']
+
+        # And so does renaming the category
+        with frozen_now(timezone.now() + timedelta(seconds=20)):
+            self.python.name = 'python3'
+            self.python.save()
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue('python3' in response.content)
+
+    def test_rerendered_posts_are_invalidated(self):
+        post = self.posts[0]
+        url = post.get_absolute_url()
+        # HTML from an older renderer, written without the save signals
+        Post.objects.filter(pk=post.pk).update(text_html='<p>Old HTML</p>')
+        response = self.client.get(url)
+        self.assertTrue('Old HTML' in response.content)
+        etag = response['ETag']
+
+        call_command('renderposts', stdout=StringIO())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse('Old HTML' in response.content)
+        self.assertTrue(Post.objects.get(pk=post.pk).modified > post.modified)
+
+class SiteTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(SiteTest, self).setUp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        self.other = Site.objects.create(domain='other.com', name='other.com')
+        self.posts = []
+        for site in (Site.objects.get_current(), self.other):
+            post = Post(title='A post on %s' % site.domain, text='Posted on %s' % site.domain,
+                        slug='%s-post' % site.name.split('.')[0], pub_date=timezone.now(),
+                        author=author, site=site)
+            post.save()
+            self.posts.append(post)
+
+    def test_views_show_the_requested_site(self):
+        response = self.client.get('/')
+        self.assertTrue('A post on example.com' in response.content)
+        self.assertFalse('A post on other.com' in response.content)
+
+        response = self.client.get('/', HTTP_HOST='other.com')
+        self.assertTrue('A post on other.com' in response.content)
+        self.assertFalse('A post on example.com' in response.content)
+
+        # A post is only found on its own site
+        url = self.posts[1].get_absolute_url()
+        self.assertEquals(self.client.get(url).status_code, 404)
+        self.assertEquals(self.client.get(url, HTTP_HOST='other.com').status_code, 200)
+
+    def test_caches_are_per_site(self):
+        self.client.get('/')
+        self.client.get('/', HTTP_HOST='other.com')
+
+        # Editing a post on the other site leaves this site's index cached
+        self.posts[1].title = 'An edited post on other.com'
+        self.posts[1].save()
+        with self.assertNumQueries(0):
+            self.client.get('/')
+        response = self.client.get('/', HTTP_HOST='other.com')
+        self.assertTrue('An edited post on other.com' in response.content)
+
+class ReplicaTest(BaseAcceptanceTest):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        self.healthy = set(['replica1', 'replica2'])
+        self.router = routers.ReplicaRouter(['replica1', 'replica2'])
+        self.router.is_healthy = lambda alias: alias in self.healthy
+
+    def tearDown(self):
+        routers._down.clear()
+        routers.start_request()
+
+    def test_round_robin_skips_failing_replicas(self):
+        self.assertEquals([self.router.choose() for i in range(4)],
+                          ['replica1', 'replica2', 'replica1', 'replica2'])
+
+        # A replica that can't be reached is left alone until its retry time
+        self.healthy.discard('replica2')
+        self.assertEquals([self.router.choose() for i in range(3)], ['replica1'] * 3)
+        self.healthy.add('replica2')
+        self.assertEquals(self.router.choose(), 'replica1')
+        routers._down['replica2'] = 0
+        self.assertEquals(self.router.choose(), 'replica2')
+
+        # With none left, or just after an invalidation, the primary
+        self.healthy.clear()
+        routers._down.clear()
+        self.assertEquals(self.router.choose(), 'default')
+        self.healthy.add('replica1')
+        invalidate('post-list')
+        self.assertEquals(self.router.choose(), 'default')
+
+    def test_reads_stay_on_one_database_per_request(self):
+        self.assertEquals(self.router.db_for_read(Post), 'default')
+        routers.start_request()
+        routers.use_replicas()
+        self.assertEquals(self.router.db_for_read(Post), 'replica1')
+        self.assertEquals(self.router.db_for_read(Tag), 'replica1')
+
+        # Once the request writes, it reads its writes
+        self.assertEquals(self.router.db_for_write(Post), 'default')
+        self.assertEquals(self.router.db_for_read(Post), 'default')
+
+    def test_public_views_read_from_replicas(self):
+        for url in ['/', '/2014/6/a-post/', '/category/python/', '/tag/python/', '/feeds/posts/',
+                    '/sitemap.xml', '/about/']:
+            self.assertTrue(getattr(resolve(url).func, 'replica_reads', False), url)
+        self.assertFalse(getattr(resolve('/admin/').func, 'replica_reads', False))
+
+    def test_writers_are_pinned_to_the_primary(self):
+        response = self.client.get('/')
+        self.assertFalse(PIN_COOKIE in response.cookies)
+
+        self.client.login(username='bobsmith', password="password")
+        response = self.client.post('/admin/blogengine/category/add/', {
+            'name': 'python',
+            'description': 'The Python programming language'
+        })
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(response.cookies[PIN_COOKIE]['max-age'], routers.REPLICA_LAG)
+
+class BenchmarkTest(BaseAcceptanceTest):
+    def test_synthetic_records_are_repeatable(self):
+        records = list(benchmark.synthetic_records(20, seed=1))
+        self.assertEquals(records, list(benchmark.synthetic_records(20, seed=1)))
+        # Smaller datasets are the newest posts of bigger ones
+        self.assertEquals(records[:5], list(benchmark.synthetic_records(5, seed=1)))
+        self.assertNotEquals(records, list(benchmark.synthetic_records(20, seed=2)))
+        self.assertEquals(len(set(record['slug'] for record in records)), 20)
+
+        # The first ranks are drawn the most
+        rng = random.Random(0)
+        zipf = benchmark.Zipf(10)
+        draws = [zipf.draw(rng) for i in range(1000)]
+        self.assertTrue(draws.count(0) > draws.count(1) > draws.count(9))
+
+    def test_seed_and_run(self):
+        call_command('seedbenchmark', '30', categories=5, tags=10, stdout=StringIO())
+        self.assertEquals(Post.objects.count(), 30)
+        self.assertEquals(FlatPage.objects.count(), len(benchmark.FLATPAGES))
+        # Seeding again adds nothing
+        call_command('seedbenchmark', '30', categories=5, tags=10, stdout=StringIO())
+        self.assertEquals(Post.objects.count(), 30)
+
+        output = StringIO()
+        call_command('runbenchmark', requests=6, paths=3, stdout=output, stderr=StringIO())
+        report = json.loads(output.getvalue())
+        self.assertEquals(report['dataset']['posts'], 30)
+        self.assertEquals(sorted(report['routes']), sorted(benchmark.ROUTES))
+        for route, result in report['routes'].items():
+            self.assertEquals(result['statuses'], {'200': 6}, route)
+            self.assertTrue(result['latency_ms']['p50'] <= result['latency_ms']['p99'])
+            self.assertTrue(result['queries_per_request']['mean'] >= 0)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(benchmark.percentile(values, 0.5), 50)
+        self.assertEquals(benchmark.percentile(values, 0.99), 99)
+        self.assertEquals(benchmark.percentile([7], 0.95), 7)
+        self.assertEquals(benchmark.percentile([], 0.5), None)
+
+class TimingTest(BaseAcceptanceTest):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        super(TimingTest, self).setUp()
+        timing.reset_stats()
+        author = User.objects.get(username='bobsmith')
+        post = Post(title='My first post', text='This is *my* first post', slug='my-first-post',
+                    pub_date=timezone.now(), author=author, site=Site.objects.get_current())
+        post.save()
+        page = FlatPage.objects.create(url='/about/', title='About me', content='All *about* me')
+        page.sites.add(Site.objects.get_current())
+
+    def test_server_timing(self):
+        response = self.client.get('/')
+        metrics = dict(metric.strip().split(';', 1) for metric in response['Server-Timing'].split(','))
+        self.assertEquals(sorted(metrics), ['cache', 'db', 'markdown', 'template', 'total'])
+        self.assertTrue(re.match(r'dur=[\d.]+;desc="[1-9]\d* queries"$', metrics['db']))
+        self.assertTrue(float(metrics['template'][4:]) > 0)
+        self.assertTrue(re.match(r'desc="hits=\d+ misses=[1-9]\d*"$', metrics['cache']))
+
+        # The page comes from the cache the second time
+        response = self.client.get('/')
+        self.assertTrue('db;dur=0.0;desc="0 queries"' in response['Server-Timing'])
+        self.assertTrue('cache;desc="hits=1 misses=0"' in response['Server-Timing'])
+
+        # Flatpages render their Markdown in the template
+        response = self.client.get('/about/')
+        self.assertTrue(re.search(r'markdown;dur=[\d.]+', response['Server-Timing']))
+
+    def test_stats(self):
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/about/')
+
+        # Only for staff
+        response = self.client.get('/metrics')
+        self.assertFalse('blogengine_request_seconds' in response.content)
+
+        self.client.login(username='bobsmith', password="password")
+        response = self.client.get('/metrics')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.splitlines()
+        self.assertTrue('# TYPE blogengine_request_seconds histogram' in lines)
+        self.assertTrue('blogengine_request_seconds_count{route="index"} 2' in lines)
+        self.assertTrue('blogengine_request_seconds_bucket{route="index",le="+Inf"} 2' in lines)
+        self.assertTrue('blogengine_request_seconds_count{route="flatpage"} 1' in lines)
+        self.assertTrue(re.search(r'^blogengine_cache_hits_total\{route="index"\} [1-9]', response.content, re.M))
+        self.assertTrue('blogengine_requests_total{route="index",status="200"} 2' in lines)
+
+    def test_histogram(self):
+        histogram = timing.Histogram((1, 5, 10))
+        for value in (0, 1, 3, 7, 20):
+            histogram.observe(value)
+        self.assertEquals(histogram.cumulative(), [('1', 2), ('5', 3), ('10', 4), ('+Inf', 5)])
+        self.assertEquals((histogram.count, histogram.sum), (5, 31))
+
+class SearchTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        self.site = Site.objects.all()[0]
+        self.first = self.create_post('Django tips', 'Keep your django views small. Django is great.')
+        self.second = self.create_post('Python tips', 'Small functions and small views in python.')
+        self.third = self.create_post('Cooking', 'Nothing about programming, but django gets a mention.')
+
+    def create_post(self, title, text):
+        post = Post()
+        post.title = title
+        post.text = text
+        post.slug = title.lower().replace(' ', '-')
+        post.pub_date = timezone.now()
+        post.author = self.author
+        post.site = self.site
+        post.save()
+        return post
+
+    def test_ranking_and_phrases(self):
+        # Check every term must match, best match first
+        self.assertEquals(search('django'), [self.first.pk, self.third.pk])
+        self.assertEquals(search('small views'), [self.second.pk, self.first.pk])
+        self.assertEquals(search('django cooking'), [self.third.pk])
+        self.assertEquals(search('missing'), [])
+
+        # Check phrases must appear in order
+        self.assertEquals(search('"django views"'), [self.first.pk])
+        self.assertEquals(search('"views django"'), [])
+
+    def test_long_phrase(self):
+        words = ('alpha bravo charlie delta echo foxtrot golf hotel india juliett kilo lima mike '
+                 'november oscar papa quebec romeo')
+        post = self.create_post('Alphabet', 'Spelled out: %s.' % words)
+        self.assertEquals(search('"%s"' % words), [post.pk])
+        self.assertEquals(self.client.get('/search/', {'q': '"%s"' % words}).status_code, 200)
+
+    def test_index_follows_edits(self):
+        # Edit a post, check only the new text is found
+        self.third.text = 'Nothing about programming at all.'
+        self.third.save()
+        self.assertEquals(search('django'), [self.first.pk])
+        self.assertEquals(search('programming'), [self.third.pk])
+
+        # Delete a post, check it is gone
+        self.first.delete()
+        self.assertEquals(search('django'), [])
+        self.assertEquals(SearchTerm.objects.get(term='tips').doc_count, 1)
+
+        # Check a rebuild gives the same index
+        postings = sorted(SearchPosting.objects.values_list('term__term', 'post', 'positions'))
+        call_command('rebuildsearch', stdout=StringIO())
+        self.assertEquals(sorted(SearchPosting.objects.values_list('term__term', 'post', 'positions')), postings)
+        self.assertEquals(search('programming'), [self.third.pk])
+        self.assertFalse(SearchTerm.objects.filter(doc_count=0).exists())
+
+    def test_only_published_posts_on_the_site(self):
+        # Better matches on another site and still to come
+        other = self.create_post('Django django', 'Django on another site.')
+        other.site = Site.objects.create(domain='other.example.com', name='other')
+        other.save()
+        scheduled = self.create_post('Django django django', 'Django next week.')
+        scheduled.pub_date = timezone.now() + timedelta(days=7)
+        scheduled.save()
+
+        # Check they don't take up the results, however few are kept
+        max_results = search_module.MAX_RESULTS
+        search_module.MAX_RESULTS = 2
+        try:
+            self.assertEquals(search('django', self.site), [self.first.pk, self.third.pk])
+            self.assertEquals(search('django', other.site), [other.pk])
+            self.assertEquals(list(self.client.get('/search/?q=django').context['object_list']),
+                              [self.first, self.third])
+        finally:
+            search_module.MAX_RESULTS = max_results
+
+        # Check a post going live is found
+        scheduled.pub_date = timezone.now()
+        scheduled.save()
+        self.assertEquals(search('django', self.site), [scheduled.pk, self.first.pk, self.third.pk])
+
+    def test_search_page(self):
+        response = self.client.get('/search/?q=django')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(list(response.context['object_list']), [self.first, self.third])
+        self.assertTrue('Django tips' in response.content)
+        self.assertTrue('Cooking' in response.content)
+        self.assertFalse('Python tips' in response.content)
+
+        # Check an empty search and a page past the end
+        self.assertEquals(self.client.get('/search/').status_code, 200)
+        self.assertEquals(self.client.get('/search/?q=django&page=3').status_code, 404)
+
+class ImportPostsTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ImportPostsTest, self).setUp()
+        User.objects.create_user('testuser', 'user@example.com', 'password')
+        self.input = tempfile.mkdtemp()
+
+        # Two posts as JSON lines, one of them invalid, and one as Markdown
+        self.jsonl = os.path.join(self.input, 'posts.jsonl')
+        with open(self.jsonl, 'w') as jsonl:
+            jsonl.write(json.dumps({'title': 'First post', 'pub_date': '2014-06-01T12:00:00',
+                                    'author': 'testuser', 'category': 'Python',
+                                    'tags': ['django', 'web'], 'text': 'Some *text*'}) + '\n')
+            jsonl.write(json.dumps({'title': 'No date', 'author': 'testuser', 'text': ''}) + '\n')
+            jsonl.write(json.dumps({'title': 'Second post', 'pub_date': '2014-07-01',
+                                    'author': 'testuser', 'category': 'python',
+                                    'tags': ['Django'], 'text': 'More text'}) + '\n')
+        self.markdown = os.path.join(self.input, 'markdown')
+        os.mkdir(self.markdown)
+        with open(os.path.join(self.markdown, 'third-post.md'), 'w') as post:
+            post.write('Title: Third post\nPub-Date: 2014-07-02\nTags: web\n\nThe *third* post')
+
+    def tearDown(self):
+        shutil.rmtree(self.input)
+
+    def import_posts(self, *args, **options):
+        out = StringIO()
+        call_command('importposts', *args, author='testuser', stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_import(self):
+        out = self.import_posts(self.jsonl, self.markdown)
+        self.assertTrue('Imported 3 posts, skipped 0 existing and 1 invalid records' in out)
+
+        # Check the posts, categories and tags
+        post = Post.objects.get(slug='first-post')
+        self.assertEquals(post.category.name, 'Python')
+        self.assertEquals(sorted(tag.slug for tag in post.tags.all()), ['django', 'web'])
+        self.assertEquals(post.text_html, '<p>Some <em>text</em></p>')
+        self.assertEquals(Post.objects.get(slug='third-post').text, 'The *third* post')
+        self.assertEquals(Category.objects.count(), 1)
+        self.assertEquals(sorted(Tag.objects.values_list('slug', 'post_count')), [('django', 2), ('web', 2)])
+
+        # Check derived data was rebuilt and pages show the new posts
+        self.assertEquals(search('third'), [Post.objects.get(slug='third-post').pk])
+        self.assertTrue('Second post' in self.client.get('/').content)
+
+        # Check running it again changes nothing
+        out = self.import_posts(self.jsonl, self.markdown)
+        self.assertTrue('Imported 0 posts, skipped 3 existing and 1 invalid records' in out)
+
+    def test_resume_from_checkpoint(self):
+        checkpoint = os.path.join(self.input, 'checkpoint')
+        with open(checkpoint, 'w') as checkpoint_file:
+            json.dump({'paths': [self.jsonl], 'records': 2}, checkpoint_file)
+        out = self.import_posts(self.jsonl, checkpoint=checkpoint, batch_size=1)
+        self.assertTrue('Imported 1 posts, skipped 0 existing and 0 invalid records' in out)
+        self.assertEquals(list(Post.objects.values_list('slug', flat=True)), ['second-post'])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_resume_after_interrupted_rebuild(self):
+        class InterruptedImport(importposts.Command):
+            def rebuild(self):
+                raise KeyboardInterrupt
+
+        checkpoint = os.path.join(self.input, 'checkpoint')
+        command = InterruptedImport()
+        command.stdout = command.stderr = StringIO()
+        with self.assertRaises(KeyboardInterrupt):
+            command.execute(self.jsonl, author='testuser', checkpoint=checkpoint, batch_size=1000,
+                            rebuild=True, stdout=StringIO(), stderr=StringIO())
+        self.assertEquals(Post.objects.count(), 2)
+        self.assertEquals(search('second'), [])
+        with open(checkpoint) as checkpoint_file:
+            self.assertEquals(json.load(checkpoint_file)['rebuild'], True)
+
+        # Nothing left to import, but the rebuild still runs
+        out = self.import_posts(self.jsonl, checkpoint=checkpoint)
+        self.assertTrue('Imported 0 posts' in out)
+        self.assertEquals(search('second'), [Post.objects.get(slug='second-post').pk])
+        self.assertEquals(Category.objects.get().post_count, 2)
+        self.assertFalse(os.path.exists(checkpoint))
+
+class ExportPostsTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ExportPostsTest, self).setUp()
+        self.output = tempfile.mkdtemp()
+        self.author = User.objects.create_superuser('testuser', 'user@example.com', 'password')
+        category = Category(name='python', description='The Python programming language')
+        category.save()
+        tag = Tag(name='django', description='The Django framework')
+        tag.save()
+        for i in range(3):
+            post = Post()
+            post.title = u'Post number %d \u2013 caf\xe9' % i
+            post.text = 'This is *post* %d' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = datetime(2014, 6, 15, 12, i, tzinfo=timezone.utc)
+            post.author = self.author
+            post.site = Site.objects.all()[0]
+            post.category = category
+            post.save()
+            post.tags.add(tag)
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def test_export_and_import_back(self):
+        expected = list(post_records(Post.objects.all()))
+        for filename in ('posts.jsonl', 'posts.tar.gz'):
+            path = os.path.join(self.output, filename)
+            out = StringIO()
+            call_command('exportposts', path, chunk_size=2, stdout=out)
+            self.assertTrue('Exported 3 posts' in out.getvalue())
+
+            # Read the export back through the importer
+            Post.objects.all().delete()
+            if filename.endswith('.tar.gz'):
+                tarfile.open(path).extractall(self.output)
+                path = os.path.join(self.output, 'posts')
+            call_command('importposts', path, stdout=StringIO())
+            self.assertEquals(list(post_records(Post.objects.all())), expected)
+
+    def test_export_view_is_for_staff(self):
+        # Check anonymous users get the admin login page
+        self.assertFalse(self.client.get('/export/posts.jsonl').has_header('Content-Disposition'))
+
+        self.client.login(username='testuser', password='password')
+        response = self.client.get('/export/posts.jsonl')
+        self.assertEquals(response['Content-Disposition'], 'attachment; filename=posts.jsonl')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEquals([json.loads(line)['slug'] for line in lines],
+                          ['post-number-0', 'post-number-1', 'post-number-2'])
+
+class ExportSiteTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ExportSiteTest, self).setUp()
+        self.output = tempfile.mkdtemp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+
+        # Create a category and seven posts, enough for two index pages
+        self.category = Category(name='python', description='The Python programming language')
+        self.category.save()
+        self.posts = []
+        for i in range(7):
+            post = Post()
+            post.title = 'Post number %d' % i
+            post.text = 'This is post %d' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = datetime(2014, 6, 15, 12, tzinfo=timezone.utc) - timedelta(hours=i)
+            post.author = author
+            post.site = site
+            post.category = self.category if i == 0 else None
+            post.save()
+            self.posts.append(post)
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def export(self):
+        out = StringIO()
+        call_command('exportsite', self.output, processes=1, stdout=out)
+        return out.getvalue()
+
+    def read(self, path):
+        with open(os.path.join(self.output, path)) as page:
+            return page.read()
+
+    def test_export_and_incremental_rebuild(self):
+        # 7 posts, 2 index pages, 1 category page, 2 feeds and 2 pages each for June and 2014
+        self.assertTrue('Rendered 16 of 16 pages' in self.export())
+        self.assertTrue('Post number 0' in self.read('index.html'))
+        self.assertTrue('Post number 0' in self.read(self.posts[0].get_absolute_url().strip('/') + '/index.html'))
+        self.assertTrue('Post number 0' in self.read('category/python/index.html'))
+        self.assertTrue('Post number 0' in self.read('feeds/posts/index.xml'))
+        self.assertTrue('Post number 0' in self.read('2014/6/index.html'))
+        older = os.listdir(os.path.join(self.output, 'after'))
+        self.assertEquals(len(older), 1)
+        self.assertTrue('Post number 6' in self.read(os.path.join('after', older[0])))
+
+        # Check nothing is rendered when nothing changed
+        self.assertTrue('Rendered 0 of 16 pages' in self.export())
+
+        # Edit the oldest post, check only its own pages are rendered again
+        self.posts[6].title = 'Edited post'
+        self.posts[6].save()
+        self.assertTrue('Rendered 5 of 16 pages' in self.export())
+        self.assertTrue('Edited post' in self.read(os.path.join('after', older[0])))
+
+    def test_only_the_current_site(self):
+        other = Site.objects.create(domain='other.com', name='other.com')
+        post = Post.objects.create(title='Elsewhere', text='On the other site', slug='elsewhere',
+                                   author=self.posts[0].author, site=other,
+                                   pub_date=datetime(2014, 6, 16, tzinfo=timezone.utc))
+        page = FlatPage.objects.create(url='/other/', title='Other', content='On the other site')
+        page.sites.add(other)
+
+        self.assertTrue('Rendered 16 of 16 pages' in self.export())
+        self.assertFalse(os.path.exists(os.path.join(self.output, post.get_absolute_url().strip('/'))))
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'other')))
+        self.assertFalse('Elsewhere' in self.read('index.html'))
+
+class ExplainViewsTest(BaseAcceptanceTest):
+    @override_settings(DEBUG=False, ALLOWED_HOSTS=['example.com'])
+    def test_explain_views(self):
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        category = Category(name='python', description='Python')
+        category.save()
+        post = Post(title='My first post', text='This is my first post', slug='my-first-post',
+                    pub_date=timezone.now(), author=author, site=Site.objects.get_current(),
+                    category=category)
+        post.save()
+
+        output = StringIO()
+        call_command('explainviews', stdout=output)
+        output = output.getvalue()
+        for label in ('== index: first page', '== category python: first page', '== feed', '== detail'):
+            self.assertTrue(label in output, label)
+        # The detail plan is that of the view's own query
+        detail = output[output.index('== detail'):]
+        self.assertTrue('"blogengine_post"."site_id" = 1' in detail)
+
+class SitemapTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(SitemapTest, self).setUp()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.get_current()
+        category = Category(name='python', description='Python')
+        category.save()
+        tag = Tag(name='django', description='Django')
+        tag.save()
+        Tag(name='unused', description='No posts').save()
+
+        self.posts = []
+        for i, (month, day) in enumerate([(6, 10), (6, 2), (5, 20)]):
+            post = Post.objects.create(title='Post number %d' % i, text='This is post %d' % i,
+                                       slug='post-number-%d' % i, author=author, site=site,
+                                       category=category,
+                                       pub_date=datetime(2014, month, day, 12, tzinfo=timezone.utc))
+            post.tags.add(tag)
+            self.posts.append(post)
+
+        page = FlatPage.objects.create(url='/about/', title='About me', content='All about me')
+        page.sites.add(site)
+
+    def locations(self, url):
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/xml; charset=utf-8')
+        return re.findall(r'<loc>http://example\.com(/[^<]*)</loc>', response.content)
+
+    def test_sitemap_index(self):
+        self.assertEquals(self.locations('/sitemap.xml'), [
+            '/sitemap-posts-2014-05.xml', '/sitemap-posts-2014-06.xml', '/sitemap-categories.xml',
+            '/sitemap-tags.xml', '/sitemap-pages.xml'])
+        self.assertEquals(self.locations('/sitemap-posts-2014-06.xml'),
+                          ['/2014/6/post-number-1/', '/2014/6/post-number-0/'])
+        self.assertEquals(self.locations('/sitemap-categories.xml'), ['/category/python/'])
+        self.assertEquals(self.locations('/sitemap-tags.xml'), ['/tag/django/'])
+        self.assertEquals(self.locations('/sitemap-pages.xml'), ['/about/'])
+        self.assertEquals(self.client.get('/sitemap-tags-2.xml').status_code, 404)
+
+    def test_only_published_posts_on_the_site(self):
+        author = User.objects.get(username='testuser')
+        perl = Category(name='perl', description='Perl')
+        perl.save()
+        flask = Tag(name='flask', description='Flask')
+        flask.save()
+        scheduled = Post.objects.create(title='Scheduled', text='Not out yet', slug='scheduled', author=author,
+                                        site=Site.objects.get_current(), category=perl,
+                                        pub_date=datetime(2099, 1, 1, tzinfo=timezone.utc))
+        scheduled.tags.add(flask)
+        self.assertEquals(self.locations('/sitemap.xml'), [
+            '/sitemap-posts-2014-05.xml', '/sitemap-posts-2014-06.xml', '/sitemap-categories.xml',
+            '/sitemap-tags.xml', '/sitemap-pages.xml'])
+        self.assertEquals(self.locations('/sitemap-categories.xml'), ['/category/python/'])
+        self.assertEquals(self.locations('/sitemap-tags.xml'), ['/tag/django/'])
+
+        # Another site's posts are left out too
+        other_site = Site.objects.create(domain='other.example.com', name='other')
+        scheduled.site = other_site
+        scheduled.pub_date = datetime(2014, 7, 1, tzinfo=timezone.utc)
+        scheduled.save()
+        self.assertFalse('/sitemap-posts-2014-07.xml' in self.locations('/sitemap.xml'))
+        self.assertEquals(self.locations('/sitemap-categories.xml'), ['/category/python/'])
+        self.assertEquals(self.locations('/sitemap-tags.xml'), ['/tag/django/'])
+
+    def test_shards(self):
+        # One URL per shard, read one row at a time
+        original = sitemaps.SHARD_SIZE, sitemaps.CHUNK_SIZE
+        sitemaps.SHARD_SIZE = sitemaps.CHUNK_SIZE = 1
+        try:
+            self.assertEquals(self.locations('/sitemap.xml')[1:3],
+                              ['/sitemap-posts-2014-06.xml', '/sitemap-posts-2014-06-2.xml'])
+            self.assertEquals(self.locations('/sitemap-posts-2014-06.xml'), ['/2014/6/post-number-1/'])
+            self.assertEquals(self.locations('/sitemap-posts-2014-06-2.xml'), ['/2014/6/post-number-0/'])
+            self.assertEquals(self.client.get('/sitemap-posts-2014-06-3.xml').status_code, 404)
+        finally:
+            sitemaps.SHARD_SIZE, sitemaps.CHUNK_SIZE = original
+
+    def test_cached_until_changed(self):
+        response = self.client.get('/sitemap-posts-2014-06.xml')
+        response = self.client.get('/sitemap-posts-2014-06.xml', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
+        # Other months are left alone
+        may = self.client.get('/sitemap-posts-2014-05.xml')['ETag']
+        self.posts[1].slug = 'renamed'
+        self.posts[1].save()
+        self.assertEquals(self.locations('/sitemap-posts-2014-06.xml'),
+                          ['/2014/6/renamed/', '/2014/6/post-number-0/'])
+        self.assertEquals(self.client.get('/sitemap-posts-2014-05.xml')['ETag'], may)
+
+        # Moving a post rebuilds both months and the index
+        self.posts[0].pub_date = datetime(2014, 7, 1, tzinfo=timezone.utc)
+        self.posts[0].save()
+        self.assertEquals(self.locations('/sitemap-posts-2014-06.xml'), ['/2014/6/renamed/'])
+        self.assertTrue('/sitemap-posts-2014-07.xml' in self.locations('/sitemap.xml'))
+
+        FlatPage.objects.all().delete()
+        self.assertEquals(self.locations('/sitemap-pages.xml'), [])
+        self.assertFalse('/sitemap-pages.xml' in self.locations('/sitemap.xml'))
+
 class FlatPageViewTest(BaseAcceptanceTest):
     def test_create_flag_page(self):
         #create flat page
@@ -797,11 +2271,8 @@ class FeedTest(BaseAcceptanceTest):
         author = User.objects.create_user('testuser', 'user@example.com', 'password')
         author.save()
 
-        # Create the site
-        site = Site()
-        site.name = 'example.com'
-        site.domain = 'example.com'
-        site.save()
+        # Use the site the test client requests, views only show its posts
+        site = Site.objects.get_current()
 
         # Create a post
         post = Post()
@@ -839,5 +2310,98 @@ class FeedTest(BaseAcceptanceTest):
         # Check post retrieved is the correct one
         feed_post = feed.entries[0]
         self.assertEquals(feed_post.title, post.title)
-        self.assertEquals(feed_post.description, post.text)
+        self.assertEquals(feed_post.description, post.text_html)
 
+    def test_feed_is_cached_until_posts_change(self):
+        # Create the author and site
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+
+        # Create more posts than the feed holds
+        for i in range(25):
+            post = Post()
+            post.title = 'Post number %d' % i
+            post.text = 'This is post *%d*' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = timezone.now()
+            post.author = author
+            post.site = site
+            post.save()
+
+        # Check the feed is capped and newest first
+        feed = feedparser.parse(self.client.get('/feeds/posts/').content)
+        self.assertEquals(len(feed.entries), 20)
+        self.assertEquals(feed.entries[0].title, 'Post number 24')
+
+        # Check the cached feed is served without touching the database
+        with self.assertNumQueries(0):
+            response = self.client.get('/feeds/posts/')
+        self.assertEquals(feedparser.parse(response.content).entries[0].title, 'Post number 24')
+
+        # Edit a post and check the feed is rebuilt
+        post.title = 'Edited post'
+        post.save()
+        feed = feedparser.parse(self.client.get('/feeds/posts/').content)
+        self.assertEquals(feed.entries[0].title, 'Edited post')
+
+    def test_category_tag_and_author_feeds(self):
+        # Create two categories, a tag and two authors
+        python = Category(name='python', description='The Python programming language')
+        python.save()
+        perl = Category(name='perl', description='The Perl programming language')
+        perl.save()
+        tag = Tag(name='django', description='The Django framework')
+        tag.save()
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        other_author = User.objects.create_user('otheruser', 'other@example.com', 'password')
+        site = Site.objects.all()[0]
+
+        # Create one post in each category
+        posts = []
+        for category, user in ((python, author), (perl, other_author)):
+            post = Post()
+            post.title = 'A %s post' % category.name
+            post.text = 'All about %s' % category.name
+            post.slug = '%s-post' % category.name
+            post.pub_date = timezone.now()
+            post.author = user
+            post.site = site
+            post.category = category
+            post.save()
+            posts.append(post)
+        posts[0].tags.add(tag)
+
+        # Check each feed only holds its own posts
+        feed = feedparser.parse(self.client.get('/category/python/feed/').content)
+        self.assertEquals([entry.title for entry in feed.entries], ['A python post'])
+        feed = feedparser.parse(self.client.get('/tag/django/feed/').content)
+        self.assertEquals([entry.title for entry in feed.entries], ['A python post'])
+        feed = feedparser.parse(self.client.get('/author/otheruser/feed/').content)
+        self.assertEquals([entry.title for entry in feed.entries], ['A perl post'])
+        self.assertEquals(self.client.get('/category/blah/feed/').status_code, 404)
+
+        # Check non-ASCII paths are cached too
+        self.assertEquals(self.client.get(u'/author/jos\xe9/feed/').status_code, 404)
+        self.assertEquals(self.client.get('/author/jos%C3%A9/feed/').status_code, 404)
+        User.objects.create_user(u'jos\xe9', 'jose@example.com', 'password')
+        self.assertEquals(self.client.get('/author/jos%C3%A9/feed/').status_code, 200)
+
+        # Edit the perl post and check the python feed is still cached
+        posts[1].title = 'An edited perl post'
+        posts[1].save()
+        with self.assertNumQueries(0):
+            self.client.get('/category/python/feed/')
+            self.client.get('/tag/django/feed/')
+
+        # Move the python post to perl and check both category feeds change
+        posts[0].category = perl
+        posts[0].save()
+        feed = feedparser.parse(self.client.get('/category/python/feed/').content)
+        self.assertEquals(len(feed.entries), 0)
+        feed = feedparser.parse(self.client.get('/category/perl/feed/').content)
+        self.assertEquals(len(feed.entries), 2)
+
+        # Untag the post and check the tag feed changes
+        posts[0].tags.remove(tag)
+        feed = feedparser.parse(self.client.get('/tag/django/feed/').content)
+        self.assertEquals(len(feed.entries), 0)
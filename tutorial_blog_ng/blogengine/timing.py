@@ -0,0 +1,224 @@
+"""Where each request's time goes: SQL, templates, Markdown and the page cache.
+
+TimingMiddleware (see blogengine.middleware) starts a RequestTimings for
+each request, which the code being timed adds to with timed() and count().
+When the response leaves, the timings go out in its Server-Timing header
+and into histograms per URL pattern name, which views.request_stats shows to
+staff in the Prometheus text format. The histograms are kept per process,
+so each worker reports its own requests.
+
+Template time is that of the outermost template rendered, includes and
+Markdown within it count towards it; Markdown time is also shown on its
+own.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Template
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+METRIC_PREFIX = getattr(settings, 'BLOGENGINE_METRIC_PREFIX', 'blogengine')
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+	def __init__(self):
+		self.started = time.time()
+		self.total = None
+		self.durations = defaultdict(float)
+		self.counts = defaultdict(int)
+		self.rendering = False
+		self.queries = 0
+		self.query_seconds = 0.0
+		# alias -> (queries recorded before the request, whether they were being recorded)
+		self._query_offsets = {}
+		for connection in connections.all():
+			self._query_offsets[connection.alias] = (len(connection.queries), connection.use_debug_cursor)
+			connection.use_debug_cursor = True
+
+	def stop(self):
+		self.total = time.time() - self.started
+		for connection in connections.all():
+			offset, recording = self._query_offsets.get(connection.alias, (0, False))
+			queries = connection.queries[offset:]
+			self.queries += len(queries)
+			self.query_seconds += sum(float(query['time']) for query in queries)
+			connection.use_debug_cursor = recording
+
+
+def start():
+	"""Start timing the current thread's request."""
+	_local.timings = RequestTimings()
+	return _local.timings
+
+
+def stop():
+	"""Stop timing the current thread's request; returns its RequestTimings, if it was timed."""
+	timings = getattr(_local, 'timings', None)
+	_local.timings = None
+	if timings is not None:
+		timings.stop()
+	return timings
+
+
+def current():
+	return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def timed(name):
+	"""Add the time spent in the block to the request's ``name`` duration."""
+	timings = current()
+	if timings is None:
+		yield
+		return
+	started = time.time()
+	try:
+		yield
+	finally:
+		timings.durations[name] += time.time() - started
+
+
+def count(name):
+	timings = current()
+	if timings is not None:
+		timings.counts[name] += 1
+
+
+def instrument_templates():
+	"""Time Template rendering from now on, in every thread."""
+	if getattr(Template._render, 'timed', False):
+		return
+	original = Template._render
+
+	def _render(self, context):
+		timings = current()
+		if timings is None or timings.rendering:
+			return original(self, context)
+		timings.rendering = True
+		started = time.time()
+		try:
+			return original(self, context)
+		finally:
+			timings.rendering = False
+			timings.durations['template'] += time.time() - started
+	_render.timed = True
+	Template._render = _render
+
+
+def server_timing(timings):
+	"""The Server-Timing header value for ``timings``."""
+	metrics = [
+		'db;dur=%.1f;desc="%d queries"' % (timings.query_seconds * 1000, timings.queries),
+		'template;dur=%.1f' % (timings.durations['template'] * 1000),
+		'markdown;dur=%.1f' % (timings.durations['markdown'] * 1000),
+		'cache;desc="hits=%d misses=%d"' % (timings.counts['cache-hit'], timings.counts['cache-miss']),
+		'total;dur=%.1f' % (timings.total * 1000),
+	]
+	return ', '.join(metrics)
+
+
+class Histogram(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.count = 0
+		self.sum = 0
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.buckets, value)
+		if index < len(self.buckets):
+			self.counts[index] += 1
+		self.count += 1
+		self.sum += value
+
+	def cumulative(self):
+		"""[(upper bound, observations up to it)], ending with +Inf."""
+		total = 0
+		bounds = []
+		for bucket, observed in zip(self.buckets, self.counts):
+			total += observed
+			bounds.append(('%g' % bucket, total))
+		bounds.append(('+Inf', self.count))
+		return bounds
+
+
+# name, description, buckets, value of a RequestTimings
+HISTOGRAMS = (
+	('request_seconds', 'Time to build the response.', SECONDS_BUCKETS, lambda timings: timings.total),
+	('db_seconds', 'Time spent in SQL queries.', SECONDS_BUCKETS, lambda timings: timings.query_seconds),
+	('db_queries', 'Number of SQL queries.', QUERY_BUCKETS, lambda timings: timings.queries),
+	('template_seconds', 'Time spent rendering templates.', SECONDS_BUCKETS,
+		lambda timings: timings.durations['template']),
+	('markdown_seconds', 'Time spent rendering Markdown in templates.', SECONDS_BUCKETS,
+		lambda timings: timings.durations['markdown']),
+)
+# name, description, RequestTimings count
+COUNTERS = (
+	('cache_hits_total', 'Cached pages and documents found.', 'cache-hit'),
+	('cache_misses_total', 'Cached pages and documents missing or invalidated.', 'cache-miss'),
+)
+
+_lock = threading.Lock()
+# (name, route) -> Histogram
+_histograms = {}
+# (name, labels) -> count
+_counters = defaultdict(int)
+
+
+def record(route, status, timings):
+	"""Add a finished request's ``timings`` to the statistics of ``route``."""
+	with _lock:
+		for name, description, buckets, value in HISTOGRAMS:
+			histogram = _histograms.get((name, route))
+			if histogram is None:
+				histogram = _histograms[(name, route)] = Histogram(buckets)
+			histogram.observe(value(timings))
+		for name, description, counted in COUNTERS:
+			_counters[(name, (('route', route),))] += timings.counts[counted]
+		_counters[('requests_total', (('route', route), ('status', str(status))))] += 1
+
+
+def reset_stats():
+	with _lock:
+		_histograms.clear()
+		_counters.clear()
+
+
+def _labels(labels):
+	return ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+					for name, value in labels)
+
+
+def render_stats():
+	"""Every statistic recorded in this process, in the Prometheus text format."""
+	lines = []
+	with _lock:
+		for name, description, buckets, value in HISTOGRAMS:
+			metric = '%s_%s' % (METRIC_PREFIX, name)
+			lines.append('# HELP %s %s' % (metric, description))
+			lines.append('# TYPE %s histogram' % metric)
+			for (histogram_name, route), histogram in sorted(_histograms.items()):
+				if histogram_name != name:
+					continue
+				for bound, observed in histogram.cumulative():
+					lines.append('%s_bucket{%s} %d' % (metric, _labels([('route', route), ('le', bound)]), observed))
+				lines.append('%s_sum{%s} %s' % (metric, _labels([('route', route)]), repr(float(histogram.sum))))
+				lines.append('%s_count{%s} %d' % (metric, _labels([('route', route)]), histogram.count))
+		counters = [(name, description) for name, description, counted in COUNTERS]
+		counters.append(('requests_total', 'Responses sent, by status.'))
+		for name, description in counters:
+			metric = '%s_%s' % (METRIC_PREFIX, name)
+			lines.append('# HELP %s %s' % (metric, description))
+			lines.append('# TYPE %s counter' % metric)
+			for (counter_name, labels), counted in sorted(_counters.items()):
+				if counter_name == name:
+					lines.append('%s{%s} %d' % (metric, _labels(labels), counted))
+	return '\n'.join(lines) + '\n'
@@ -1,32 +1,59 @@
 from django.conf.urls import patterns, url
-from django.views.generic import ListView, DetailView
-from blogengine.models import Post, Category, Tag
-from blogengine.views import CategoryListView, TagListView, PostsFeed
+from blogengine.models import Category, Tag
+from blogengine.routers import replica_reads
+from blogengine.views import CategoryListView, PostDetailView, PostListView, SearchView, TagListView
+from blogengine.views import ArchiveListView, export_posts, request_stats
+from blogengine.sitemaps import sitemap_index, sitemap_shard
+from blogengine.views import AuthorPostsFeed, CategoryPostsFeed, PostsFeed, TagPostsFeed
 
 urlpatterns = patterns('',
+	# Date archives, before the index would take /<year>/ as a page number
+	url(r'^(?P<year>\d{4})(?:/(?P<month>\d{1,2}))?/?$', replica_reads(ArchiveListView.as_view()),
+		name='archive'),
+
 	#index
-	url('^(?P<page>\d+)?/?$', ListView.as_view(
-		model=Post,
+	url('^(?P<page>\d+)?/?$', replica_reads(PostListView.as_view(
 		paginate_by=5,
-		)),
+		)), name='index'),
 
 	#individual posts
-	url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', DetailView.as_view(
-		model=Post,
-		)),		
+	url(r'^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', replica_reads(PostDetailView.as_view()),
+		name='detail'),
 
 	#categories
-	url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/?$', CategoryListView.as_view(
+	url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/?$', replica_reads(CategoryListView.as_view(
 		paginate_by=5,
 		model=Category,
-		)),
+		)), name='category'),
 
     # Tags
-    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/?$', TagListView.as_view(
+    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/?$', replica_reads(TagListView.as_view(
         paginate_by=5,
         model=Tag,
-        )),
+        )), name='tag'),
+
+    # Search
+    url(r'^search/?$', replica_reads(SearchView.as_view()), name='search'),
+
+    # Export for staff
+    url(r'^export/posts\.(?P<export_format>jsonl|tar\.gz)$', export_posts, name='export'),
+
+    # Sitemap index and its shards
+    url(r'^sitemap\.xml$', replica_reads(sitemap_index), name='sitemap'),
+    url(r'^sitemap-(?P<kind>posts)-(?P<year>\d{4})-(?P<month>\d{2})(?:-(?P<part>[2-9]|[1-9]\d+))?\.xml$',
+        replica_reads(sitemap_shard), name='sitemap-shard'),
+    url(r'^sitemap-(?P<kind>categories|tags)(?:-(?P<part>[2-9]|[1-9]\d+))?\.xml$', replica_reads(sitemap_shard),
+        name='sitemap-shard'),
+    url(r'^sitemap-(?P<kind>pages)\.xml$', replica_reads(sitemap_shard), name='sitemap-shard'),
 
     #post RSS feed
-    url(r'^feeds/posts/$', PostsFeed())
+    url(r'^feeds/posts/$', replica_reads(PostsFeed()), name='feed'),
+
+    # Category, tag and author feeds
+    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/feed/$', replica_reads(CategoryPostsFeed()), name='category-feed'),
+    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/feed/$', replica_reads(TagPostsFeed()), name='tag-feed'),
+    url(r'^author/(?P<username>[\w.@+-]+)/feed/$', replica_reads(AuthorPostsFeed()), name='author-feed'),
+
+    # Request timings for staff, see blogengine.timing
+    url(r'^metrics$', request_stats, name='metrics'),
 )
\ No newline at end of file
@@ -1,37 +1,472 @@
+import datetime
+from calendar import timegm
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import InvalidPage, Paginator
+from django.http import (Http404, HttpResponse, HttpResponseNotModified,
+	HttpResponsePermanentRedirect, HttpResponseRedirect, StreamingHttpResponse)
 from django.shortcuts import render
-from django.views.generic import ListView
-from blogengine.models import Category, Post, Tag
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.generic import DetailView, ListView
+from blogengine.cache import (changed_at, get_cached, get_versions, make_etag, request_key, set_cached,
+	site_dependencies)
+from blogengine.middleware import request_site, single_site
+from blogengine.models import Category, Post, RelatedPost, Tag
+from blogengine.pagination import EPOCH, KeysetPaginator
+from blogengine.publishing import last_publication, next_publication, publication_timeout
+from blogengine.records import jsonl_lines, markdown_tar, post_records
+from blogengine.search import search
+from blogengine.timing import render_stats
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.models import User
 from django.contrib.syndication.views import Feed
 
+# Deepest numbered page still redirected to its cursor, deeper ones are a 404
+MAX_OFFSET_PAGE = getattr(settings, 'BLOGENGINE_MAX_OFFSET_PAGE', 20)
+# Number of posts in each feed
+FEED_ITEMS = getattr(settings, 'BLOGENGINE_FEED_ITEMS', 20)
+
+def sidebar_dependencies(site):
+	"""What the widgets in blogengine/templatetags/sidebar.py depend on."""
+	return ['post-counts'] + site_dependencies(site.pk, 'archive', 'post-list')
+
+class KeysetListMixin(object):
+	"""Paginate a post listing with ?after= / ?before= cursors.
+
+	Numbered pages (``/3/`` or ``?page=3``) are redirected to the matching
+	cursor, up to MAX_OFFSET_PAGE.
+	"""
+	paginate_by = 5
+
+	def get(self, request, *args, **kwargs):
+		number = self.kwargs.get(self.page_kwarg) or request.GET.get(self.page_kwarg)
+		if number:
+			return self.redirect_to_page(number)
+		return super(KeysetListMixin, self).get(request, *args, **kwargs)
+
+	def get_listing_url(self):
+		return self.request.path
+
+	def redirect_to_page(self, number):
+		try:
+			number = int(number)
+		except ValueError:
+			raise Http404
+		if number > MAX_OFFSET_PAGE:
+			raise Http404
+		paginator = KeysetPaginator(self.get_queryset(), self.get_paginate_by(None))
+		try:
+			cursor = paginator.cursor_for_page(number)
+		except InvalidPage:
+			raise Http404
+		url = self.get_listing_url()
+		if cursor:
+			url = '%s?after=%s' % (url, cursor)
+		return HttpResponseRedirect(url)
+
+	def get_post_count(self):
+		"""Number of posts in the listing if it is stored, see blogengine.counts."""
+		return None
+
+	def paginate_queryset(self, queryset, page_size):
+		paginator = KeysetPaginator(queryset, page_size, self.get_post_count())
+		try:
+			page = paginator.page(after=self.request.GET.get('after'),
+								before=self.request.GET.get('before'))
+		except InvalidPage:
+			raise Http404
+		return (paginator, page, page.object_list, page.has_other_pages())
+
+def is_not_modified(request, etag, last_modified):
+	"""Whether the client's copy is current, per If-None-Match/If-Modified-Since."""
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if if_none_match:
+		etags = parse_etags(if_none_match)
+		return etag in etags or '*' in etags
+	if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+	return (if_modified_since is not None and last_modified is not None and
+			last_modified <= if_modified_since)
+
+def set_validators(response, page):
+	response['ETag'] = quote_etag(page['etag'])
+	if page['last_modified'] is not None:
+		response['Last-Modified'] = http_date(page['last_modified'])
+	return response
+
+def cached_page_response(request, page):
+	"""A 304 or 200 response for a page dict stored by the views below."""
+	if is_not_modified(request, page['etag'], page['last_modified']):
+		response = HttpResponseNotModified()
+	else:
+		response = HttpResponse(page['content'], content_type=page['content_type'])
+	return set_validators(response, page)
+
+def last_modified_of(versions, dates):
+	"""Timestamp for Last-Modified: the latest of ``dates``, of a change to a dependency
+	``versions`` were taken of, and of a post going live, which changes the counts shown."""
+	dates = [date for date in list(dates) + [last_publication()] if date is not None]
+	timestamps = [timegm(date.utctimetuple()) for date in dates] + [changed_at(versions)]
+	return max(timestamp for timestamp in timestamps if timestamp is not None)
+
+def post_dates(posts):
+	# A scheduled post changes the page when it goes live, after its last edit
+	return [max(post.modified, post.pub_date) for post in posts]
+
+class CachedPageMixin(object):
+	"""Cache the rendered page until something shown on it is invalidated.
+
+	The page is validated with an ETag built from the versions of its
+	dependencies (see blogengine.signals) and a Last-Modified from the posts
+	on it, so revalidations are answered with a 304 before rendering. Pages
+	expire when the next scheduled post goes live (see blogengine.publishing).
+	"""
+
+	def dispatch(self, request, *args, **kwargs):
+		if request.method not in ('GET', 'HEAD'):
+			return super(CachedPageMixin, self).dispatch(request, *args, **kwargs)
+
+		key = request_key(request)
+		page = get_cached(key)
+		if page is not None:
+			return cached_page_response(request, page)
+
+		response = super(CachedPageMixin, self).dispatch(request, *args, **kwargs)
+		if response.status_code != 200 or not hasattr(response, 'render'):
+			return response
+		dependencies = self.get_cache_dependencies(response.context_data)
+		if dependencies is None:
+			return response
+
+		versions = get_versions(dependencies)
+		page = {
+			'etag': make_etag(key, versions, next_publication()),
+			'last_modified': last_modified_of(versions, post_dates(self.get_page_posts(response.context_data))),
+			'content_type': response['Content-Type'],
+		}
+		if is_not_modified(request, page['etag'], page['last_modified']):
+			# The template is never rendered
+			return set_validators(HttpResponseNotModified(), page)
+
+		response.render()
+		page['content'] = response.content
+		set_cached(key, page, versions, publication_timeout())
+		return set_validators(response, page)
+
+	def get_site(self):
+		return request_site(self.request)
+
+	def get_page_posts(self, context):
+		return context['object_list']
+
+	def get_listing_dependencies(self):
+		"""Dependencies of the page apart from its posts, None to skip caching."""
+		return []
+
+	def get_cache_dependencies(self, context):
+		dependencies = self.get_listing_dependencies()
+		if dependencies is None:
+			return None
+		for post in self.get_page_posts(context):
+			dependencies.append('post:%d' % post.pk)
+			if post.category_id:
+				dependencies.append('category:%d' % post.category_id)
+			# Prefetched, so no queries
+			dependencies.extend('tag:%d' % tag.pk for tag in post.tags.all())
+		return dependencies
+
+class PostListView(CachedPageMixin, KeysetListMixin, ListView):
+	def get_queryset(self):
+		return Post.objects.for_listing().published().for_site(self.get_site())
+
+	def get_listing_url(self):
+		return '/'
+
+	def get_listing_dependencies(self):
+		site = self.get_site()
+		return site_dependencies(site.pk, 'post-list') + sidebar_dependencies(site)
+
+class PostDetailView(CachedPageMixin, DetailView):
+	"""Look posts up by their unique slug, then check the date in the URL."""
+
+	def get_queryset(self):
+		return Post.objects.for_listing().published().for_site(self.get_site())
+
+	def get_object(self, queryset=None):
+		if queryset is None:
+			queryset = self.get_queryset()
+		try:
+			return queryset.get(slug=self.kwargs['slug'])
+		except Post.DoesNotExist:
+			raise Http404
+
+	def get(self, request, *args, **kwargs):
+		self.object = self.get_object()
+		pub_date = self.object.pub_date
+		if (int(self.kwargs['year']), int(self.kwargs['month'])) != (pub_date.year, pub_date.month):
+			return HttpResponsePermanentRedirect(self.object.get_absolute_url())
+		context = self.get_context_data(object=self.object)
+		return self.render_to_response(context)
+
+	def get_context_data(self, **kwargs):
+		context = super(PostDetailView, self).get_context_data(**kwargs)
+		context['related_posts'] = [link.related for link in
+			RelatedPost.objects.filter(post=self.object, related__pub_date__lte=timezone.now(),
+				related__site=self.object.site_id).select_related('related')]
+		return context
+
+	def get_page_posts(self, context):
+		return [context['object']]
+
+	def get_cache_dependencies(self, context):
+		dependencies = super(PostDetailView, self).get_cache_dependencies(context)
+		dependencies.append('related:%d' % context['object'].pk)
+		dependencies.extend('post:%d' % post.pk for post in context['related_posts'])
+		return dependencies
+
 # Create your views here.
-class CategoryListView(ListView):
+class CategoryListView(CachedPageMixin, KeysetListMixin, ListView):
+	category = None
+
 	def get_queryset(self):
 		slug = self.kwargs['slug']
 		try:
-			category = Category.objects.get(slug=slug)
-			return Post.objects.filter(category=category)
+			self.category = Category.objects.get(slug=slug)
+			return Post.objects.for_listing().published().for_site(self.get_site()).filter(
+				category=self.category)
 		except Category.DoesNotExist:
 			return Post.objects.none()
 
-class TagListView(ListView):
+	def get_listing_dependencies(self):
+		if self.category is not None:
+			site = self.get_site()
+			dependency = 'category:%d' % self.category.pk
+			return [dependency] + site_dependencies(site.pk, dependency) + sidebar_dependencies(site)
+
+	def get_post_count(self):
+		# The stored count includes scheduled posts and every site's posts
+		if self.category is not None and next_publication() is None and single_site():
+			return self.category.post_count
+
+class TagListView(CachedPageMixin, KeysetListMixin, ListView):
+    tag = None
+
     def get_queryset(self):
         slug = self.kwargs['slug']
         try:
-            tag = Tag.objects.get(slug=slug)
-            return tag.post_set.all()
+            self.tag = Tag.objects.get(slug=slug)
+            return Post.objects.for_listing().published().for_site(self.get_site()).filter(tags=self.tag)
         except Tag.DoesNotExist:
             return Post.objects.none()
 
-class PostsFeed(Feed):
+    def get_listing_dependencies(self):
+        if self.tag is not None:
+            site = self.get_site()
+            dependency = 'tag:%d' % self.tag.pk
+            return [dependency] + site_dependencies(site.pk, dependency) + sidebar_dependencies(site)
+
+    def get_post_count(self):
+        if self.tag is not None and next_publication() is None and single_site():
+            return self.tag.post_count
+
+class ArchiveListView(CachedPageMixin, KeysetListMixin, ListView):
+	"""Posts of the request's site published in a year, or in a month of it."""
+
+	def get_period(self):
+		"""Start and end of the period, and the months it covers."""
+		year = int(self.kwargs['year'])
+		month = self.kwargs.get('month')
+		try:
+			if month:
+				month = int(month)
+				start = datetime.datetime(year, month, 1, tzinfo=EPOCH.tzinfo)
+				end = datetime.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=EPOCH.tzinfo)
+				return start, end, [month]
+			start = datetime.datetime(year, 1, 1, tzinfo=EPOCH.tzinfo)
+			end = datetime.datetime(year + 1, 1, 1, tzinfo=EPOCH.tzinfo)
+			return start, end, range(1, 13)
+		except ValueError:
+			raise Http404
+
+	def get_queryset(self):
+		start, end, months = self.get_period()
+		return Post.objects.for_listing().published().for_site(self.get_site()).filter(
+			pub_date__gte=start, pub_date__lt=end)
+
+	def get_listing_dependencies(self):
+		start, end, months = self.get_period()
+		site = self.get_site()
+		return (site_dependencies(site.pk, *['archive:%d-%d' % (start.year, month) for month in months]) +
+				sidebar_dependencies(site))
+
+class SearchView(ListView):
+	"""Ranked search results, see blogengine.search."""
+	template_name = 'blogengine/search.html'
+	paginate_by = 10
+
+	def get_queryset(self):
+		# Just the ranked ids, only the current page is loaded
+		return search(self.request.GET.get('q', ''), request_site(self.request))
+
+	def paginate_queryset(self, queryset, page_size):
+		paginator = Paginator(queryset, page_size)
+		try:
+			page = paginator.page(self.request.GET.get('page') or 1)
+		except InvalidPage:
+			raise Http404
+		posts = Post.objects.for_listing().in_bulk(page.object_list)
+		page.object_list = [posts[pk] for pk in page.object_list if pk in posts]
+		return (paginator, page, page.object_list, page.has_other_pages())
+
+	def get_context_data(self, **kwargs):
+		context = super(SearchView, self).get_context_data(**kwargs)
+		context['query'] = self.request.GET.get('q', '')
+		return context
+
+@staff_member_required
+def request_stats(request):
+	"""This process' request timings in the Prometheus text format, see blogengine.timing."""
+	return HttpResponse(render_stats(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@staff_member_required
+def export_posts(request, export_format):
+	"""Stream every post as JSON lines or a tar of Markdown files, see exportposts."""
+	records = post_records(Post.objects.all())
+	if export_format == 'jsonl':
+		response = StreamingHttpResponse(jsonl_lines(records), content_type='application/x-ndjson')
+		filename = 'posts.jsonl'
+	else:
+		response = StreamingHttpResponse(markdown_tar(records, compress=True), content_type='application/gzip')
+		filename = 'posts.tar.gz'
+	response['Content-Disposition'] = 'attachment; filename=%s' % filename
+	return response
+
+class CachedFeed(Feed):
+	"""A Feed whose whole document is cached until its dependencies change.
+
+	``get_object`` returns what the feed is about with the request's site
+	as ``feed_site``.
+	"""
+
+	def get_listing_dependencies(self, obj):
+		return site_dependencies(obj.feed_site.pk, 'post-list')
+
+	def __call__(self, request, *args, **kwargs):
+		key = request_key(request, 'feed')
+		page = get_cached(key)
+		if page is not None:
+			return cached_page_response(request, page)
+
+		try:
+			obj = self.get_object(request, *args, **kwargs)
+		except ObjectDoesNotExist:
+			raise Http404('Feed object does not exist.')
+
+		# One small query so aggregators revalidating get a 304 without a rebuild
+		items = list(self.items(obj).values_list('pk', 'modified', 'pub_date'))
+		dependencies = self.get_listing_dependencies(obj) + ['post:%d' % item[0] for item in items]
+		versions = get_versions(dependencies)
+		page = {
+			'etag': make_etag(key, versions, next_publication()),
+			'last_modified': last_modified_of(versions, [max(item[1:]) for item in items]),
+		}
+		if is_not_modified(request, page['etag'], page['last_modified']):
+			return set_validators(HttpResponseNotModified(), page)
+
+		# Same as Feed.__call__
+		feedgen = self.get_feed(obj, request)
+		response = HttpResponse(content_type=feedgen.mime_type)
+		feedgen.write(response, 'utf-8')
+
+		page['content'] = response.content
+		page['content_type'] = response['Content-Type']
+		set_cached(key, page, versions, publication_timeout())
+		return set_validators(response, page)
+
+class PostsFeed(CachedFeed):
 	title = "RSS feed - posts"
 	link = "feeds/posts/"
 	description = "RSS feed - blog posts"
 
-	def items(self):
-		return Post.objects.order_by('-pub_date')
+	def get_object(self, request):
+		site = request_site(request)
+		site.feed_site = site
+		return site
+
+	def get_posts(self, obj):
+		return Post.objects.published().for_site(obj.feed_site).order_by('-pub_date', '-pk')
+
+	def items(self, obj):
+		return self.get_posts(obj)[:FEED_ITEMS]
 
 	def item_title(self, item):
 		return item.title
 
 	def item_description(self, item):
-		return item.text
\ No newline at end of file
+		return item.text_html
+
+class CategoryPostsFeed(PostsFeed):
+	def get_object(self, request, slug):
+		category = Category.objects.get(slug=slug)
+		category.feed_site = request_site(request)
+		return category
+
+	def get_listing_dependencies(self, obj):
+		dependency = 'category:%d' % obj.pk
+		return [dependency] + site_dependencies(obj.feed_site.pk, dependency)
+
+	def title(self, obj):
+		return "RSS feed - %s posts" % obj.name
+
+	def link(self, obj):
+		return obj.get_absolute_url()
+
+	def description(self, obj):
+		return "RSS feed - blog posts in %s" % obj.name
+
+	def get_posts(self, obj):
+		return super(CategoryPostsFeed, self).get_posts(obj).filter(category=obj)
+
+class TagPostsFeed(PostsFeed):
+	def get_object(self, request, slug):
+		tag = Tag.objects.get(slug=slug)
+		tag.feed_site = request_site(request)
+		return tag
+
+	def get_listing_dependencies(self, obj):
+		dependency = 'tag:%d' % obj.pk
+		return [dependency] + site_dependencies(obj.feed_site.pk, dependency)
+
+	def title(self, obj):
+		return "RSS feed - posts tagged %s" % obj.name
+
+	def link(self, obj):
+		return obj.get_absolute_url()
+
+	def description(self, obj):
+		return "RSS feed - blog posts tagged %s" % obj.name
+
+	def get_posts(self, obj):
+		return super(TagPostsFeed, self).get_posts(obj).filter(tags=obj)
+
+class AuthorPostsFeed(PostsFeed):
+	def get_object(self, request, username):
+		author = User.objects.get(username=username)
+		author.feed_site = request_site(request)
+		return author
+
+	def get_listing_dependencies(self, obj):
+		return site_dependencies(obj.feed_site.pk, 'author:%d' % obj.pk)
+
+	def title(self, obj):
+		return "RSS feed - posts by %s" % obj.username
+
+	def link(self, obj):
+		return "/author/%s/feed/" % obj.username
+
+	def description(self, obj):
+		return "RSS feed - blog posts by %s" % obj.username
+
+	def get_posts(self, obj):
+		return super(AuthorPostsFeed, self).get_posts(obj).filter(author=obj)
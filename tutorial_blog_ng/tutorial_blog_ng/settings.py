@@ -44,12 +44,17 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so the timings cover the other middleware too
+    'blogengine.middleware.TimingMiddleware',
+    # Early, so it sees every write of the request, the session's included
+    'blogengine.middleware.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'blogengine.middleware.CurrentSiteMiddleware',
 )
 
 ROOT_URLCONF = 'tutorial_blog_ng.urls'
@@ -74,6 +79,9 @@ DATABASES = {
     }
 }
 
+# Public pages read from any other DATABASES aliases, see blogengine/routers.py
+DATABASE_ROUTERS = ['blogengine.routers.ReplicaRouter']
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -96,6 +104,12 @@ STATIC_URL = '/static/'
 #template directory
 TEMPLATE_DIRS = [os.path.join(BASE_DIR, 'templates')]
 
+# The request, so template tags can tell which site they render for
+from django.conf import global_settings
+TEMPLATE_CONTEXT_PROCESSORS = global_settings.TEMPLATE_CONTEXT_PROCESSORS + (
+    'django.core.context_processors.request',
+)
+
 SITE_ID = 1
 
 INSTALLED_APPS += ('django_jenkins',)
@@ -1,6 +1,8 @@
 from django.conf.urls import patterns, include, url
 
 from django.contrib import admin
+from django.contrib.flatpages.views import flatpage
+from blogengine.routers import replica_reads
 admin.autodiscover()
 
 urlpatterns = patterns('',
@@ -14,6 +16,6 @@ urlpatterns = patterns('',
     url(r'', include('blogengine.urls')),
 
     # flat pages
-    url(r'', include('django.contrib.flatpages.urls')),
+    url(r'^(?P<url>.*)$', replica_reads(flatpage), name='flatpage'),
     
 )